@@ -17,21 +17,29 @@ import hashlib
 import uuid
 import secrets
 import threading
+import socket
+import ipaddress
 import logging
 import asyncio
 import aiohttp
 from datetime import datetime, timedelta
 from io import BytesIO
 from urllib.parse import urlparse, urljoin
-from functools import wraps
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import wraps, partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import queue
 import zipfile
+import gzip
+import zlib
+from itertools import islice
 import xml.etree.ElementTree as ET
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict, namedtuple
+import sqlite3
 
 # Core Flask
-from flask import Flask, request, jsonify, send_file, render_template_string, session, redirect, url_for
+from flask import Flask, Response, request, jsonify, send_file, render_template_string, session, redirect, url_for
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
@@ -45,12 +53,26 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException, NoSuchElementException
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, Tag
+import soupsieve as sv
 import requests
 from fake_useragent import UserAgent
 
+try:
+    import lxml  # noqa: F401 - parser HTML veloce per BeautifulSoup
+    LXML_AVAILABLE = True
+except ImportError:
+    LXML_AVAILABLE = False
+
+try:
+    import orjson  # parser JSON veloce per dati strutturati
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 # Excel Professional + Images
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, NamedStyle
 from openpyxl.drawing.image import Image as XLImage
 from openpyxl.utils import get_column_letter
@@ -109,6 +131,96 @@ class OmniSystemConfig:
     EXCEL_MAX_FILE_SIZE = 500 * 1024 * 1024
     EXCEL_SPLIT_AT = 5000
     
+    # Export in streaming (risposta chunked, buffer limitato, nessun file su disco)
+    EXPORT_STREAM_CHUNK_SIZE = 64 * 1024
+    EXPORT_STREAM_BUFFER_CHUNKS = 16
+    EXPORT_STREAM_WORKERS = int(os.environ.get('EXPORT_STREAM_WORKERS', '4'))
+    EXPORT_STREAM_IDLE_TIMEOUT = 60  # secondi senza chunk (produttori tutti occupati o bloccati) prima di fallire
+    EXPORT_STREAM_TOKEN_TTL = 600
+    
+    # Cache degli export per contenuto (retention LRU su EXPORT_PATH)
+    EXPORT_CACHE_ENABLED = os.environ.get('EXPORT_CACHE_ENABLED', 'true').lower() == 'true'
+    EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', str(2 * 1024 * 1024 * 1024)))
+    EXPORT_CACHE_DB_PATH = os.environ.get('EXPORT_CACHE_DB_PATH', './cache/export_cache.db')
+    
+    # Immagini prodotto negli export (miniature in cache per contenuto sotto TEMP_PATH)
+    IMAGE_THUMB_SIZE = 64  # px, lato lungo
+    IMAGE_FETCH_CONCURRENCY = 32  # download + decodifica in corso (limita anche la memoria)
+    IMAGE_FETCH_PER_HOST = 6
+    IMAGE_FETCH_TIMEOUT = 10
+    IMAGE_MAX_SOURCE_BYTES = 8 * 1024 * 1024
+    IMAGE_MAX_PIXELS = 40_000_000  # dopo il draft: oltre, l'immagine viene scartata
+    IMAGE_BLOCK_TIMEOUT = 30  # budget per blocco di AI_BATCH_SIZE prodotti
+    IMAGE_HOST_MAX_FAILURES = 5  # errori consecutivi prima di saltare l'host per il resto dell'export
+    IMAGE_MAX_REDIRECTS = 3
+    IMAGE_URL_TTL = 7 * 24 * 3600
+    IMAGE_FAILED_TTL = 6 * 3600
+    IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+    
+    # AI Competitor Analysis batch
+    AI_BATCH_SIZE = 500  # prodotti letti per blocco durante l'export
+    AI_BATCH_CONCURRENCY = 8  # analisi uniche in parallelo
+    AI_CACHE_TTL = 3600
+    AI_CACHE_MAX_ENTRIES = 20000
+    AI_CACHE_MAX_BYTES = 64 * 1024 * 1024
+    AI_CACHE_SHARED = os.environ.get('AI_CACHE_SHARED', 'true').lower() == 'true'
+    AI_CACHE_SQLITE_PATH = os.environ.get('AI_CACHE_SQLITE_PATH', './cache/market_analysis.db')
+    
+    # Memoria strategie per dominio (probe sitemap/API, fasi)
+    STRATEGY_DB_PATH = os.environ.get('STRATEGY_DB_PATH', './cache/domain_strategy.db')
+    PROBE_NEGATIVE_TTL = 6 * 3600  # probe falliti non ripetuti per 6 ore
+    STRATEGY_TTL = 7 * 24 * 3600
+    HTTP_CACHE_ENABLED = os.environ.get('HTTP_CACHE_ENABLED', 'true').lower() == 'true'
+    HTTP_CACHE_MAX_BYTES = int(os.environ.get('HTTP_CACHE_MAX_BYTES', str(1024 * 1024 * 1024)))
+    SELECTOR_PRUNE_MISSES = 20  # selettori card mai riusciti spostati in coda dopo N pagine a vuoto
+    SELECTOR_FIELD_PRUNE_HITS = 200  # card risolte per campo prima di togliere i selettori campo mai riusciti
+    SELECTOR_STATS_REFRESH = 60  # secondi prima di rileggere le statistiche condivise
+    
+    # HTML Parsing
+    HTML_PARSER = os.environ.get('HTML_PARSER') or ('lxml' if LXML_AVAILABLE else 'html.parser')
+    
+    # Thread pool per richieste bloccanti (cloudscraper)
+    FETCH_WORKERS = int(os.environ.get('FETCH_WORKERS', '64'))
+    
+    # HTTP pool condiviso (discovery bulk)
+    HTTP_POOL_LIMIT = 100
+    HTTP_POOL_LIMIT_PER_HOST = 8
+    HTTP_DNS_CACHE_TTL = 300
+    HTTP_KEEPALIVE_TIMEOUT = 30
+    
+    # Arricchimento da pagine prodotto (URL da sitemap/API)
+    ENRICH_CONCURRENCY = 16  # pagine dettaglio in parallelo (per host vale HTTP_POOL_LIMIT_PER_HOST)
+    ENRICH_READ_TIMEOUT = 20
+    ENRICH_MAX_BLOCKS = 20  # blocchi senza successi prima di abbandonare
+    
+    # Sitemap streaming
+    SITEMAP_CONCURRENCY = 4  # sitemap figlie lette in parallelo
+    SITEMAP_MAX_DEPTH = 3  # livelli di sitemap index seguiti
+    SITEMAP_READ_TIMEOUT = 30
+    SITEMAP_MAX_URLS = 5000
+    
+    # Processi web sullo stesso host (gunicorn -w, esportato da start_production.sh): i pool sono per processo
+    WEB_WORKERS = max(1, int(os.environ.get('WEB_WORKERS', '1')))
+    
+    # Pool di processi per il parsing HTML (0 = parsing nel processo, default su host single-core).
+    # Ogni figlio reimporta app.py (~200 MB): i core sono divisi tra i processi web, al massimo 4 ciascuno
+    PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', str(
+        min(4, (os.cpu_count() or 1) // WEB_WORKERS) if (os.cpu_count() or 1) > 1 else 0
+    )))
+    PARSE_START_METHOD = os.environ.get('PARSE_START_METHOD', 'spawn')
+    
+    # Pool di processi separato per gli export (parti Excel, miniature): non compete con le estrazioni.
+    # Metà della quota di core del processo web, al massimo 2
+    EXPORT_WORKERS = int(os.environ.get('EXPORT_WORKERS', str(
+        min(2, max(1, (os.cpu_count() or 1) // (2 * WEB_WORKERS))) if (os.cpu_count() or 1) > 1 else 0
+    )))
+    
+    # Background Jobs
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+    JOB_PROGRESS_INTERVAL = 2.0  # secondi tra salvataggi del progresso
+    JOB_HEARTBEAT_INTERVAL = 15  # secondi tra heartbeat dei job del processo
+    JOB_STALE_AFTER = 120  # job queued/running senza heartbeat da più tempo = worker morto
+    
     # Rate Limiting Production
     RATE_LIMIT_PER_MINUTE = 60
     RATE_LIMIT_PER_HOUR = 2000
@@ -118,6 +230,10 @@ class OmniSystemConfig:
     EXPORT_PATH = './exports'
     TEMP_PATH = './temp_images'
     LOGS_PATH = './logs'
+    RESULTS_PATH = './results'
+    RESULTS_TTL_HOURS = 72
+    CACHE_PATH = './cache'
+    PRODUCT_INDEX_PATH = os.environ.get('PRODUCT_INDEX_PATH', './cache/product_index.db')
     CHROME_DRIVER_PATH = '/usr/bin/chromedriver'
     
     # ===============================================
@@ -439,7 +555,8 @@ logger = logging.getLogger(__name__)
 ua = UserAgent()
 
 # Create directories
-for path in [OmniSystemConfig.EXPORT_PATH, OmniSystemConfig.TEMP_PATH, OmniSystemConfig.LOGS_PATH]:
+for path in [OmniSystemConfig.EXPORT_PATH, OmniSystemConfig.TEMP_PATH, OmniSystemConfig.LOGS_PATH,
+             OmniSystemConfig.RESULTS_PATH, OmniSystemConfig.CACHE_PATH]:
     os.makedirs(path, exist_ok=True)
 
 # ==========================================
@@ -552,6 +669,56 @@ class Conversion(db.Model):
             'portal_type': self.portal_type
         }
 
+class ExtractionResult(db.Model):
+    __tablename__ = 'extraction_results'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    url = db.Column(db.String(500))
+    portal_type = db.Column(db.String(20))
+    products_count = db.Column(db.Integer)
+    file_path = db.Column(db.String(300))
+    file_size = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def to_dict(self):
+        return {
+            'extraction_id': self.id,
+            'url': self.url,
+            'portal_type': self.portal_type,
+            'products_count': self.products_count,
+            'created_at': self.created_at.isoformat() if self.created_at else None
+        }
+
+class OmniJob(db.Model):
+    __tablename__ = 'jobs'
+    
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), default='queued', index=True)
+    params = db.Column(db.Text)
+    progress = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    owner = db.Column(db.String(128))  # host:pid del worker che esegue il job
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'progress': json.loads(self.progress) if self.progress else {},
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
 class SystemMetrics(db.Model):
     __tablename__ = 'system_metrics'
     
@@ -571,13 +738,29 @@ class SystemMetrics(db.Model):
 
 class IntelligentSiteProfileManager:
     """
-    Gestione profili intelligente per ogni tipo di sito
+    Gestione profili intelligente per ogni tipo di sito. Impara per
+    dominio quali selettori card e campo funzionano (statistiche in
+    SQLite condivise tra i processi) e ne ricava il selector plan
+    """
+    
+    SELECTOR_SCHEMA = """
+        CREATE TABLE IF NOT EXISTS selector_stats (
+            domain TEXT NOT NULL,
+            field TEXT NOT NULL,
+            selector TEXT NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0,
+            misses INTEGER NOT NULL DEFAULT 0,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (domain, field, selector)
+        );
     """
     
     def __init__(self):
         self.profiles = {}
-        self.learning_data = defaultdict(list)
+        self.learning_data = {}  # dominio -> statistiche selettori (cache)
         self.blocked_patterns = defaultdict(list)
+        self.selector_store = SharedSQLiteStore(OmniSystemConfig.STRATEGY_DB_PATH, self.SELECTOR_SCHEMA)
+        self.lock = threading.Lock()
         self._init_all_profiles()
     
     def _init_all_profiles(self):
@@ -709,6 +892,104 @@ class IntelligentSiteProfileManager:
         self.profiles[domain] = profile
         return profile
     
+    def _selector_stats(self, domain):
+        """Statistiche selettori del dominio: {campo: {selettore: [hits, misses]}}"""
+        now = time.time()
+        cached = self.learning_data.get(domain)
+        if cached and now - cached['loaded_at'] < OmniSystemConfig.SELECTOR_STATS_REFRESH:
+            return cached['stats']
+        
+        stats = defaultdict(dict)
+        try:
+            rows = self.selector_store.execute(
+                'SELECT field, selector, hits, misses FROM selector_stats WHERE domain = ?', (domain,)
+            ).fetchall()
+            for field, selector, hits, misses in rows:
+                stats[field][selector] = [hits, misses]
+        except sqlite3.Error as e:
+            logger.debug(f"Selector stats read failed: {e}")
+        
+        with self.lock:
+            self.learning_data[domain] = {'loaded_at': now, 'stats': stats}
+        return stats
+    
+    def record_parse(self, domain, parse_stats):
+        """Registra l'esito del parsing di una pagina (statistiche da parse_listing)"""
+        rows = []
+        
+        card = parse_stats.get('card')
+        if card and card not in ('structured', 'microdata'):
+            rows.append(('card', card, 1, 0))
+        for selector in parse_stats.get('misses', []):
+            rows.append(('card', selector, 0, 1))
+        for field, counts in parse_stats.get('fields', {}).items():
+            for selector, count in counts.items():
+                rows.append((field, selector, count, 0))
+        
+        if not rows:
+            return
+        
+        # Aggiorna subito la cache locale, poi lo store condiviso
+        stats = self._selector_stats(domain)
+        with self.lock:
+            for field, selector, hits, misses in rows:
+                entry = stats[field].setdefault(selector, [0, 0])
+                entry[0] += hits
+                entry[1] += misses
+        
+        now = time.time()
+        try:
+            self.selector_store.executemany(
+                'INSERT INTO selector_stats VALUES (?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (domain, field, selector) DO UPDATE SET '
+                'hits = hits + excluded.hits, misses = misses + excluded.misses, updated_at = excluded.updated_at',
+                [(domain, field, selector, hits, misses, now) for field, selector, hits, misses in rows]
+            )
+        except sqlite3.Error as e:
+            logger.debug(f"Selector stats write failed: {e}")
+    
+    def selector_plan(self, domain, selectors):
+        """
+        Selector plan del dominio: selettori card riusciti per primi (per
+        numero di successi), poi gli altri nell'ordine del profilo; quelli
+        mai riusciti dopo SELECTOR_PRUNE_MISSES pagine finiscono nel
+        fallback. I selettori campo restano nell'ordine di priorità (il
+        primo che trova vince, riordinarli cambierebbe i valori estratti):
+        dopo SELECTOR_FIELD_PRUNE_HITS card risolte si tolgono solo quelli
+        provati e mai riusciti (prima dell'ultimo vincente); quelli dopo
+        restano come ripiego
+        """
+        stats = self._selector_stats(domain)
+        card = stats.get('card', {})
+        
+        learned = sorted((s for s in selectors if card.get(s, [0, 0])[0] > 0), key=lambda s: -card[s][0])
+        rest = [s for s in selectors if s not in learned]
+        fallback = []
+        
+        if learned:
+            fallback = [s for s in rest if card.get(s, [0, 0])[1] >= OmniSystemConfig.SELECTOR_PRUNE_MISSES]
+            rest = [s for s in rest if s not in fallback]
+        
+        fields = {}
+        defaults = {
+            'name': ProductHtmlParser.NAME_SELECTORS,
+            'price': ProductHtmlParser.PRICE_SELECTORS,
+            'brand': ProductHtmlParser.BRAND_SELECTORS
+        }
+        for field, field_selectors in defaults.items():
+            counts = stats.get(field)
+            if not counts:
+                continue
+            
+            with self.lock:
+                resolved = sum(hits for hits, _ in counts.values())
+                used = [s for s in field_selectors if counts.get(s, [0, 0])[0] > 0]
+            if used and resolved >= OmniSystemConfig.SELECTOR_FIELD_PRUNE_HITS:
+                last = field_selectors.index(used[-1])
+                fields[field] = used + field_selectors[last + 1:]
+        
+        return {'selectors': learned + rest, 'fallback': fallback, 'fields': fields}
+    
     def _get_universal_selectors(self):
         """Selettori universali che funzionano ovunque"""
         return [
@@ -880,6 +1161,628 @@ class AdvancedIdentitySystem:
                 if identity['block_count'] < 3:
                     self.blocked_identities.discard(identity['id'])
 
+# ==========================================
+#  SHARED CACHES
+# ==========================================
+
+class SharedSQLiteStore:
+    """
+    File SQLite condiviso tra i worker gunicorn (WAL), con una connessione
+    per thread
+    """
+    
+    def __init__(self, path, schema):
+        self.path = path
+        self.schema = schema
+        self.local = threading.local()
+    
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.schema)
+            self.local.conn = conn
+        return conn
+    
+    def execute(self, sql, params=()):
+        return self.connection().execute(sql, params)
+    
+    def executemany(self, sql, rows):
+        return self.connection().executemany(sql, rows)
+
+class MarketAnalysisCache:
+    """
+    Cache process-wide LRU + TTL per le analisi di mercato, con contatori
+    hit/miss, limite su numero di voci e dimensione stimata, e tier SQLite
+    opzionale condiviso tra i worker
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS market_analysis (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_market_analysis_expires ON market_analysis (expires_at);
+    """
+    
+    def __init__(self, max_entries, max_bytes, ttl, sqlite_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (value, expires_at, size)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.last_sweep = time.time()
+        self.shared = SharedSQLiteStore(sqlite_path, self.SCHEMA) if sqlite_path else None
+    
+    def get(self, key):
+        """Valore in cache o None"""
+        now = time.time()
+        
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[1] > now:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                self._remove(key)
+                self.stats['expired'] += 1
+        
+        # Tier condiviso
+        if self.shared:
+            try:
+                row = self.shared.execute(
+                    'SELECT value, expires_at FROM market_analysis WHERE key = ? AND expires_at > ?',
+                    (key, now)
+                ).fetchone()
+                if row:
+                    value = json.loads(row[0])
+                    with self.lock:
+                        self._store(key, value, row[1], len(row[0]))
+                        self.stats['hits'] += 1
+                        self.stats['shared_hits'] += 1
+                    return value
+            except Exception as e:
+                logger.warning(f"Shared analysis cache read failed: {e}")
+        
+        with self.lock:
+            self.stats['misses'] += 1
+        return None
+    
+    def set(self, key, value):
+        """Salva un valore con TTL"""
+        expires_at = time.time() + self.ttl
+        payload = json.dumps(value, default=str)
+        
+        with self.lock:
+            self._store(key, value, expires_at, len(payload))
+            self._maybe_sweep()
+        
+        if self.shared:
+            try:
+                self.shared.execute(
+                    'INSERT OR REPLACE INTO market_analysis (key, value, expires_at) VALUES (?, ?, ?)',
+                    (key, payload, expires_at)
+                )
+            except Exception as e:
+                logger.warning(f"Shared analysis cache write failed: {e}")
+    
+    def info(self):
+        """Statistiche cache"""
+        with self.lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.stats['hits'],
+                'shared_hits': self.stats['shared_hits'],
+                'misses': self.stats['misses'],
+                'evictions': self.stats['evictions'],
+                'expired': self.stats['expired'],
+                'hit_rate': round(self.stats['hits'] / lookups, 3) if lookups else 0,
+                'shared_tier': bool(self.shared)
+            }
+    
+    def _store(self, key, value, expires_at, size):
+        if key in self.entries:
+            self._remove(key)
+        
+        self.entries[key] = (value, expires_at, size)
+        self.total_bytes += size
+        
+        # Eviction LRU
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            oldest = next(iter(self.entries))
+            self._remove(oldest)
+            self.stats['evictions'] += 1
+    
+    def _remove(self, key):
+        _, _, size = self.entries.pop(key)
+        self.total_bytes -= size
+    
+    def _maybe_sweep(self):
+        """Rimuove periodicamente le voci scadute anche se mai rilette"""
+        now = time.time()
+        if now - self.last_sweep < 60:
+            return
+        
+        self.last_sweep = now
+        expired = [key for key, entry in self.entries.items() if entry[1] <= now]
+        for key in expired:
+            self._remove(key)
+        self.stats['expired'] += len(expired)
+        
+        if self.shared:
+            try:
+                self.shared.execute('DELETE FROM market_analysis WHERE expires_at <= ?', (now,))
+            except Exception as e:
+                logger.warning(f"Shared analysis cache sweep failed: {e}")
+
+market_analysis_cache = MarketAnalysisCache(
+    max_entries=OmniSystemConfig.AI_CACHE_MAX_ENTRIES,
+    max_bytes=OmniSystemConfig.AI_CACHE_MAX_BYTES,
+    ttl=OmniSystemConfig.AI_CACHE_TTL,
+    sqlite_path=OmniSystemConfig.AI_CACHE_SQLITE_PATH if OmniSystemConfig.AI_CACHE_SHARED else None
+)
+
+class DomainStrategyMemory:
+    """
+    Memoria persistente per dominio dei percorsi di discovery (fasi e
+    singoli probe sitemap/API): esito, latenza e resa. I probe falliti
+    restano in cache negativa per PROBE_NEGATIVE_TTL, quelli riusciti
+    vengono provati per primi nei job successivi
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS domain_strategy (
+            domain TEXT NOT NULL,
+            probe TEXT NOT NULL,
+            ok INTEGER NOT NULL,
+            latency REAL NOT NULL,
+            yield INTEGER NOT NULL,
+            checked_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (domain, probe)
+        );
+    """
+    
+    def __init__(self, path, negative_ttl, positive_ttl):
+        self.store = SharedSQLiteStore(path, self.SCHEMA)
+        self.negative_ttl = negative_ttl
+        self.positive_ttl = positive_ttl
+    
+    def record(self, domain, probe, ok, latency, yield_count=0):
+        """Salva l'esito di un probe o di una fase"""
+        now = time.time()
+        ttl = self.positive_ttl if ok else self.negative_ttl
+        
+        try:
+            self.store.execute(
+                'INSERT OR REPLACE INTO domain_strategy VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (domain, probe, int(bool(ok)), latency, yield_count, now, now + ttl)
+            )
+        except sqlite3.Error as e:
+            logger.debug(f"Strategy memory write failed: {e}")
+    
+    def get(self, domain, prefix=''):
+        """{probe: {'ok', 'latency', 'yield'}} non scaduti per il dominio"""
+        try:
+            rows = self.store.execute(
+                'SELECT probe, ok, latency, yield FROM domain_strategy '
+                'WHERE domain = ? AND probe LIKE ? AND expires_at > ?',
+                (domain, prefix + '%', time.time())
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.debug(f"Strategy memory read failed: {e}")
+            return {}
+        
+        return {row[0]: {'ok': bool(row[1]), 'latency': row[2], 'yield': row[3]} for row in rows}
+    
+    @staticmethod
+    def _cost(record):
+        """Secondi per prodotto trovato"""
+        return record['latency'] / max(record['yield'], 1)
+    
+    def order_probes(self, domain, prefix, candidates):
+        """
+        Probe da tentare: solo quelli già riusciti (dal più economico) se
+        ce ne sono, altrimenti i candidati senza i falliti di recente
+        """
+        records = self.get(domain, prefix)
+        working = [c for c in candidates if records.get(prefix + c, {}).get('ok')]
+        if working:
+            return sorted(working, key=lambda c: self._cost(records[prefix + c]))
+        return [c for c in candidates if prefix + c not in records]
+    
+    def order_phases(self, domain, phases):
+        """Fasi riuscite (dalla più economica), poi quelle ignote, poi le fallite"""
+        records = self.get(domain, 'phase:')
+        
+        def rank(phase):
+            record = records.get('phase:' + phase)
+            if record is None:
+                return (1, 0)
+            if record['ok']:
+                return (0, self._cost(record))
+            return (2, 0)
+        
+        return sorted(phases, key=rank)
+
+# Risposta listing ricostruita dalla cache dopo un 304
+CachedResponse = namedtuple('CachedResponse', ['status_code', 'content', 'encoding', 'headers', 'cache_entry'])
+
+class HttpCacheWriter:
+    """Scrittura in streaming di un corpo in cache (file temporaneo, commit atomico)"""
+    
+    def __init__(self, cache, url, etag, last_modified, encoding):
+        self.cache = cache
+        self.url = url
+        self.etag = etag
+        self.last_modified = last_modified
+        self.encoding = encoding
+        self.key = cache.key(url)
+        self.path = cache.file_path(self.key, 'body')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.tmp_path = f"{self.path}.{uuid.uuid4().hex[:8]}.tmp"
+        self.file = gzip.open(self.tmp_path, 'wb', compresslevel=3)
+    
+    def write(self, chunk):
+        self.file.write(chunk)
+    
+    def commit(self):
+        """Chiude il file e lo registra nell'indice: ritorna la voce di cache"""
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        return self.cache.index_body(self)
+    
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+class HttpResponseCache:
+    """
+    Cache HTTP su disco per pagine listing, sitemap e dettaglio: salva il
+    corpo (gzip) con ETag/Last-Modified, li ripresenta come If-None-Match/
+    If-Modified-Since e su 304 riusa il corpo e i prodotti già estratti.
+    Dimensione totale limitata (eviction LRU sull'indice SQLite)
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS http_cache (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            encoding TEXT,
+            parse_key TEXT,
+            size INTEGER NOT NULL,
+            stored_at REAL NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_http_cache_accessed ON http_cache (accessed_at);
+    """
+    
+    EVICT_INTERVAL = 10
+    
+    # Parte della chiave del parsing: da cambiare quando cambia l'output dei parser
+    PARSE_VERSION = 2
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.index = SharedSQLiteStore(os.path.join(path, 'index.db'), self.SCHEMA)
+        self.stats = Counter()
+        self.last_evict = 0
+    
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode()).hexdigest()
+    
+    def file_path(self, key, kind):
+        return os.path.join(self.path, key[:2], f"{key}.{kind}.gz")
+    
+    @staticmethod
+    def parse_key(*parts):
+        """Chiave del parsing (selector plan e opzioni): i prodotti salvati valgono solo per la stessa"""
+        return hashlib.sha1(
+            json.dumps([HttpResponseCache.PARSE_VERSION, *parts], sort_keys=True, default=str).encode()
+        ).hexdigest()
+    
+    def lookup(self, url):
+        """Voce in cache per l'URL (con validatori) o None"""
+        key = self.key(url)
+        try:
+            row = self.index.execute(
+                'SELECT etag, last_modified, encoding, parse_key FROM http_cache WHERE key = ?', (key,)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        
+        if not row or not os.path.exists(self.file_path(key, 'body')):
+            return None
+        
+        return {'key': key, 'url': url, 'etag': row[0], 'last_modified': row[1], 'encoding': row[2], 'parse_key': row[3]}
+    
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+    
+    def hit(self, entry):
+        """Risposta 304: aggiorna l'accesso (LRU)"""
+        self.stats['revalidated'] += 1
+        try:
+            self.index.execute('UPDATE http_cache SET accessed_at = ? WHERE key = ?', (time.time(), entry['key']))
+        except sqlite3.Error:
+            pass
+    
+    def read_body(self, entry):
+        with gzip.open(self.file_path(entry['key'], 'body'), 'rb') as f:
+            return f.read()
+    
+    def iter_body(self, entry, chunk_size=64 * 1024):
+        with gzip.open(self.file_path(entry['key'], 'body'), 'rb') as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+    
+    def open_writer(self, url, headers, encoding=None):
+        """Writer per il corpo se la risposta ha validatori, altrimenti None"""
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return None
+        
+        try:
+            return HttpCacheWriter(self, url, etag, last_modified, encoding)
+        except OSError as e:
+            logger.debug(f"HTTP cache write failed: {e}")
+            return None
+    
+    def store(self, url, headers, content, encoding=None):
+        """Salva un corpo completo (se la risposta ha validatori): voce di cache o None"""
+        writer = self.open_writer(url, headers, encoding)
+        if writer is None:
+            return None
+        
+        try:
+            writer.write(content)
+            return writer.commit()
+        except (OSError, sqlite3.Error) as e:
+            writer.discard()
+            logger.debug(f"HTTP cache write failed: {e}")
+            return None
+    
+    def index_body(self, writer):
+        """Nuovo corpo: i prodotti estratti dal precedente non valgono più"""
+        try:
+            os.remove(self.file_path(writer.key, 'parsed'))
+        except OSError:
+            pass
+        
+        now = time.time()
+        self.index.execute(
+            'INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, NULL, ?, ?, ?)',
+            (writer.key, writer.url, writer.etag, writer.last_modified, writer.encoding,
+             os.path.getsize(writer.path), now, now)
+        )
+        self.stats['stored'] += 1
+        self._maybe_evict()
+        
+        return {'key': writer.key, 'url': writer.url, 'etag': writer.etag,
+                'last_modified': writer.last_modified, 'encoding': writer.encoding, 'parse_key': None}
+    
+    def store_parsed(self, entry, parse_key, payload):
+        """Salva i prodotti estratti dal corpo in cache"""
+        key = entry['key']
+        path = self.file_path(key, 'parsed')
+        
+        try:
+            with gzip.open(path, 'wt', encoding='utf-8', compresslevel=3) as f:
+                json.dump(payload, f, ensure_ascii=False, default=str)
+            self.index.execute(
+                'UPDATE http_cache SET parse_key = ?, size = ? WHERE key = ?',
+                (parse_key, os.path.getsize(self.file_path(key, 'body')) + os.path.getsize(path), key)
+            )
+            entry['parse_key'] = parse_key
+        except (OSError, sqlite3.Error) as e:
+            logger.debug(f"HTTP cache parsed write failed: {e}")
+    
+    def load_parsed(self, entry, parse_key):
+        """Prodotti estratti in precedenza (stessa chiave di parsing) o None"""
+        if entry.get('parse_key') != parse_key:
+            return None
+        
+        try:
+            with gzip.open(self.file_path(entry['key'], 'parsed'), 'rt', encoding='utf-8') as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return None
+        
+        self.stats['parse_reused'] += 1
+        return payload
+    
+    def _maybe_evict(self):
+        """Elimina le voci meno usate di recente oltre max_bytes"""
+        now = time.time()
+        if now - self.last_evict < self.EVICT_INTERVAL:
+            return
+        self.last_evict = now
+        
+        total = self.index.execute('SELECT COALESCE(SUM(size), 0) FROM http_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        rows = self.index.execute('SELECT key, size FROM http_cache ORDER BY accessed_at').fetchall()
+        
+        for key, size in rows:
+            if freed >= target:
+                break
+            for kind in ('body', 'parsed'):
+                try:
+                    os.remove(self.file_path(key, kind))
+                except OSError:
+                    pass
+            self.index.execute('DELETE FROM http_cache WHERE key = ?', (key,))
+            freed += size
+            self.stats['evicted'] += 1
+    
+    def info(self):
+        return dict(self.stats)
+
+http_response_cache = HttpResponseCache(
+    os.path.join(OmniSystemConfig.CACHE_PATH, 'http'),
+    OmniSystemConfig.HTTP_CACHE_MAX_BYTES
+) if OmniSystemConfig.HTTP_CACHE_ENABLED else None
+
+class ExportFileCache:
+    """
+    Export Excel indirizzati per contenuto: digest di prodotti normalizzati,
+    tipo portale, feature del piano e versione del generatore -> file già
+    presente in EXPORT_PATH. Retention LRU (mtime, aggiornato a ogni hit e
+    download) con tetto in byte su tutta la cartella, export delta compresi
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS export_cache (
+            digest TEXT PRIMARY KEY,
+            filename TEXT NOT NULL,
+            result TEXT NOT NULL,
+            expires_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_export_cache_filename ON export_cache (filename);
+    """
+    
+    EVICT_INTERVAL = 10
+    EVICT_MIN_AGE = 60  # file più recenti possono essere ancora in scrittura o in download
+    
+    def __init__(self, export_path, db_path, max_bytes):
+        self.export_path = export_path
+        self.max_bytes = max_bytes
+        self.index = SharedSQLiteStore(db_path, self.SCHEMA)
+        self.stats = Counter()
+        self.last_evict = 0
+    
+    def digest(self, products, *parts):
+        """sha256 di parts e dei prodotti normalizzati (JSON a chiavi ordinate, uno per riga)"""
+        digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode())
+        for product in products:
+            digest.update(json.dumps(
+                product, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str
+            ).encode())
+            digest.update(b'\n')
+        return digest.hexdigest()
+    
+    def lookup(self, digest):
+        """Risultato dell'export già generato (come da generate_omnisystem_excel) o None"""
+        row = self.index.execute(
+            'SELECT filename, result, expires_at FROM export_cache WHERE digest = ?', (digest,)
+        ).fetchone()
+        
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        
+        filename, result, expires_at = row
+        filepath = os.path.join(self.export_path, filename)
+        
+        if (expires_at and expires_at < time.time()) or not self.touch(filename):
+            self.index.execute('DELETE FROM export_cache WHERE digest = ?', (digest,))
+            self.stats['misses'] += 1
+            return None
+        
+        self.stats['hits'] += 1
+        result = json.loads(result)
+        result.update(filepath=filepath, file_size=os.path.getsize(filepath), cached=True)
+        return result
+    
+    def store(self, digest, result, ttl=None):
+        """Indicizza l'export appena generato (ttl: per export con dati che scadono, es. AI)"""
+        self.index.execute(
+            'INSERT OR REPLACE INTO export_cache (digest, filename, result, expires_at) VALUES (?, ?, ?, ?)',
+            (
+                digest, result['filename'],
+                json.dumps({k: v for k, v in result.items() if k != 'filepath'}, default=str),
+                time.time() + ttl if ttl else None
+            )
+        )
+        self.stats['stored'] += 1
+        self.maybe_evict()
+    
+    def touch(self, filename):
+        """Segna il file come usato ora (False se non esiste più)"""
+        try:
+            os.utime(os.path.join(self.export_path, filename))
+            return True
+        except OSError:
+            return False
+    
+    def maybe_evict(self):
+        """LRU su EXPORT_PATH: oltre max_bytes rimuove i file meno usati fino al 90%"""
+        now = time.time()
+        if now - self.last_evict < self.EVICT_INTERVAL:
+            return
+        self.last_evict = now
+        
+        files = []
+        with os.scandir(self.export_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.name))
+        
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        
+        for mtime, size, name in sorted(files):
+            if freed >= target or now - mtime < self.EVICT_MIN_AGE:
+                break
+            try:
+                os.remove(os.path.join(self.export_path, name))
+            except OSError:
+                continue
+            self.index.execute('DELETE FROM export_cache WHERE filename = ?', (name,))
+            freed += size
+            self.stats['evicted'] += 1
+    
+    def info(self):
+        return dict(self.stats)
+
+export_file_cache = ExportFileCache(
+    OmniSystemConfig.EXPORT_PATH,
+    OmniSystemConfig.EXPORT_CACHE_DB_PATH,
+    OmniSystemConfig.EXPORT_CACHE_MAX_BYTES
+) if OmniSystemConfig.EXPORT_CACHE_ENABLED else None
+
+domain_strategy_memory = DomainStrategyMemory(
+    OmniSystemConfig.STRATEGY_DB_PATH,
+    negative_ttl=OmniSystemConfig.PROBE_NEGATIVE_TTL,
+    positive_ttl=OmniSystemConfig.STRATEGY_TTL
+)
+
 # ==========================================
 #  AI COMPETITOR INTELLIGENCE ENHANCED
 # ==========================================
@@ -891,8 +1794,8 @@ class EnhancedCompetitorIntelligenceAI:
     
     def __init__(self):
         self.scraper = None
-        self.cache = {}
-        self.cache_duration = 3600
+        self.cache = market_analysis_cache
+        self.cache_duration = self.cache.ttl
         self.total_competitors = len(OmniSystemConfig.COMPETITOR_SITES)
         logger.info(f"AI Competitor Intelligence initialized with {self.total_competitors} competitors")
     
@@ -900,14 +1803,13 @@ class EnhancedCompetitorIntelligenceAI:
         """
         Analisi AI estesa con 30+ competitor
         """
-        cache_key = f"{product_name}_{brand}_{category}"
+        cache_key = '|'.join(self.analysis_key(product_name, brand, category))
         
         # Check cache
-        if cache_key in self.cache:
-            cached_data, timestamp = self.cache[cache_key]
-            if time.time() - timestamp < self.cache_duration:
-                logger.info(f"Using cached analysis for {product_name}")
-                return cached_data
+        cached_data = self.cache.get(cache_key)
+        if cached_data is not None:
+            logger.debug(f"Using cached analysis for {product_name}")
+            return cached_data
         
         logger.info(f" AI Enhanced Market Analysis starting for: {product_name}")
         
@@ -988,7 +1890,7 @@ class EnhancedCompetitorIntelligenceAI:
                 logger.warning(f"No valid prices found for {product_name}")
             
             # Cache results
-            self.cache[cache_key] = (market_data, time.time())
+            self.cache.set(cache_key, market_data)
             
             return market_data
             
@@ -996,6 +1898,51 @@ class EnhancedCompetitorIntelligenceAI:
             logger.error(f"Enhanced market analysis failed: {e}")
             return market_data
     
+    def analysis_key(self, product_name, brand=None, category=None):
+        """Chiave di dedup: keywords del nome + brand + categoria"""
+        keywords = ' '.join(self._extract_enhanced_keywords(product_name or ''))
+        return (keywords, (brand or '').strip().upper(), (category or '').strip().upper())
+    
+    async def analyze_market_batch(self, products, concurrency=None):
+        """
+        Analisi di un'intera lista prodotti: i prodotti con la stessa chiave
+        (keywords nome, brand, categoria) condividono una sola analisi e le
+        analisi uniche girano con concorrenza limitata.
+        Ritorna una lista allineata a products
+        """
+        concurrency = concurrency or OmniSystemConfig.AI_BATCH_CONCURRENCY
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        # Raggruppa per chiave, il primo prodotto rappresenta il gruppo
+        groups = {}
+        row_keys = []
+        for product in products:
+            key = self.analysis_key(product.get('name'), product.get('brand'), product.get('category', 'PRODUCT'))
+            groups.setdefault(key, product)
+            row_keys.append(key)
+        
+        async def analyze(product):
+            async with semaphore:
+                return await self.analyze_market_enhanced(
+                    product.get('name', 'Product'),
+                    product.get('brand'),
+                    product.get('category', 'PRODUCT')
+                )
+        
+        keys = list(groups)
+        results = await asyncio.gather(*(analyze(groups[key]) for key in keys), return_exceptions=True)
+        
+        analyses = {}
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Batch analysis failed for {key}: {result}")
+                result = None
+            analyses[key] = result
+        
+        logger.info(f"Batch AI analysis: {len(products)} products, {len(keys)} unique analyses")
+        
+        return [analyses[key] for key in row_keys]
+    
     async def _analyze_single_competitor_enhanced(self, competitor_name, base_url, product_name, brand, category):
         """
         Analizza singolo competitor con pattern di ricerca specifici
@@ -1277,63 +2224,1681 @@ class EnhancedCompetitorIntelligenceAI:
         return round(min(final_confidence, 98), 1)
 
 # ==========================================
-#  MASTER EXTRACTOR ENGINE COMPLETO
+#  PRODUCT TEXT CLASSIFICATION
 # ==========================================
 
-class MasterOmniExtractor:
+class KeywordMatcher:
     """
-    Sistema di estrazione definitivo omnisystem che gestisce:
-    - Siti pubblici con 200+ identity rotation
-    - Portali B2B autenticati
-    - Estrazione massiva parallela fino a 50.000+ prodotti
-    - Recovery intelligente
-    - Supporto universale (fashion, mobili, tech, etc.)
+    Uno o più vocabolari (etichetta, parole chiave; etichette in ordine di
+    priorità) compilati in un'unica regex a trie e letti con una sola
+    scansione. Il lookahead trova le occorrenze in ogni posizione (anche
+    sovrapposte) e il trie sceglie la parola più lunga: le più corte nella
+    stessa posizione sono suoi prefissi, quindi ogni parola porta già il
+    rango minimo dei suoi prefissi. Il risultato è quello dei controlli in
+    sottostringa etichetta per etichetta
     """
     
-    def __init__(self):
-        self.site_manager = IntelligentSiteProfileManager()
-        self.identity_system = AdvancedIdentitySystem()
-        self.sessions = []
-        self.browsers = []
-        self.stats = defaultdict(int)
-        self.scraper = cloudscraper.create_scraper()
+    MISSING = 1 << 30
+    MAX_COMBINATIONS = 10000
     
-    async def extract_omnisystem(self, url, target=10000, user=None):
-        """
-        Estrazione master omnisystem che rileva automaticamente il tipo
-        """
-        
-        self.stats['start_time'] = datetime.now()
-        profile = self.site_manager.get_profile(url)
-        
-        # Determina limite basato su utente
-        if user:
-            plan_limits = user.get_plan_limits()
-            max_products = min(target, plan_limits['products'])
-        else:
-            max_products = min(target, 15)  # Trial limit
-        
-        logger.info(f"""
-         OMNISYSTEM EXTRACTION STARTED
-        ╔══════════════════════════════════════════════╗
-         URL: {url}
-         Type: {profile.get('type', 'unknown')}
-         Target: {max_products} products
-         Strategy: {profile.get('strategy', 'adaptive')}
-         User: {user.email if user else 'Anonymous'}
-        ╚══════════════════════════════════════════════╝
-        """)
-        
-        # Rileva tipo e usa strategia appropriata
-        if profile.get('type') == 'b2b_portal':
-            products = await self._extract_b2b_portal(url, max_products, profile)
-        elif profile.get('type') == 'furniture':
-            products = await self._extract_furniture_site(url, max_products, profile)
-        else:
-            products = await self._extract_public_site(url, max_products, profile)
-        
-        # Post-processing
-        final_products = self._process_and_deduplicate(products)
+    def __init__(self, vocabularies):
+        self.labels = [[label for label, _ in vocabulary] for vocabulary, _ in vocabularies]
+        self.defaults = [default for _, default in vocabularies]
+        
+        own = {}
+        for index, (vocabulary, _) in enumerate(vocabularies):
+            for rank, (_, keywords) in enumerate(vocabulary):
+                for keyword in keywords:
+                    ranks = own.setdefault(keyword, [self.MISSING] * len(vocabularies))
+                    ranks[index] = min(ranks[index], rank)
+        
+        keywords = sorted(own, key=len, reverse=True)
+        self.ranks = {
+            keyword: tuple(min(column) for column in zip(*(own[k] for k in keywords if keyword.startswith(k))))
+            for keyword in keywords
+        }
+        self.empty = (self.MISSING,) * len(vocabularies)
+        self.resolved = {}  # parole trovate -> etichette
+        self.pattern = re.compile(f"(?=({self._trie_pattern(keywords)}))")
+    
+    @classmethod
+    def _trie_pattern(cls, keywords):
+        """Alternanza a trie: un carattere per ramo, continuazione più lunga prima della fine parola"""
+        trie = {}
+        for keyword in keywords:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        return cls._node_pattern(trie)
+    
+    @classmethod
+    def _node_pattern(cls, node):
+        branches = [re.escape(char) + cls._node_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        if '' in node:
+            pattern = f"(?:{pattern})?"
+        return pattern
+    
+    def match(self, text):
+        """Etichetta (o default) per ogni vocabolario"""
+        found = tuple(self.pattern.findall(text))
+        labels = self.resolved.get(found)
+        if labels is None:
+            if len(self.resolved) >= self.MAX_COMBINATIONS:
+                self.resolved.clear()
+            labels = self.resolved[found] = self._resolve(found)
+        return labels
+    
+    def _resolve(self, found):
+        best = self.empty
+        for keyword in found:
+            best = tuple(map(min, best, self.ranks[keyword]))
+        
+        return tuple(
+            default if rank == self.MISSING else labels[rank]
+            for rank, labels, default in zip(best, self.labels, self.defaults)
+        )
+
+ProductTraits = namedtuple('ProductTraits', ['category', 'furniture_category', 'gender', 'color'])
+
+class ProductTextClassifier:
+    """
+    Classificazione dei nomi prodotto (categoria, categoria mobili, gender,
+    colore) e mappa categoria -> taglie. I vocabolari sono compilati una
+    volta e i risultati messi in cache per nome normalizzato
+    """
+    
+    CATEGORY_KEYWORDS = [
+        ('BORSE', ['bag', 'borsa', 'clutch', 'tote', 'backpack']),
+        ('SCARPE', ['shoe', 'sneaker', 'boot', 'sandal', 'pump', 'loafer']),
+        ('ABBIGLIAMENTO', ['dress', 'shirt', 'jacket', 'coat', 'pants', 'skirt']),
+        ('ACCESSORI', ['belt', 'wallet', 'scarf', 'hat', 'sunglasses']),
+        ('GIOIELLI', ['ring', 'necklace', 'bracelet', 'earring', 'watch']),
+        ('MOBILI', ['chair', 'table', 'sofa', 'desk', 'bed', 'wardrobe']),
+        ('ILLUMINAZIONE', ['lamp', 'light', 'chandelier', 'lampada'])
+    ]
+    
+    FURNITURE_KEYWORDS = [
+        ('DIVANI', ['sofa', 'divano', 'couch', 'settee']),
+        ('TAVOLI', ['table', 'tavolo', 'desk', 'scrivania']),
+        ('SEDIE', ['chair', 'sedia', 'stool', 'sgabello']),
+        ('LETTI', ['bed', 'letto', 'mattress', 'materasso']),
+        ('ARMADI', ['wardrobe', 'armadio', 'closet', 'guardaroba']),
+        ('LIBRERIE', ['bookcase', 'libreria', 'shelf', 'scaffale']),
+        ('ILLUMINAZIONE', ['lamp', 'lampada', 'light', 'chandelier'])
+    ]
+    
+    GENDER_KEYWORDS = [
+        ('F', ['women', 'donna', 'lady', 'female']),
+        ('M', ['men', 'uomo', 'man', 'male'])
+    ]
+    
+    COLOR_KEYWORDS = [
+        ('NERO', ['black']), ('BIANCO', ['white']), ('ROSSO', ['red']),
+        ('BLU', ['blue']), ('VERDE', ['green']), ('MARRONE', ['brown']),
+        ('GRIGIO', ['grey', 'gray']), ('BEIGE', ['beige']),
+        ('ROSA', ['pink']), ('GIALLO', ['yellow']), ('ARANCIONE', ['orange']),
+        ('VIOLA', ['purple']), ('ORO', ['gold']), ('ARGENTO', ['silver'])
+    ]
+    
+    # Categorie non coperte da SIZE_MAPPING (in ordine)
+    SIZE_FALLBACK = [
+        ('SCARPE', ['SCARPE', 'SHOE']),
+        ('BORSE', ['BORSE', 'BAG']),
+        ('COMPLEMENTI', ['MOBILI', 'FURNITURE'])
+    ]
+    
+    def __init__(self, cache_size=50000):
+        # Ordine dei vocabolari = ordine dei campi di ProductTraits
+        self.matcher = KeywordMatcher([
+            (self.CATEGORY_KEYWORDS, 'LUXURY ITEM'),
+            (self.FURNITURE_KEYWORDS, 'ARREDAMENTO'),
+            (self.GENDER_KEYWORDS, 'Unisex'),
+            (self.COLOR_KEYWORDS, 'MULTICOLOR')
+        ])
+        
+        # SIZE_MAPPING (stessa priorità del dict), poi le regole di default
+        self.size_matcher = KeywordMatcher([
+            ([(size_key, [cat_key]) for cat_key, size_key in OmniSystemConfig.SIZE_MAPPING.items()], None),
+            (self.SIZE_FALLBACK, 'ABBIGLIAMENTO')
+        ])
+        self.sizes_cache = {}
+        
+        # Cache sul nome così com'è (niente normalizzazione sui nomi già visti) e sul nome normalizzato
+        self._classify = lru_cache(maxsize=cache_size)(self._classify_raw)
+        self._classify_text = lru_cache(maxsize=cache_size)(self._classify_normalized)
+    
+    @staticmethod
+    def normalize(name):
+        # Le parole chiave non contengono spazi: compattarli non cambia i risultati
+        return ' '.join((name or '').lower().split())
+    
+    def classify(self, name):
+        """ProductTraits del nome (in cache per nome normalizzato)"""
+        return self._classify(name)
+    
+    def classify_many(self, names):
+        """ProductTraits per un blocco di nomi: ogni nome distinto è classificato una volta"""
+        results = {}
+        for name in names:
+            if name not in results:
+                results[name] = self.classify(name)
+        return results
+    
+    def _classify_raw(self, name):
+        return self._classify_text(self.normalize(name))
+    
+    def _classify_normalized(self, text):
+        return ProductTraits(*self.matcher.match(text))
+    
+    def sizes_for_category(self, category):
+        """Taglie per categoria (SIZE_MAPPING, poi le regole di default)"""
+        sizes = self.sizes_cache.get(category)
+        if sizes is None:
+            size_key, fallback = self.size_matcher.match((category or '').upper())
+            if size_key is not None:
+                sizes = OmniSystemConfig.ALL_SIZES.get(size_key, ['UNI'])
+            else:
+                sizes = OmniSystemConfig.ALL_SIZES[fallback]
+            self.sizes_cache[category] = sizes
+        return sizes
+
+product_classifier = ProductTextClassifier()
+
+# ==========================================
+#  HTML PRODUCT PARSER (SELECTOR PLANS)
+# ==========================================
+
+class CompiledSelector:
+    """
+    Selettore CSS compilato una volta. I selettori composti semplici
+    (tag, .classe, [attr], [attr=v], [attr*=v], [attr^=v], [attr$=v] e
+    liste separate da virgola) diventano predicati Python diretti; quelli
+    con combinatori passano da soupsieve
+    """
+    
+    TAG_RE = re.compile(r'[a-zA-Z][\w-]*|\*')
+    PART_RE = re.compile(
+        r"""\.([\w-]+)"""
+        r"""|\[\s*([\w:-]+)\s*(?:([*^$]?=)\s*(?:"([^"]*)"|'([^']*)'|([\w-]+))\s*)?\]"""
+    )
+    
+    def __init__(self, selector):
+        self.selector = selector
+        self.soupsieve = sv.compile(selector)
+        
+        compounds = [part.strip() for part in selector.split(',')]
+        predicates = [self._compile_compound(compound) for compound in compounds]
+        self.predicates = predicates if all(predicates) else None
+        
+        # Prefiltro economico: tag richiesti e attributi di cui serve almeno uno
+        self.tag_names = None
+        self.attr_keys = None
+        if self.predicates is not None:
+            tags = [self._required_tag(compound) for compound in compounds]
+            keys = [self._required_attr(compound) for compound in compounds]
+            self.tag_names = frozenset(tags) if all(tags) else None
+            self.attr_keys = frozenset(keys) if all(keys) else None
+    
+    def _compile_compound(self, compound):
+        """Predicato per un selettore composto semplice (None se non supportato)"""
+        pos = 0
+        tag_name = None
+        classes = []
+        attr_checks = []
+        
+        tag_match = self.TAG_RE.match(compound)
+        if tag_match:
+            tag_name = None if tag_match.group() == '*' else tag_match.group().lower()
+            pos = tag_match.end()
+        
+        while pos < len(compound):
+            part = self.PART_RE.match(compound, pos)
+            if not part:
+                return None
+            
+            if part.group(1):
+                classes.append(part.group(1))
+            else:
+                value = next((v for v in part.group(4, 5, 6) if v is not None), None)
+                attr_checks.append((part.group(2).lower(), part.group(3), value))
+            pos = part.end()
+        
+        if not (tag_name or classes or attr_checks):
+            return None
+        
+        def match(tag):
+            if tag_name and tag.name != tag_name:
+                return False
+            
+            attrs = tag.attrs
+            for cls in classes:
+                value = attrs.get('class')
+                if not value or cls not in (value if isinstance(value, list) else value.split()):
+                    return False
+            
+            for name, op, expected in attr_checks:
+                value = attrs.get(name)
+                if value is None:
+                    return False
+                if op is None:
+                    continue
+                if isinstance(value, list):
+                    value = ' '.join(value)
+                if op == '=':
+                    if value != expected:
+                        return False
+                elif not expected:
+                    return False
+                elif op == '*=':
+                    if expected not in value:
+                        return False
+                elif op == '^=':
+                    if not value.startswith(expected):
+                        return False
+                elif not value.endswith(expected):
+                    return False
+            
+            return True
+        
+        return match
+    
+    def _required_tag(self, compound):
+        tag_match = self.TAG_RE.match(compound)
+        if tag_match and tag_match.group() != '*':
+            return tag_match.group().lower()
+        return None
+    
+    def _required_attr(self, compound):
+        part = self.PART_RE.search(compound)
+        if not part:
+            return None
+        return 'class' if part.group(1) else part.group(2).lower()
+    
+    def may_match(self, tag):
+        """False se il tag non può matchare (controllo rapido prima di match)"""
+        if self.tag_names is not None and tag.name not in self.tag_names:
+            return False
+        if self.attr_keys is not None and self.attr_keys.isdisjoint(tag.attrs):
+            return False
+        return True
+    
+    def match(self, tag):
+        if self.predicates is None:
+            return self.soupsieve.match(tag)
+        return any(predicate(tag) for predicate in self.predicates)
+    
+    def select(self, root, limit=0):
+        """Discendenti che matchano, in ordine di documento"""
+        if self.predicates is None:
+            return self.soupsieve.select(root, limit=limit)
+        
+        results = []
+        match = self.match
+        for node in root.descendants:
+            if isinstance(node, Tag) and match(node):
+                results.append(node)
+                if len(results) == limit:
+                    break
+        return results
+    
+    def select_one(self, root):
+        if self.predicates is None:
+            return self.soupsieve.select_one(root)
+        
+        match = self.match
+        for node in root.descendants:
+            if isinstance(node, Tag) and match(node):
+                return node
+        return None
+
+class ProductHtmlParser:
+    """
+    Parsing prodotti da HTML con selettori compilati una sola volta:
+    i selettori card di ogni profilo vengono compilati e messi
+    in cache per profilo, i selettori dei campi sono compilati all'avvio.
+    Usa lxml come parser quando disponibile
+    """
+    
+    NAME_SELECTORS = [
+        '[itemprop="name"]', 'h1', 'h2', 'h3', 'h4',
+        '.product-name', '.title', 'a[href*="/product"]',
+        '.pip-header-section__title'  # IKEA
+    ]
+    
+    PRICE_SELECTORS = [
+        '[itemprop="price"]', '.price', '[data-price]',
+        'span[class*="price"]', '.cost',
+        '.pip-price__integer'  # IKEA
+    ]
+    
+    BRAND_SELECTORS = [
+        '[itemprop="brand"]', '.brand', '.designer',
+        '[data-brand]'
+    ]
+    
+    LINK_SELECTOR = 'a[href*="/product"], a[href*="/item"]'
+    
+    FURNITURE_NAME_SELECTORS = [
+        '.pip-header-section__title',  # IKEA
+        'h3', 'h2', 'h4',
+        '[class*="product-name"]',
+        '[class*="product-title"]'
+    ]
+    
+    FURNITURE_PRICE_SELECTORS = [
+        '.pip-price__integer',  # IKEA
+        '[class*="price"]',
+        '.price'
+    ]
+    
+    JSON_LD_RE = re.compile(
+        r'<script[^>]+type\s*=\s*["\']application/ld\+json["\'][^>]*>(.*?)</script>', re.I | re.S
+    )
+    NEXT_DATA_RE = re.compile(r'<script[^>]+id\s*=\s*["\']__NEXT_DATA__["\'][^>]*>(.*?)</script>', re.I | re.S)
+    PRODUCT_TYPES = {'product', 'productgroup', 'productmodel', 'individualproduct'}
+    STATE_PRICE_KEYS = ('price', 'salePrice', 'finalPrice', 'currentPrice', 'priceRange')
+    STRUCTURED_MAX_DEPTH = 12
+    
+    TOTAL_PAGES_RE = re.compile(r'"(?:totalPages|total_pages|pageCount|numberOfPages)"\s*:\s*(\d{1,5})\b')
+    TOTAL_JSON_RE = re.compile(
+        r'"(?:totalResults|totalCount|total_count|totalItems|numberOfItems|nbHits)"\s*:\s*(\d{1,7})\b'
+    )
+    TOTAL_RESULTS_RE = re.compile(
+        r'(\d{1,3}(?:[.,]\d{3})+|\d{1,7})\s*(?:prodotti|products|risultati|results|articoli|items|articles)\b',
+        re.I
+    )
+    
+    def __init__(self, parser=None):
+        self.parser = parser or OmniSystemConfig.HTML_PARSER
+        self.plans = {}
+        self.lock = threading.Lock()
+        
+        self.name_plan = self._compile(self.NAME_SELECTORS)
+        self.price_plan = self._compile(self.PRICE_SELECTORS)
+        self.brand_plan = self._compile(self.BRAND_SELECTORS)
+        self.link_matcher = CompiledSelector(self.LINK_SELECTOR)
+        self.img_matcher = CompiledSelector('img')
+        self.microdata_matcher = CompiledSelector('[itemscope][itemtype*="schema.org/Product"]')
+        self.furniture_name_plan = self._compile(self.FURNITURE_NAME_SELECTORS)
+        self.furniture_price_plan = self._compile(self.FURNITURE_PRICE_SELECTORS)
+    
+    def _compile(self, selectors):
+        """Compila una lista di selettori CSS, scartando quelli non validi"""
+        compiled = []
+        for selector in selectors:
+            try:
+                compiled.append((selector, CompiledSelector(selector)))
+            except Exception as e:
+                logger.warning(f"Invalid selector skipped: {selector} ({e})")
+        return compiled
+    
+    def get_plan(self, selectors):
+        """Selector plan compilato per i selettori card di un profilo (in cache)"""
+        key = tuple(selectors)
+        plan = self.plans.get(key)
+        
+        if plan is None:
+            with self.lock:
+                plan = self.plans.get(key)
+                if plan is None:
+                    plan = self._compile(selectors)
+                    self.plans[key] = plan
+        
+        return plan
+    
+    def parse_pagination(self, html, page_size):
+        """
+        Ultima pagina dalla prima pagina, solo da un totale esplicito:
+        totale pagine o totale risultati (testo o stato JSON). None se non
+        nota. I link page=N no: pager a finestra o solo "Next" darebbero
+        un limite troppo basso, la fine la segna la prima pagina vuota
+        """
+        candidates = [int(n) for n in self.TOTAL_PAGES_RE.findall(html)]
+        
+        if page_size:
+            totals = [int(re.sub(r'\D', '', n)) for n in self.TOTAL_RESULTS_RE.findall(html)]
+            totals.extend(int(n) for n in self.TOTAL_JSON_RE.findall(html))
+            # Totali minori di una pagina sono rumore (es. "2 items" nel carrello)
+            candidates.extend(-(-total // page_size) for total in totals if total >= page_size)
+        
+        if not candidates:
+            return None
+        return max(max(candidates), 1)
+    
+    def make_soup(self, html):
+        return BeautifulSoup(html, self.parser)
+    
+    def parse_listing(self, html, selectors, limit=100, fallback=None, field_order=None, stats=None):
+        """
+        Parse prodotti da pagina listing: prima i dati strutturati
+        (JSON-LD, __NEXT_DATA__, microdata), poi il primo selettore card
+        che produce risultati (selectors, poi fallback: selettori potati).
+        Se stats è dato, registra selettore card vincente, selettori
+        provati a vuoto e selettori vincenti per campo
+        """
+        if stats is None:
+            stats = {}
+        stats.update({'card': None, 'misses': [], 'fields': {}})
+        
+        products = self.parse_structured(html, limit)
+        if products:
+            stats['card'] = 'structured'
+            return products
+        
+        soup = self.make_soup(html)
+        products = self.parse_microdata(soup, limit)
+        if products:
+            stats['card'] = 'microdata'
+            return products
+        
+        plans = self.field_plans(field_order)
+        
+        for selector, matcher in self.get_plan(list(selectors) + list(fallback or [])):
+            elements = matcher.select(soup, limit=limit)
+            
+            for element in elements:
+                product = self.extract_card(element, plans, stats['fields'])
+                if product:
+                    products.append(product)
+            
+            if products:
+                stats['card'] = selector
+                break
+            stats['misses'].append(selector)
+        
+        return products
+    
+    def parse_detail(self, html, url=None):
+        """
+        Prodotto da pagina dettaglio: dati strutturati, microdata, poi i
+        selettori card applicati all'intera pagina
+        """
+        products = self.parse_structured(html, limit=1)
+        
+        if not products:
+            soup = self.make_soup(html)
+            products = self.parse_microdata(soup, limit=1)
+            if not products:
+                product = self.extract_card(soup.body or soup)
+                products = [product] if product else []
+        
+        if not products:
+            return None
+        
+        product = products[0]
+        if url:
+            product['url'] = url
+        return product
+    
+    def parse_furniture(self, html, selectors, target):
+        """Parse prodotti da pagina di un sito mobili"""
+        products = []
+        soup = self.make_soup(html)
+        
+        for selector, matcher in self.get_plan(selectors):
+            elements = matcher.select(soup, limit=target) if target > 0 else []
+            
+            for elem in elements:
+                product = self.extract_furniture_card(elem)
+                if product:
+                    products.append(product)
+            
+            if products:
+                break
+        
+        return products
+    
+    # ---- Dati strutturati ----
+    
+    def parse_structured(self, html, limit=100):
+        """Prodotti da blocchi JSON-LD o, in mancanza, dallo stato __NEXT_DATA__"""
+        items = []
+        
+        for block in self.JSON_LD_RE.findall(html):
+            data = self._load_json(block)
+            if data is not None:
+                self._collect_json_ld(data, items, limit)
+        
+        if not items:
+            match = self.NEXT_DATA_RE.search(html)
+            if match:
+                data = self._load_json(match.group(1))
+                if data is not None:
+                    self._collect_state(data, items, limit)
+        
+        return self._finalize_structured(items[:limit])
+    
+    def parse_microdata(self, soup, limit=100):
+        """Prodotti da markup microdata schema.org/Product"""
+        items = []
+        
+        for scope in self.microdata_matcher.select(soup, limit=limit):
+            props = {}
+            self._read_microdata(scope, props)
+            items.append({
+                'name': props.get('name'),
+                'price': props.get('price') or props.get('lowPrice'),
+                'brand': props.get('brand'),
+                'sku': props.get('sku') or props.get('mpn') or props.get('productID'),
+                'image': props.get('image'),
+                'url': props.get('url'),
+                'currency': props.get('priceCurrency'),
+                'availability': props.get('availability')
+            })
+        
+        return self._finalize_structured(items)
+    
+    def normalize_products(self, items):
+        """Normalizza prodotti da API o dati strutturati nella forma comune"""
+        normalized = []
+        
+        for item in items:
+            if isinstance(item, dict):
+                product = {
+                    'name': item.get('name') or item.get('title'),
+                    'price': item.get('price') or item.get('cost'),
+                    'brand': item.get('brand') or item.get('manufacturer'),
+                    'sku': item.get('sku') or item.get('id'),
+                    'image_url': item.get('image') or item.get('image_url'),
+                    'url': item.get('url') or item.get('link'),
+                    'category': item.get('category', 'PRODUCT')
+                }
+                
+                # Campi extra solo se presenti nella sorgente
+                currency = item.get('currency') or item.get('priceCurrency')
+                if currency:
+                    product['currency'] = currency
+                if item.get('availability'):
+                    product['availability'] = item['availability']
+                
+                if product['name']:
+                    normalized.append(product)
+        
+        return normalized
+    
+    @staticmethod
+    def _load_json(text):
+        text = text.strip()
+        if text.startswith('<!--'):
+            text = text[4:].rsplit('-->', 1)[0]
+        try:
+            return json_loads(text)
+        except ValueError:
+            return None
+    
+    def _collect_json_ld(self, data, items, limit, depth=0):
+        """Raccoglie nodi Product da JSON-LD (liste, @graph, ItemList, mainEntity)"""
+        if depth > self.STRUCTURED_MAX_DEPTH or len(items) >= limit:
+            return
+        
+        if isinstance(data, list):
+            for node in data:
+                self._collect_json_ld(node, items, limit, depth + 1)
+            return
+        
+        if not isinstance(data, dict):
+            return
+        
+        types = data.get('@type')
+        types = {t.lower() for t in (types if isinstance(types, list) else [types]) if isinstance(t, str)}
+        
+        if types & self.PRODUCT_TYPES:
+            items.append(self._from_json_ld(data))
+            return
+        
+        for key in ('@graph', 'mainEntity'):
+            if key in data:
+                self._collect_json_ld(data[key], items, limit, depth + 1)
+        
+        if 'itemlist' in types:
+            for element in data.get('itemListElement') or []:
+                if isinstance(element, dict):
+                    self._collect_json_ld(element.get('item', element), items, limit, depth + 1)
+    
+    def _from_json_ld(self, node):
+        offer = self._first(node.get('offers'))
+        if not isinstance(offer, dict):
+            offer = {}
+        
+        price = offer.get('price', offer.get('lowPrice'))
+        spec = self._first(offer.get('priceSpecification'))
+        if price is None and isinstance(spec, dict):
+            price = spec.get('price')
+        
+        return {
+            'name': node.get('name'),
+            'price': price,
+            'brand': self._label(node.get('brand')),
+            'sku': node.get('sku') or node.get('mpn') or node.get('productID'),
+            'image': self._label(node.get('image')),
+            'url': node.get('url') or offer.get('url'),
+            'currency': offer.get('priceCurrency') or (spec.get('priceCurrency') if isinstance(spec, dict) else None),
+            'availability': offer.get('availability')
+        }
+    
+    def _collect_state(self, data, items, limit, depth=0):
+        """Cerca nello stato embedded (__NEXT_DATA__) oggetti con aspetto di prodotto"""
+        if depth > self.STRUCTURED_MAX_DEPTH or len(items) >= limit:
+            return
+        
+        if isinstance(data, list):
+            for node in data:
+                self._collect_state(node, items, limit, depth + 1)
+            return
+        
+        if not isinstance(data, dict):
+            return
+        
+        name = data.get('name') or data.get('title')
+        if isinstance(name, str) and any(key in data for key in self.STATE_PRICE_KEYS):
+            items.append(self._from_state(data))
+            return
+        
+        for value in data.values():
+            if isinstance(value, (dict, list)):
+                self._collect_state(value, items, limit, depth + 1)
+    
+    def _from_state(self, node):
+        if node.get('@type'):
+            return self._from_json_ld(node)
+        
+        price = next((node[key] for key in self.STATE_PRICE_KEYS if node.get(key) is not None), None)
+        currency = node.get('currency') or node.get('currencyCode') or node.get('priceCurrency')
+        
+        # Prezzi come oggetto: {"value": ..., "currency": ...}
+        if isinstance(price, dict):
+            currency = currency or price.get('currency') or price.get('currencyCode')
+            price = next((price[key] for key in ('value', 'amount', 'final', 'current', 'min') if key in price), None)
+        
+        availability = node.get('availability') or node.get('stockStatus')
+        if availability is None and isinstance(node.get('inStock'), bool):
+            availability = 'InStock' if node['inStock'] else 'OutOfStock'
+        
+        return {
+            'name': node.get('name') or node.get('title'),
+            'price': price,
+            'brand': self._label(node.get('brand') or node.get('designer') or node.get('manufacturer')),
+            'sku': node.get('sku') or node.get('id'),
+            'image': self._label(node.get('image') or node.get('images') or node.get('image_url')),
+            'url': node.get('url') or node.get('link') or node.get('href'),
+            'currency': currency,
+            'availability': availability
+        }
+    
+    def _read_microdata(self, scope, props):
+        """Legge le itemprop di uno scope, entrando in offers e brand annidati"""
+        for child in scope.children:
+            if not isinstance(child, Tag):
+                continue
+            
+            names = (child.get('itemprop') or '').split()
+            
+            if child.has_attr('itemscope'):
+                if 'offers' in names:
+                    self._read_microdata(child, props)
+                elif 'brand' in names or 'manufacturer' in names:
+                    nested = {}
+                    self._read_microdata(child, nested)
+                    props.setdefault('brand', nested.get('name'))
+                continue
+            
+            if names:
+                value = self._microdata_value(child)
+                for name in names:
+                    props.setdefault(name, value)
+            
+            self._read_microdata(child, props)
+    
+    @staticmethod
+    def _microdata_value(tag):
+        if tag.name == 'meta':
+            return tag.get('content')
+        if tag.name in ('a', 'link'):
+            return tag.get('href')
+        if tag.name in ('img', 'source'):
+            return tag.get('src') or tag.get('data-src')
+        if tag.has_attr('content'):
+            return tag.get('content')
+        return tag.get_text(strip=True)
+    
+    @staticmethod
+    def _first(value):
+        """Primo elemento se lista"""
+        if isinstance(value, list):
+            return value[0] if value else None
+        return value
+    
+    @classmethod
+    def _label(cls, value):
+        """Valore testuale di campi annidati (brand, image): nome o url dell'oggetto"""
+        value = cls._first(value)
+        if isinstance(value, dict):
+            return value.get('name') or value.get('url') or value.get('contentUrl')
+        return value
+    
+    def _finalize_structured(self, items):
+        """Forma comune (come API) più la normalizzazione della via CSS"""
+        products = []
+        
+        for product in self.normalize_products(items):
+            name = product['name']
+            if not isinstance(name, str) or len(name.strip()) <= 3:
+                continue
+            
+            product['name'] = name.strip()[:200]
+            product['price'] = self._coerce_price(product['price'])
+            if not product['price']:
+                del product['price']
+            
+            brand = product.get('brand')
+            if isinstance(brand, str) and brand.strip():
+                product['brand'] = brand.strip().upper()
+            else:
+                del product['brand']
+            
+            image = product.get('image_url')
+            if isinstance(image, str) and image:
+                product['image_url'] = image if image.startswith('http') else f"https:{image}"
+            else:
+                del product['image_url']
+            
+            if not product.get('url'):
+                del product['url']
+            
+            availability = product.get('availability')
+            if isinstance(availability, str):
+                product['availability'] = availability.rsplit('/', 1)[-1]
+            
+            product['category'] = self.detect_category(product['name'])
+            product['sku'] = str(product['sku']) if product.get('sku') else \
+                f"LXB{hashlib.md5(product['name'].encode()).hexdigest()[:8].upper()}"
+            
+            products.append(product)
+        
+        return products
+    
+    @classmethod
+    def _coerce_price(cls, value):
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, float)):
+            return float(value) if value > 0 else None
+        if isinstance(value, str):
+            return cls.parse_price(value)
+        return None
+    
+    def _scan_card(self, element, fields, scan_text=None, hits=None):
+        """
+        Visita il sottoalbero della card una sola volta e risolve tutti i
+        campi. fields: lista di (nome, plan, validator). Per ogni campo vince
+        il selettore a priorità più alta il cui primo match (in ordine di
+        documento) è accettato dal validator, come con select_one in
+        sequenza. validator(elem) -> (accettato, valore).
+        Se scan_text è dato, segnala anche se compare nel markup della card.
+        Se hits è dato, conta il selettore vincente per campo
+        """
+        values = {}
+        best = {}
+        tried = {}
+        open_fields = []
+        
+        for name, plan, validator in fields:
+            best[name] = len(plan)
+            tried[name] = [False] * len(plan)
+            open_fields.append((name, plan, validator))
+        
+        text_found = False
+        if scan_text:
+            text_found = self._node_contains(element, scan_text)
+        
+        for node in element.descendants:
+            if not isinstance(node, Tag):
+                if scan_text and not text_found and scan_text in node.lower():
+                    text_found = True
+                continue
+            
+            if scan_text and not text_found:
+                text_found = self._node_contains(node, scan_text)
+            
+            still_open = []
+            for field in open_fields:
+                name, plan, validator = field
+                field_tried = tried[name]
+                
+                for i in range(best[name]):
+                    if field_tried[i]:
+                        continue
+                    matcher = plan[i][1]
+                    if not matcher.may_match(node) or not matcher.match(node):
+                        continue
+                    
+                    field_tried[i] = True
+                    accepted, value = validator(node)
+                    if accepted:
+                        best[name] = i
+                        values[name] = value
+                        break
+                
+                # Campo risolto quando nessun selettore migliore può ancora vincere
+                if not all(field_tried[:best[name]]):
+                    still_open.append(field)
+            
+            open_fields = still_open
+            if not open_fields and (not scan_text or text_found):
+                break
+        
+        if hits is not None:
+            for name, plan, _ in fields:
+                if name in values and len(plan) > 1:
+                    field_hits = hits.setdefault(name, {})
+                    selector = plan[best[name]][0]
+                    field_hits[selector] = field_hits.get(selector, 0) + 1
+        
+        return values, text_found
+    
+    @staticmethod
+    def _node_contains(tag, text):
+        """Testo presente nel nome tag o negli attributi"""
+        if text in tag.name.lower():
+            return True
+        for key, value in tag.attrs.items():
+            if isinstance(value, list):
+                value = ' '.join(value)
+            if text in key.lower() or text in str(value).lower():
+                return True
+        return False
+    
+    @staticmethod
+    def _accept_name(elem):
+        text = elem.get_text(strip=True)
+        if text and len(text) > 3:
+            return True, text[:200]
+        return False, None
+    
+    @classmethod
+    def _accept_price(cls, elem):
+        price = cls.parse_price(elem.get_text())
+        return bool(price), price
+    
+    @staticmethod
+    def _accept_brand(elem):
+        return True, elem.get_text(strip=True).upper()
+    
+    @staticmethod
+    def _accept_text(elem):
+        return True, elem.get_text(strip=True)
+    
+    @staticmethod
+    def _accept_element(elem):
+        return True, elem
+    
+    def field_plans(self, field_order=None):
+        """Plan dei campi card; field_order riordina i selettori per campo (appresi per dominio)"""
+        plans = {'name': self.name_plan, 'price': self.price_plan, 'brand': self.brand_plan}
+        
+        for name, selectors in (field_order or {}).items():
+            if name in plans and selectors:
+                plans[name] = self.get_plan(selectors)
+        
+        return plans
+    
+    def extract_card(self, element, plans=None, hits=None):
+        """Estrae dati prodotto da elemento HTML (una sola visita della card)"""
+        plans = plans or self.field_plans()
+        
+        try:
+            fields, _ = self._scan_card(element, [
+                ('name', plans['name'], self._accept_name),
+                ('price', plans['price'], self._accept_price),
+                ('brand', plans['brand'], self._accept_brand),
+                ('img', [('img', self.img_matcher)], self._accept_element),
+                ('link', [(self.LINK_SELECTOR, self.link_matcher)], self._accept_element)
+            ], hits=hits)
+            
+            # Nome
+            if not fields.get('name'):
+                return None
+            
+            product = {'name': fields['name']}
+            
+            # Prezzo
+            if 'price' in fields:
+                product['price'] = fields['price']
+            
+            # Brand
+            if 'brand' in fields:
+                product['brand'] = fields['brand']
+            
+            # Immagine
+            img = fields.get('img')
+            if img:
+                src = img.get('src') or img.get('data-src') or img.get('data-lazy')
+                if src:
+                    product['image_url'] = src if src.startswith('http') else f"https:{src}"
+            
+            # URL prodotto
+            link = fields.get('link')
+            if link:
+                product['url'] = link.get('href')
+            
+            # Categoria
+            product['category'] = self.detect_category(product['name'])
+            
+            # SKU
+            product['sku'] = f"LXB{hashlib.md5(product['name'].encode()).hexdigest()[:8].upper()}"
+            
+            return product
+        
+        except Exception as e:
+            return None
+    
+    def extract_furniture_card(self, element):
+        """Estrae prodotto mobili (una sola visita della card)"""
+        try:
+            fields, is_ikea = self._scan_card(element, [
+                ('name', self.furniture_name_plan, self._accept_text),
+                ('price', self.furniture_price_plan, self._accept_price),
+                ('img', [('img', self.img_matcher)], self._accept_element)
+            ], scan_text='ikea')
+            
+            # Nome prodotto
+            if not fields.get('name'):
+                return None
+            
+            product = {'name': fields['name']}
+            
+            # Prezzo
+            if 'price' in fields:
+                product['price'] = fields['price']
+            
+            # Se non trova prezzo, genera uno realistico per mobili
+            if not product.get('price'):
+                product['price'] = random.randint(50, 2000)
+            
+            # Categoria mobili
+            product['category'] = self.detect_furniture_category(product['name'])
+            
+            # Brand (spesso il nome del sito per mobili)
+            product['brand'] = 'IKEA' if is_ikea else 'DESIGN'
+            
+            # SKU
+            product['sku'] = f"FUR{hashlib.md5(product['name'].encode()).hexdigest()[:8].upper()}"
+            
+            # Immagine
+            img = fields.get('img')
+            if img:
+                product['image_url'] = img.get('src') or img.get('data-src')
+            
+            return product
+        
+        except Exception as e:
+            return None
+    
+    @staticmethod
+    def parse_price(text):
+        """Parse prezzo da testo"""
+        if not text:
+            return None
+        
+        # Pulisci testo
+        text = re.sub(r'[^\d.,]', '', text)
+        text = text.replace(',', '.')
+        
+        try:
+            price = float(text)
+            if 10 <= price <= 50000:
+                return price
+        except:
+            pass
+        
+        return None
+    
+    @staticmethod
+    def detect_category(name):
+        """Rileva categoria da nome"""
+        return product_classifier.classify(name).category
+    
+    @staticmethod
+    def detect_furniture_category(name):
+        """Rileva categoria mobili"""
+        return product_classifier.classify(name).furniture_category
+
+product_html_parser = ProductHtmlParser()
+
+def _decode_html(content, encoding):
+    """Testo della pagina; charset dichiarato sconosciuto o non valido = utf-8"""
+    try:
+        return content.decode(encoding or 'utf-8', errors='replace')
+    except (LookupError, TypeError):
+        return content.decode('utf-8', errors='replace')
+
+def _pool_parse_listing(content, encoding, plan, limit, pagination):
+    """Eseguita nei processi del pool: prodotti (dict), ultima pagina stimata e statistiche selettori"""
+    html = _decode_html(content, encoding)
+    stats = {}
+    products = product_html_parser.parse_listing(
+        html, plan['selectors'], limit,
+        fallback=plan.get('fallback'), field_order=plan.get('fields'), stats=stats
+    )
+    last_page = product_html_parser.parse_pagination(html, len(products)) if pagination and products else None
+    return products, last_page, stats
+
+def _pool_parse_detail(content, encoding, url):
+    """Eseguita nei processi del pool: prodotto (dict) da pagina dettaglio"""
+    return product_html_parser.parse_detail(_decode_html(content, encoding), url)
+
+def _pool_parse_furniture(content, encoding, selectors, target):
+    """Eseguita nei processi del pool: prodotti mobili (dict)"""
+    return product_html_parser.parse_furniture(_decode_html(content, encoding), selectors, target)
+
+def _pool_build_excel_part(items, portal_type, stg_prefix):
+    """Eseguita nei processi del pool: parte xlsx (byte) di un export multi-file"""
+    return OmniSystemExcelGenerator().build_part(items, portal_type, stg_prefix)
+
+def _pool_make_thumbnail(data, size):
+    """
+    Eseguita nei processi del pool: miniatura JPEG (byte) o None.
+    Il draft mode fa decodificare i JPEG già ridotti (fino a 1/8)
+    """
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.draft('RGB', (size, size))
+            if image.width * image.height > OmniSystemConfig.IMAGE_MAX_PIXELS:
+                return None
+            
+            image.thumbnail((size, size))
+            
+            # Trasparenza su fondo bianco
+            if image.mode in ('RGBA', 'LA', 'P'):
+                image = image.convert('RGBA')
+                background = Image.new('RGB', image.size, 'white')
+                background.paste(image, mask=image.getchannel('A'))
+                image = background
+            elif image.mode != 'RGB':
+                image = image.convert('RGB')
+            
+            out = BytesIO()
+            image.save(out, 'JPEG', quality=80)
+            return out.getvalue()
+    
+    except Exception:
+        return None
+
+class CpuTaskPool:
+    """
+    Pool di processi per il lavoro CPU-bound: parsing HTML (byte della
+    pagina e selettori del profilo -> dict prodotto), parti degli export
+    Excel multi-file e miniature. Il loop resta libero per l'I/O e un job
+    usa tutti i core. Con 0 worker o pool rotto il lavoro avviene nel
+    processo corrente. Un'istanza per carico (estrazioni, export)
+    """
+    
+    def __init__(self, name, workers, start_method='spawn'):
+        self.name = name
+        self.workers = workers
+        self.start_method = start_method
+        self.executor = None
+        self.lock = threading.Lock()
+    
+    def _get_executor(self):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(
+                        max_workers=self.workers,
+                        mp_context=multiprocessing.get_context(self.start_method)
+                    )
+                    logger.info(f"{self.name} pool started: {self.workers} processes ({self.start_method})")
+        return self.executor
+    
+    async def _submit(self, func, *args, threaded=False):
+        """threaded: senza processi esegue in un thread (decodifiche lunghe che fermerebbero il loop)"""
+        loop = asyncio.get_running_loop()
+        if self.workers <= 0:
+            return await loop.run_in_executor(None, func, *args) if threaded else func(*args)
+        
+        try:
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        except BrokenProcessPool:
+            logger.warning(f"{self.name} pool broken, running in process")
+            with self.lock:
+                self.executor = None
+            return await loop.run_in_executor(None, func, *args) if threaded else func(*args)
+    
+    async def parse_listing(self, content, encoding, plan, limit=100, pagination=False):
+        """
+        plan: lista di selettori card o selector plan del dominio
+        ({'selectors', 'fallback', 'fields'}).
+        Ritorna (prodotti, ultima pagina stimata o None, statistiche selettori)
+        """
+        if not isinstance(plan, dict):
+            plan = {'selectors': list(plan)}
+        return await self._submit(_pool_parse_listing, content, encoding, plan, limit, pagination)
+    
+    async def parse_furniture(self, content, encoding, selectors, target):
+        return await self._submit(_pool_parse_furniture, content, encoding, list(selectors), target)
+    
+    async def parse_detail(self, content, encoding, url):
+        """Prodotto da pagina dettaglio o None"""
+        return await self._submit(_pool_parse_detail, content, encoding, url)
+    
+    async def build_excel_part(self, items, portal_type, stg_prefix):
+        """Parte xlsx di un export multi-file: (byte, righe scritte)"""
+        return await self._submit(_pool_build_excel_part, items, portal_type, stg_prefix)
+    
+    async def make_thumbnail(self, data, size):
+        """Miniatura JPEG (byte) o None se l'immagine non è decodificabile"""
+        return await self._submit(_pool_make_thumbnail, data, size, threaded=True)
+    
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False, cancel_futures=True)
+                self.executor = None
+
+# Parsing delle estrazioni
+html_parse_pool = CpuTaskPool('HTML parse', OmniSystemConfig.PARSE_WORKERS, OmniSystemConfig.PARSE_START_METHOD)
+
+# Export: parti Excel e miniature
+export_pool = CpuTaskPool('Export', OmniSystemConfig.EXPORT_WORKERS, OmniSystemConfig.PARSE_START_METHOD)
+
+# ==========================================
+#  SITEMAP STREAMING
+# ==========================================
+
+SitemapEntry = namedtuple('SitemapEntry', ['url', 'lastmod'])
+
+class SitemapReader:
+    """
+    Lettura incrementale di sitemap XML (anche gzip) con un parser pull:
+    gli URL vengono prodotti man mano che arrivano i chunk, le sitemap
+    index sono seguite in parallelo con un limite di concorrenza
+    """
+    
+    CHUNK_SIZE = 64 * 1024
+    GZIP_MAGIC = b'\x1f\x8b'
+    
+    def __init__(self, session, concurrency=None, max_depth=None, url_filter=None, queue_size=1000, cache=None):
+        self.session = session
+        self.cache = cache
+        self.semaphore = asyncio.Semaphore(concurrency or OmniSystemConfig.SITEMAP_CONCURRENCY)
+        self.max_depth = OmniSystemConfig.SITEMAP_MAX_DEPTH if max_depth is None else max_depth
+        self.url_filter = url_filter
+        self.timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=10, sock_read=OmniSystemConfig.SITEMAP_READ_TIMEOUT
+        )
+        
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.tasks = set()
+        self.pending = 0
+        self.visited = set()
+        self.seen_urls = set()
+        self.stats = {'sitemaps': 0, 'urls': 0, 'errors': 0, 'not_modified': 0}
+        self.roots = {}  # sitemap iniziale -> status, latenza, URL (figlie incluse)
+        self.finished = False
+    
+    async def iter_entries(self, sitemap_urls):
+        """Genera SitemapEntry dalle sitemap indicate e dalle loro figlie"""
+        for sitemap_url in sitemap_urls:
+            self.roots[sitemap_url] = {'status': None, 'latency': None, 'urls': 0}
+            self._schedule(sitemap_url, 0, sitemap_url)
+        
+        try:
+            while self.pending or not self.queue.empty():
+                entry = await self.queue.get()
+                if entry is not None:
+                    yield entry
+            self.finished = True
+        finally:
+            # Consumer fermo (limite raggiunto o errore): ferma le letture
+            for task in self.tasks:
+                task.cancel()
+            if self.tasks:
+                await asyncio.gather(*self.tasks, return_exceptions=True)
+    
+    def _schedule(self, sitemap_url, depth, root):
+        if sitemap_url in self.visited or depth > self.max_depth:
+            return
+        
+        self.visited.add(sitemap_url)
+        self.pending += 1
+        task = asyncio.ensure_future(self._run(sitemap_url, depth, root))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+    
+    async def _run(self, sitemap_url, depth, root):
+        try:
+            async with self.semaphore:
+                await self._read(sitemap_url, depth, root)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats['errors'] += 1
+            logger.debug(f"Sitemap {sitemap_url} failed: {e}")
+        
+        # Segnale di fine lettura per il consumer
+        self.pending -= 1
+        await self.queue.put(None)
+    
+    async def _read(self, sitemap_url, depth, root):
+        started = time.time()
+        
+        # Revalidazione: su 304 il corpo viene riletto dalla cache su disco
+        entry = await self._offload(self.cache.lookup, sitemap_url) if self.cache else None
+        headers = self.cache.conditional_headers(entry) if entry else None
+        
+        async with self.session.get(sitemap_url, timeout=self.timeout, headers=headers) as response:
+            status = response.status
+            writer = None
+            
+            if entry and status == 304:
+                await self._offload(self.cache.hit, entry)
+                self.stats['not_modified'] += 1
+                status = 200
+                chunks = self._iter_cached(entry)
+            else:
+                if status == 200 and self.cache:
+                    writer = await self._offload(self.cache.open_writer, sitemap_url, response.headers)
+                chunks = response.content.iter_chunked(self.CHUNK_SIZE)
+            
+            if sitemap_url == root:
+                self.roots[root]['status'] = status
+            if status != 200:
+                return
+            
+            self.stats['sitemaps'] += 1
+            try:
+                await self._parse(chunks, writer, sitemap_url, depth, root)
+            except BaseException:
+                # Lettura interrotta: niente corpo parziale in cache
+                if writer:
+                    writer.discard()
+                raise
+            
+            if writer:
+                await self._offload(writer.commit)
+        
+        if sitemap_url == root:
+            self.roots[root]['latency'] = time.time() - started
+    
+    @staticmethod
+    async def _offload(func, *args):
+        """Cache su disco (SQLite, gzip) nel pool fetch: il loop resta libero"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(fetch_executor, func, *args)
+    
+    async def _iter_cached(self, entry):
+        body = self.cache.iter_body(entry, self.CHUNK_SIZE)
+        try:
+            while True:
+                chunk = await self._offload(next, body, None)
+                if chunk is None:
+                    return
+                yield chunk
+        finally:
+            try:
+                body.close()
+            except ValueError:
+                pass  # lettura ancora in corso nel pool (consumer cancellato)
+    
+    async def _parse(self, chunks, writer, sitemap_url, depth, root):
+        parser = ET.XMLPullParser(events=('start', 'end'))
+        state = {'root': None, 'ns': '', 'loc': None, 'lastmod': None}
+        decompressor = None
+        first_chunk = True
+        
+        async for chunk in chunks:
+            # Corpo grezzo in cache (prima della decompressione)
+            if writer:
+                await self._offload(writer.write, chunk)
+            
+            # .xml.gz servite come file: aiohttp non le decomprime
+            if first_chunk:
+                first_chunk = False
+                if chunk[:2] == self.GZIP_MAGIC:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            
+            parser.feed(chunk)
+            await self._drain(parser, state, sitemap_url, depth, root)
+        
+        if decompressor:
+            parser.feed(decompressor.flush())
+        parser.close()
+        await self._drain(parser, state, sitemap_url, depth, root)
+    
+    async def _drain(self, parser, state, sitemap_url, depth, root):
+        """Consuma gli eventi del parser: url -> entry, sitemap -> lettura figlia"""
+        for event, elem in parser.read_events():
+            if state['root'] is None:
+                # Namespace della radice: standard, legacy o assente
+                state['root'] = elem
+                state['ns'] = elem.tag[:elem.tag.index('}') + 1] if elem.tag.startswith('{') else ''
+            
+            if event == 'start':
+                continue
+            
+            tag = elem.tag
+            if state['ns'] and tag.startswith(state['ns']):
+                tag = tag[len(state['ns']):]
+            elif tag.startswith('{'):
+                continue  # estensioni (image:loc, xhtml:link...)
+            
+            if tag == 'loc':
+                state['loc'] = (elem.text or '').strip()
+            elif tag == 'lastmod':
+                state['lastmod'] = (elem.text or '').strip() or None
+            elif tag in ('url', 'sitemap'):
+                loc, lastmod = state['loc'], state['lastmod']
+                state['loc'] = state['lastmod'] = None
+                
+                # Libera i nodi già letti
+                state['root'].clear()
+                
+                if not loc:
+                    continue
+                
+                if tag == 'sitemap':
+                    self._schedule(urljoin(sitemap_url, loc), depth + 1, root)
+                elif loc not in self.seen_urls and (not self.url_filter or self.url_filter(loc)):
+                    self.seen_urls.add(loc)
+                    self.stats['urls'] += 1
+                    self.roots[root]['urls'] += 1
+                    await self.queue.put(SitemapEntry(loc, lastmod))
+
+# ==========================================
+#  MASTER EXTRACTOR ENGINE COMPLETO
+# ==========================================
+
+# Profili e statistiche selettori condivisi da tutti gli estrattori del processo
+site_profile_manager = IntelligentSiteProfileManager()
+
+# Pool condiviso da tutti i job per le richieste sincrone (cloudscraper)
+fetch_executor = ThreadPoolExecutor(
+    max_workers=OmniSystemConfig.FETCH_WORKERS,
+    thread_name_prefix='omnifetch'
+)
+
+class ProductCollector:
+    """
+    Raccolta prodotti condivisa tra fasi e worker: deduplica con la chiave
+    di _process_and_deduplicate e segnala (done) quando il target di
+    prodotti unici è raggiunto
+    """
+    
+    MERGE_FIELDS = ['image_url', 'brand', 'category', 'sizes']
+    
+    def __init__(self, target):
+        self.target = target
+        self.products = []
+        self.seen = {}
+        self.done = asyncio.Event()
+    
+    @staticmethod
+    def key(product):
+        return f"{product.get('name', '')}_{product.get('brand', '')}"
+    
+    @property
+    def reached(self):
+        return len(self.products) >= self.target
+    
+    def add(self, products):
+        """Aggiunge i prodotti nuovi (fino al target), ritorna quanti"""
+        added = 0
+        
+        for product in products:
+            key = self.key(product)
+            existing = self.seen.get(key)
+            
+            if existing is not None:
+                # Mergia dati migliori
+                for field in self.MERGE_FIELDS:
+                    if not existing.get(field) and product.get(field):
+                        existing[field] = product[field]
+            elif not self.reached:
+                self.seen[key] = product
+                self.products.append(product)
+                added += 1
+        
+        if self.reached:
+            self.done.set()
+        
+        return added
+
+class PageFrontier:
+    """
+    Frontiera condivisa delle pagine listing: ogni pagina è assegnata una
+    sola volta ai worker, che si fermano a fine catalogo (ultima pagina
+    nota o prima pagina vuota) o quando il collector ha raggiunto il target
+    """
+    
+    def __init__(self, collector, first_page=1, last_page=None):
+        self.collector = collector
+        self.next_page = first_page
+        self.last_page = last_page
+        self.end_page = None  # prima pagina vuota vista
+        self.page_size = None  # prodotti della prima pagina
+        self.retry = []
+        self.pages_done = 0
+    
+    def _beyond_end(self, page):
+        if self.last_page is not None and page > self.last_page:
+            return True
+        return self.end_page is not None and page >= self.end_page
+    
+    def claim(self):
+        """Prossima pagina da leggere (None = stop)"""
+        if self.collector.reached:
+            return None
+        
+        while self.retry:
+            page = self.retry.pop(0)
+            if not self._beyond_end(page):
+                return page
+        
+        page = self.next_page
+        if self._beyond_end(page):
+            return None
+        
+        self.next_page += 1
+        return page
+    
+    def release(self, page):
+        """Pagina non letta (blocco/errore): torna disponibile per un altro worker"""
+        self.retry.append(page)
+        self.retry.sort()
+    
+    def complete(self, page, count):
+        """Pagina letta: una pagina vuota segna la fine del catalogo"""
+        self.pages_done += 1
+        if not count and (self.end_page is None or page < self.end_page):
+            self.end_page = page
+    
+    def remaining_pages(self):
+        """Pagine ancora assegnabili (None se la fine del catalogo non è nota)"""
+        if self.collector.reached:
+            return 0
+        
+        pending = len([page for page in self.retry if not self._beyond_end(page)])
+        last = self.last_page
+        if self.end_page is not None:
+            last = self.end_page - 1 if last is None else min(last, self.end_page - 1)
+        
+        if last is None:
+            return None
+        return max(0, last - self.next_page + 1) + pending
+
+class MasterOmniExtractor:
+    """
+    Sistema di estrazione definitivo omnisystem che gestisce:
+    - Siti pubblici con 200+ identity rotation
+    - Portali B2B autenticati
+    - Estrazione massiva parallela fino a 50.000+ prodotti
+    - Recovery intelligente
+    - Supporto universale (fashion, mobili, tech, etc.)
+    """
+    
+    def __init__(self, progress=None):
+        self.site_manager = site_profile_manager
+        self.identity_system = AdvancedIdentitySystem()
+        self.sessions = []
+        self.browsers = []
+        self.stats = defaultdict(int)
+        self.scraper = cloudscraper.create_scraper()
+        self.html_parser = product_html_parser
+        self.html_parse_pool = html_parse_pool
+        self.strategy_memory = domain_strategy_memory
+        self.http_cache = http_response_cache
+        self.known_products = {}  # modalità delta: url -> (lastmod, prodotto) dell'estrazione precedente
+        self.progress = progress
+        self.http_session = None
+        self.detail_identities = {}  # dominio -> identità usata per le pagine dettaglio
+    
+    async def _get_http_session(self):
+        """
+        Sessione aiohttp condivisa da sitemap e probe API: pool con limite
+        per host, keep-alive e cache DNS. Creata al primo uso nel loop del job
+        """
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=OmniSystemConfig.HTTP_POOL_LIMIT,
+                limit_per_host=OmniSystemConfig.HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=OmniSystemConfig.HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=OmniSystemConfig.HTTP_KEEPALIVE_TIMEOUT
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                headers={'Accept-Encoding': 'gzip, deflate'}
+            )
+        
+        return self.http_session
+    
+    async def close(self):
+        """Chiude la sessione HTTP condivisa"""
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+    
+    async def _fetch(self, session, url, **kwargs):
+        """GET sincrono (cloudscraper/requests) eseguito nel pool, fuori dal loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(fetch_executor, partial(session.get, url, **kwargs))
+    
+    async def _fetch_listing(self, session, url, **kwargs):
+        """Come _fetch, con revalidazione dalla cache HTTP (pagine listing)"""
+        if self.http_cache is None:
+            response = await self._fetch(session, url, **kwargs)
+            response.cache_entry = None
+            return response
+        
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(fetch_executor, partial(self._cached_get, session, url, **kwargs))
+    
+    def _cached_get(self, session, url, **kwargs):
+        """GET condizionale: su 304 la risposta riporta il corpo in cache, su 200 lo salva"""
+        cache = self.http_cache
+        entry = cache.lookup(url)
+        if entry:
+            kwargs['headers'] = {**kwargs.get('headers', {}), **cache.conditional_headers(entry)}
+        
+        response = session.get(url, **kwargs)
+        
+        if entry and response.status_code == 304:
+            cache.hit(entry)
+            return CachedResponse(200, cache.read_body(entry), entry['encoding'], response.headers, entry)
+        
+        # Pagine di blocco mai in cache: sostituirebbero la voce buona
+        response.cache_entry = None
+        if response.status_code == 200 and not self._is_blocked(self._response_head(response)):
+            response.cache_entry = cache.store(url, response.headers, response.content, response.encoding)
+        return response
+    
+    async def _selector_plan(self, domain, selectors):
+        """Selector plan del dominio; le statistiche SQLite sono lette nel pool, fuori dal loop"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(fetch_executor, self.site_manager.selector_plan, domain, selectors)
+    
+    async def _record_parse(self, domain, parse_stats):
+        """Esito del parsing nelle statistiche del dominio, scritte nel pool"""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(fetch_executor, self.site_manager.record_parse, domain, parse_stats)
+    
+    async def _parse_listing_response(self, response, plan, pagination=False):
+        """Parsing listing nel pool; su pagina non modificata riusa i prodotti già estratti"""
+        entry = response.cache_entry
+        if entry is None:
+            return await self.html_parse_pool.parse_listing(
+                response.content, response.encoding, plan, pagination=pagination
+            )
+        
+        loop = asyncio.get_running_loop()
+        parse_key = HttpResponseCache.parse_key(plan, pagination)
+        payload = await loop.run_in_executor(fetch_executor, self.http_cache.load_parsed, entry, parse_key)
+        if payload is not None:
+            products, last_page = payload
+            return products, last_page, {}
+        
+        products, last_page, parse_stats = await self.html_parse_pool.parse_listing(
+            response.content, response.encoding, plan, pagination=pagination
+        )
+        await loop.run_in_executor(
+            fetch_executor, self.http_cache.store_parsed, entry, parse_key, [products, last_page]
+        )
+        return products, last_page, parse_stats
+    
+    def _report_progress(self, key, amount=1):
+        """Aggiorna il progresso del job (se presente)"""
+        if self.progress:
+            self.progress.increment(key, amount)
+    
+    async def extract_omnisystem(self, url, target=10000, user=None):
+        """
+        Estrazione master omnisystem che rileva automaticamente il tipo
+        """
+        
+        self.stats['start_time'] = datetime.now()
+        profile = self.site_manager.get_profile(url)
+        
+        # Determina limite basato su utente
+        if user:
+            plan_limits = user.get_plan_limits()
+            max_products = min(target, plan_limits['products'])
+        else:
+            max_products = min(target, 15)  # Trial limit
+        
+        logger.info(f"""
+         OMNISYSTEM EXTRACTION STARTED
+        ╔══════════════════════════════════════════════╗
+         URL: {url}
+         Type: {profile.get('type', 'unknown')}
+         Target: {max_products} products
+         Strategy: {profile.get('strategy', 'adaptive')}
+         User: {user.email if user else 'Anonymous'}
+        ╚══════════════════════════════════════════════╝
+        """)
+        
+        # Rileva tipo e usa strategia appropriata
+        try:
+            if profile.get('type') == 'b2b_portal':
+                products = await self._extract_b2b_portal(url, max_products, profile)
+            elif profile.get('type') == 'furniture':
+                products = await self._extract_furniture_site(url, max_products, profile)
+            else:
+                products = await self._extract_public_site(url, max_products, profile)
+        finally:
+            await self.close()
+        
+        # Post-processing
+        final_products = self._process_and_deduplicate(products)
+        if self.progress:
+            self.progress.set('products_unique', len(final_products))
         
         elapsed_time = (datetime.now() - self.stats['start_time']).seconds
         
@@ -1350,6 +3915,12 @@ class MasterOmniExtractor:
         
         return final_products[:min(max_products, OmniSystemConfig.EXCEL_SAFE_ROWS)]
     
+    def extraction_complete(self):
+        """Catalogo letto fino in fondo: nessun blocco o errore, nessuna pagina o sitemap rimasta da leggere"""
+        return not any(
+            self.stats[key] for key in ('blocks', 'errors', 'pages_left', 'sitemaps_unfinished')
+        )
+    
     async def _extract_b2b_portal(self, url, target, profile):
         """
         Estrazione specifica per portali B2B autenticati
@@ -1384,6 +3955,9 @@ class MasterOmniExtractor:
                     product = self._extract_b2b_product(element, selectors)
                     if product:
                         products.append(product)
+                
+                self._report_progress('pages_fetched')
+                self._report_progress('products_parsed', len(products))
             
             # Gestisci paginazione B2B
             while len(products) < target:
@@ -1392,6 +3966,8 @@ class MasterOmniExtractor:
                 
                 new_products = self._extract_current_page(driver, selectors)
                 products.extend(new_products)
+                self._report_progress('pages_fetched')
+                self._report_progress('products_parsed', len(new_products))
                 
                 if len(products) >= target:
                     break
@@ -1508,8 +4084,8 @@ class MasterOmniExtractor:
         products = []
         
         try:
-            response = self.scraper.get(url, timeout=30)
-            soup = BeautifulSoup(response.text, 'html.parser')
+            response = await self._fetch(self.scraper, url, timeout=30)
+            self._report_progress('pages_fetched')
             
             # Selettori specifici per mobili
             furniture_selectors = profile.get('selectors', [
@@ -1520,17 +4096,11 @@ class MasterOmniExtractor:
                 'article[class*="product"]'
             ])
             
-            for selector in furniture_selectors:
-                elements = soup.select(selector)[:target]
-                
-                for elem in elements:
-                    product = self._extract_furniture_product(elem)
-                    if product:
-                        products.append(product)
-                
-                if products:
-                    break
+            products = await self.html_parse_pool.parse_furniture(
+                response.content, response.encoding, furniture_selectors, target
+            )
             
+            self._report_progress('products_parsed', len(products))
             logger.info(f"Extracted {len(products)} furniture products from {url}")
             
         except Exception as e:
@@ -1540,162 +4110,302 @@ class MasterOmniExtractor:
     
     def _extract_furniture_product(self, element):
         """Estrae prodotto mobili"""
-        try:
-            product = {}
-            
-            # Nome prodotto
-            name_selectors = [
-                '.pip-header-section__title',  # IKEA
-                'h3', 'h2', 'h4',
-                '[class*="product-name"]',
-                '[class*="product-title"]'
-            ]
-            
-            for selector in name_selectors:
-                elem = element.select_one(selector)
-                if elem:
-                    product['name'] = elem.get_text(strip=True)
-                    break
-            
-            if not product.get('name'):
-                return None
-            
-            # Prezzo
-            price_selectors = [
-                '.pip-price__integer',  # IKEA
-                '[class*="price"]',
-                '.price'
-            ]
-            
-            for selector in price_selectors:
-                elem = element.select_one(selector)
-                if elem:
-                    price = self._parse_price(elem.get_text())
-                    if price:
-                        product['price'] = price
-                        break
-            
-            # Se non trova prezzo, genera uno realistico per mobili
-            if not product.get('price'):
-                product['price'] = random.randint(50, 2000)
-            
-            # Categoria mobili
-            product['category'] = self._detect_furniture_category(product['name'])
-            
-            # Brand (spesso il nome del sito per mobili)
-            product['brand'] = 'IKEA' if 'ikea' in str(element).lower() else 'DESIGN'
-            
-            # SKU
-            product['sku'] = f"FUR{hashlib.md5(product['name'].encode()).hexdigest()[:8].upper()}"
+        return self.html_parser.extract_furniture_card(element)
+    
+    def _detect_furniture_category(self, name):
+        """Rileva categoria mobili"""
+        return self.html_parser.detect_furniture_category(name)
+    
+    async def _extract_public_site(self, url, target, profile):
+        """
+        Estrazione da siti pubblici con strategie multiple: le fasi sono
+        ordinate dalla strategia del profilo e da ciò che ha funzionato
+        in passato sul dominio
+        """
+        collector = ProductCollector(target)
+        domain = urlparse(url).netloc
+        
+        # FASE 1-2: bulk (sitemap, API) e listing parallelo
+        for phase in self._plan_phases(domain, profile):
+            if collector.reached:
+                break
             
-            # Immagine
-            img = element.select_one('img')
-            if img:
-                product['image_url'] = img.get('src') or img.get('data-src')
+            started = time.time()
+            before = len(collector.products)
             
-            return product
+            if phase == 'sitemap':
+                await self._bulk_from_sitemap(url, collector)
+            elif phase == 'api':
+                await self._bulk_from_api(url, collector)
+            else:
+                await self._parallel_extraction(url, collector, profile)
             
-        except Exception as e:
-            return None
+            gained = len(collector.products) - before
+            self.strategy_memory.record(domain, f'phase:{phase}', gained > 0, time.time() - started, gained)
+            if gained and phase != 'listing':
+                logger.info(f" Bulk ({phase}): {gained} products")
+        
+        # FASE 3: Recovery se necessario
+        if len(collector.products) < target * 0.7:
+            recovery_products = await self._recovery_extraction(url, target - len(collector.products))
+            collector.add(recovery_products)
+        
+        return collector.products
     
-    def _detect_furniture_category(self, name):
-        """Rileva categoria mobili"""
-        name_lower = name.lower()
+    def _plan_phases(self, domain, profile):
+        """Ordine delle fasi: strategia del profilo, poi memoria del dominio"""
+        strategy = profile.get('strategy')
+        
+        if strategy == 'no_bulk':
+            phases = ['listing']
+        elif strategy == 'api_first':
+            phases = ['api', 'sitemap', 'listing']
+        else:
+            phases = ['sitemap', 'api', 'listing']
         
-        categories = {
-            'DIVANI': ['sofa', 'divano', 'couch', 'settee'],
-            'TAVOLI': ['table', 'tavolo', 'desk', 'scrivania'],
-            'SEDIE': ['chair', 'sedia', 'stool', 'sgabello'],
-            'LETTI': ['bed', 'letto', 'mattress', 'materasso'],
-            'ARMADI': ['wardrobe', 'armadio', 'closet', 'guardaroba'],
-            'LIBRERIE': ['bookcase', 'libreria', 'shelf', 'scaffale'],
-            'ILLUMINAZIONE': ['lamp', 'lampada', 'light', 'chandelier']
-        }
+        return self.strategy_memory.order_phases(domain, phases)
+    
+    async def _bulk_from_sitemap(self, url, collector):
+        """Sitemap: URL prodotto arricchiti dalle pagine dettaglio"""
+        return await self._enrich_products(self._sitemap_seeds(url), collector)
+    
+    async def _bulk_from_api(self, url, collector):
+        """API nascoste; i prodotti senza prezzo ma con URL sono completati dalla pagina dettaglio (se leggibile)"""
+        products = []
+        api_products = (await self._find_hidden_apis(url))[:5000]
         
-        for category, keywords in categories.items():
-            if any(kw in name_lower for kw in keywords):
-                return category
+        complete = [p for p in api_products if p.get('price') or not p.get('url')]
+        products.extend(complete)
+        collector.add(complete)
+        
+        if len(complete) < len(api_products) and not collector.reached:
+            unpriced = [p for p in api_products if not p.get('price') and p.get('url')]
+            enriched = await self._enrich_products(self._list_seeds(unpriced, url), collector)
+            products.extend(enriched)
+            
+            # Pagina dettaglio fallita o bloccata: resta il prodotto dell'API, senza prezzo
+            done = {p.get('url') for p in enriched}
+            fallback = [p for p in unpriced if urljoin(url, p['url']) not in done]
+            if fallback and not collector.reached:
+                products.extend(fallback)
+                collector.add(fallback)
         
-        return 'ARREDAMENTO'
+        return products
     
-    async def _extract_public_site(self, url, target, profile):
+    async def _sitemap_seeds(self, base_url):
+        """(url, dati iniziali) dalle sitemap, in streaming"""
+        entries = self.iter_sitemap_entries(base_url)
+        count = 0
+        
+        try:
+            async for entry in entries:
+                seed = {'from_sitemap': True}
+                if entry.lastmod:
+                    seed['lastmod'] = entry.lastmod
+                
+                self._report_progress('sitemap_urls')
+                yield entry.url, seed
+                
+                count += 1
+                if count >= OmniSystemConfig.SITEMAP_MAX_URLS:
+                    break
+        finally:
+            await entries.aclose()
+    
+    @staticmethod
+    async def _list_seeds(products, base_url):
+        for product in products:
+            yield urljoin(base_url, product['url']), product
+    
+    async def _enrich_products(self, seeds, collector):
         """
-        Estrazione da siti pubblici con strategie multiple
+        Scarica le pagine prodotto con worker limitati (ENRICH_CONCURRENCY,
+        più il limite per host della sessione condivisa) e manda i prodotti
+        al collector man mano che vengono estratti. I campi del seed
+        (es. dati API, lastmod) prevalgono su quelli della pagina
         """
-        all_products = []
+        concurrency = OmniSystemConfig.ENRICH_CONCURRENCY
+        work_queue = asyncio.Queue(maxsize=concurrency * 2)
+        enriched = []
+        state = {'blocks': 0, 'stop': False}
+        
+        async def worker():
+            while True:
+                item = await work_queue.get()
+                if item is None:
+                    return
+                if state['stop'] or collector.reached:
+                    continue
+                
+                page_url, seed = item
+                try:
+                    product = await self._fetch_product_detail(page_url, state)
+                except Exception as e:
+                    logger.debug(f"Detail page {page_url} failed: {e}")
+                    self.stats['errors'] += 1
+                    continue
+                
+                if product:
+                    product.update({k: v for k, v in seed.items() if v})
+                    product['url'] = page_url
+                    enriched.append(product)
+                    collector.add([product])
+                    self._report_progress('products_parsed')
+                elif not enriched and state['blocks'] >= OmniSystemConfig.ENRICH_MAX_BLOCKS:
+                    state['stop'] = True
+                    logger.warning(f" Enrichment stopped: {state['blocks']} blocked detail pages")
+        
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
         
-        # FASE 1: Prova metodi bulk
-        if profile.get('strategy') != 'no_bulk':
-            bulk_products = await self._try_bulk_extraction(url)
-            if bulk_products:
-                all_products.extend(bulk_products)
-                logger.info(f" Bulk: {len(bulk_products)} products")
+        try:
+            async for item in seeds:
+                if state['stop'] or collector.reached:
+                    break
+                
+                # Modalità delta: pagina con lo stesso lastmod dell'ultima estrazione, niente download
+                known = self._known_product(*item)
+                if known:
+                    self.stats['delta_skipped'] += 1
+                    enriched.append(known)
+                    collector.add([known])
+                    self._report_progress('products_parsed')
+                    continue
+                
+                await work_queue.put(item)
+        finally:
+            await seeds.aclose()
+            for _ in workers:
+                await work_queue.put(None)
+            await asyncio.gather(*workers, return_exceptions=True)
         
-        # FASE 2: Estrazione parallela
-        if len(all_products) < target:
-            remaining = target - len(all_products)
-            parallel_products = await self._parallel_extraction(url, remaining, profile)
-            all_products.extend(parallel_products)
+        if enriched:
+            logger.info(f" Enrichment: {len(enriched)} products from detail pages")
         
-        # FASE 3: Recovery se necessario
-        if len(all_products) < target * 0.7:
-            recovery_products = await self._recovery_extraction(url, target - len(all_products))
-            all_products.extend(recovery_products)
+        return enriched
+    
+    def _known_product(self, page_url, seed):
+        """Prodotto dell'estrazione precedente se la sitemap riporta lo stesso lastmod"""
+        known = self.known_products.get(page_url)
+        if not known or not seed.get('lastmod') or known[0] != seed['lastmod']:
+            return None
         
-        return all_products
+        product = json_loads(known[1])
+        product.update({k: v for k, v in seed.items() if v})
+        return product
     
-    async def _try_bulk_extraction(self, url):
-        """Prova estrazione bulk (sitemap, API, feeds)"""
-        products = []
+    async def _fetch_product_detail(self, url, state):
+        """Pagina dettaglio via sessione condivisa, parsing nel pool (revalidata dalla cache HTTP)"""
+        session = await self._get_http_session()
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=OmniSystemConfig.ENRICH_READ_TIMEOUT)
+        cache = self.http_cache
+        loop = asyncio.get_running_loop()
+        # Indice SQLite e corpi su disco nel pool, fuori dal loop
+        entry = await loop.run_in_executor(fetch_executor, cache.lookup, url) if cache else None
+        identity = self._detail_identity(url)
+        headers = {
+            'User-Agent': identity['user_agent'],
+            'Accept-Language': identity['accept_language'],
+            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
+        }
+        if entry:
+            headers.update(cache.conditional_headers(entry))
         
-        # Sitemap
-        sitemap_products = await self._extract_from_sitemap(url)
-        products.extend(sitemap_products[:5000])
+        async with session.get(url, timeout=timeout, headers=headers) as response:
+            self._report_progress('pages_fetched')
+            
+            not_modified = bool(entry) and response.status == 304
+            if not not_modified:
+                if response.status != 200:
+                    return None
+                content = await response.read()
+                encoding = response.charset
+                entry = None
+        
+        if not_modified:
+            payload, content = await loop.run_in_executor(fetch_executor, self._revalidated_detail, entry)
+            if payload is not None:
+                return payload[0]
+            encoding = entry['encoding']
+        
+        if self._is_blocked(_decode_html(content[:20000], encoding)):
+            self.stats['blocks'] += 1
+            state['blocks'] += 1
+            # Identità bruciata: le prossime pagine del dominio ne usano un'altra
+            self.identity_system.mark_blocked(identity['id'])
+            self.detail_identities.pop(urlparse(url).netloc, None)
+            return None
         
-        # Hidden APIs
-        api_products = await self._find_hidden_apis(url)
-        products.extend(api_products[:5000])
+        if cache and entry is None:
+            entry = await loop.run_in_executor(
+                fetch_executor, cache.store, url, response.headers, content, encoding
+            )
         
-        return products
+        product = await self.html_parse_pool.parse_detail(content, encoding, url)
+        if entry:
+            await loop.run_in_executor(fetch_executor, cache.store_parsed, entry, 'detail', [product])
+        return product
     
-    async def _extract_from_sitemap(self, base_url):
-        """Estrae da sitemap XML"""
-        products = []
-        sitemap_urls = [
-            f"{base_url}/sitemap.xml",
-            f"{base_url}/sitemap_products.xml",
-            f"{base_url}/product-sitemap.xml",
-            f"{base_url}/sitemap/products.xml"
+    def _detail_identity(self, url):
+        """Identità (User-Agent, lingua) per le pagine dettaglio del dominio, come per le listing"""
+        domain = urlparse(url).netloc
+        identity = self.detail_identities.get(domain)
+        if identity is None:
+            identity = self.detail_identities[domain] = self.identity_system.get_best_identity(domain)
+            self.stats['identities_used'] += 1
+        return identity
+    
+    def _revalidated_detail(self, entry):
+        """Pagina non modificata: prodotto già estratto o, in mancanza, corpo dalla cache"""
+        self.http_cache.hit(entry)
+        payload = self.http_cache.load_parsed(entry, 'detail')
+        if payload is not None:
+            return payload, None
+        return None, self.http_cache.read_body(entry)
+    
+    async def iter_sitemap_entries(self, base_url):
+        """SitemapEntry dei prodotti del sito, prodotte man mano che le sitemap vengono lette"""
+        sitemap_paths = [
+            '/sitemap.xml',
+            '/sitemap_products.xml',
+            '/product-sitemap.xml',
+            '/sitemap/products.xml'
         ]
         
-        for sitemap_url in sitemap_urls:
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(sitemap_url, timeout=10) as response:
-                        if response.status == 200:
-                            content = await response.text()
-                            root = ET.fromstring(content)
-                            
-                            namespace = {'sm': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-                            
-                            for url_elem in root.findall('.//sm:url', namespace):
-                                loc = url_elem.find('sm:loc', namespace)
-                                if loc is not None:
-                                    url_text = loc.text
-                                    if any(x in url_text for x in ['/product', '/item', '/p/']):
-                                        products.append({
-                                            'url': url_text,
-                                            'from_sitemap': True
-                                        })
-                            
-                            if products:
-                                logger.info(f" Sitemap: {len(products)} URLs found")
-                                return products
-                                
-            except Exception as e:
-                continue
+        # Solo le sitemap che hanno funzionato, o le non fallite di recente
+        domain = urlparse(base_url).netloc
+        paths = self.strategy_memory.order_probes(domain, 'sitemap:', sitemap_paths)
+        sitemap_urls = {f"{base_url}{path}": path for path in paths}
         
-        return []
+        if not sitemap_urls:
+            return
+        
+        session = await self._get_http_session()
+        reader = SitemapReader(session, url_filter=self._is_product_url, cache=self.http_cache)
+        entries = reader.iter_entries(list(sitemap_urls))
+        try:
+            async for entry in entries:
+                yield entry
+        finally:
+            # Chiusura esplicita: i task del reader vanno cancellati prima che la sessione venga chiusa
+            await entries.aclose()
+            self._report_progress('pages_fetched', reader.stats['sitemaps'])
+            
+            # Sitemap fallite o lettura interrotta (limite URL, target): catalogo non completo
+            self.stats['errors'] += reader.stats['errors']
+            if not reader.finished:
+                self.stats['sitemaps_unfinished'] += 1
+            
+            for sitemap_url, result in reader.roots.items():
+                # Fallimento certo solo se non 200 o lettura completata senza URL
+                if result['urls'] or result['status'] not in (None, 200) or reader.finished:
+                    self.strategy_memory.record(
+                        domain, 'sitemap:' + sitemap_urls[sitemap_url],
+                        result['urls'] > 0, result['latency'] or 0, result['urls']
+                    )
+    
+    @staticmethod
+    def _is_product_url(url):
+        return any(x in url for x in ['/product', '/item', '/p/'])
     
     async def _find_hidden_apis(self, base_url):
         """Cerca API nascoste"""
@@ -1711,7 +4421,12 @@ class MasterOmniExtractor:
             '/graphql'
         ]
         
-        for pattern in api_patterns:
+        # Solo gli endpoint già riusciti sul dominio, o i non falliti di recente
+        domain = urlparse(base_url).netloc
+        session = await self._get_http_session()
+        
+        for pattern in self.strategy_memory.order_probes(domain, 'api:', api_patterns):
+            started = time.time()
             try:
                 url = base_url.rstrip('/') + pattern
                 
@@ -1720,53 +4435,47 @@ class MasterOmniExtractor:
                     'Accept': 'application/json'
                 }
                 
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers, timeout=10) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            
-                            # Parse JSON per prodotti
-                            if isinstance(data, list):
-                                products = data
-                            elif isinstance(data, dict):
-                                for key in ['products', 'items', 'data', 'results']:
-                                    if key in data:
-                                        products = data[key]
-                                        break
+                async with session.get(url, headers=headers, timeout=10) as response:
+                    if response.status == 200:
+                        data = await response.json()
+                        
+                        # Parse JSON per prodotti
+                        if isinstance(data, list):
+                            products = data
+                        elif isinstance(data, dict):
+                            for key in ['products', 'items', 'data', 'results']:
+                                if key in data:
+                                    products = data[key]
+                                    break
+                        
+                        self._report_progress('pages_fetched')
+                        
+                        if products:
+                            logger.info(f" API found: {pattern}")
+                            normalized = self._normalize_api_products(products[:5000])
+                            self._report_progress('products_parsed', len(normalized))
+                            self.strategy_memory.record(
+                                domain, 'api:' + pattern, bool(normalized), time.time() - started, len(normalized)
+                            )
+                            return normalized
                             
-                            if products:
-                                logger.info(f" API found: {pattern}")
-                                return self._normalize_api_products(products[:5000])
-                                
             except:
-                continue
+                pass
+            
+            self.strategy_memory.record(domain, 'api:' + pattern, False, time.time() - started)
         
         return []
     
     def _normalize_api_products(self, api_products):
         """Normalizza prodotti da API"""
-        normalized = []
-        
-        for item in api_products:
-            if isinstance(item, dict):
-                product = {
-                    'name': item.get('name') or item.get('title'),
-                    'price': item.get('price') or item.get('cost'),
-                    'brand': item.get('brand') or item.get('manufacturer'),
-                    'sku': item.get('sku') or item.get('id'),
-                    'image_url': item.get('image') or item.get('image_url'),
-                    'url': item.get('url') or item.get('link'),
-                    'category': item.get('category', 'PRODUCT')
-                }
-                
-                if product['name']:
-                    normalized.append(product)
-        
-        return normalized
+        return self.html_parser.normalize_products(api_products)
     
-    async def _parallel_extraction(self, url, target, profile):
-        """Estrazione parallela con identità multiple"""
-        products = []
+    async def _parallel_extraction(self, url, collector, profile):
+        """
+        Estrazione parallela con identità multiple su una frontiera di pagine
+        condivisa. I worker ancora attivi vengono cancellati appena il
+        collector raggiunge il target
+        """
         domain = urlparse(url).netloc
         
         # Calcola sessioni parallele
@@ -1775,86 +4484,193 @@ class MasterOmniExtractor:
             OmniSystemConfig.MAX_CONCURRENT_REQUESTS
         )
         
-        chunk_size = max(100, target // max_parallel)
+        # Prima pagina: prodotti e paginazione del catalogo
+        frontier = PageFrontier(collector)
+        identity = self.identity_system.get_best_identity(domain)
+        self.stats['identities_used'] += 1
+        await self._discover_pagination(url, identity, profile, frontier)
+        
+        # Worker solo per le pagine ancora da leggere
+        remaining = frontier.remaining_pages()
+        workers = max_parallel if remaining is None else min(max_parallel, remaining)
+        
+        # Non più worker delle pagine che servono al target
+        if frontier.page_size:
+            needed = -(-(collector.target - len(collector.products)) // frontier.page_size)
+            workers = min(workers, max(needed, 1))
         
         # Crea task paralleli
         tasks = []
-        for i in range(max_parallel):
+        for i in range(workers):
             identity = self.identity_system.get_best_identity(domain)
-            task = self._extract_chunk(url, identity, profile, chunk_size, i)
+            task = asyncio.ensure_future(self._extract_chunk(url, identity, profile, frontier, i))
             tasks.append(task)
             self.stats['identities_used'] += 1
         
-        # Esegui
+        # Esegui fino a fine worker o target raggiunto
+        target_reached = asyncio.ensure_future(collector.done.wait())
+        pending = set(tasks)
+        
+        while pending and not collector.reached:
+            _, pending = await asyncio.wait(pending | {target_reached}, return_when=asyncio.FIRST_COMPLETED)
+            pending.discard(target_reached)
+        
+        target_reached.cancel()
+        if pending:
+            logger.info(f" Target reached: cancelling {len(pending)} workers")
+            for task in pending:
+                task.cancel()
+        
         results = await asyncio.gather(*tasks, return_exceptions=True)
         
         for result in results:
-            if isinstance(result, list):
-                products.extend(result)
-            elif isinstance(result, Exception):
+            if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
                 logger.warning(f"Task failed: {result}")
                 self.stats['errors'] += 1
         
-        return products
-    
-    async def _extract_chunk(self, url, identity, profile, chunk_size, chunk_id):
-        """Estrae chunk con identità specifica"""
-        products = []
+        # Pagine non lette (rilasciate dopo blocchi/errori) o fine catalogo mai vista
+        left = frontier.remaining_pages()
+        self.stats['pages_left'] += 1 if left is None else left
         
-        # Crea sessione con identità
-        session = cloudscraper.create_scraper(
+        logger.info(f" Frontier: {frontier.pages_done} pages read, last page {frontier.last_page or 'unknown'}")
+        return collector.products
+    
+    async def _create_identity_session(self, identity):
+        """Sessione cloudscraper con identità (una per task: le sessioni non sono thread-safe)"""
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(fetch_executor, partial(
+            cloudscraper.create_scraper,
             browser={
                 'browser': 'chrome',
                 'platform': identity['platform'],
                 'desktop': True
             }
-        )
+        ))
         
         session.headers.update({
             'User-Agent': identity['user_agent'],
             'Accept-Language': identity['accept_language']
         })
         
+        return session
+    
+    @staticmethod
+    def _page_url(url, page):
+        """URL della pagina listing (la prima è l'URL stesso)"""
+        if page <= 1:
+            return url
+        return f"{url}?page={page}" if '?' not in url else f"{url}&page={page}"
+    
+    async def _discover_pagination(self, url, identity, profile, frontier):
+        """Legge la prima pagina: prodotti e ultima pagina (link page=N, totali, rel=next)"""
+        products = []
+        page = frontier.claim()
+        if page is None:
+            return products
+        
+        session = None
+        try:
+            session = await self._create_identity_session(identity)
+            response = await self._fetch_listing(session, self._page_url(url, page), timeout=30)
+            self._report_progress('pages_fetched')
+            
+            if response.status_code != 200:
+                frontier.release(page)
+                return products
+            
+            if self._is_blocked(self._response_head(response)):
+                self.stats['blocks'] += 1
+                self.identity_system.mark_blocked(identity['id'])
+                frontier.release(page)
+                return products
+            
+            selectors = profile.get('selectors', self.site_manager._get_universal_selectors())
+            domain = urlparse(url).netloc
+            products, last_page, parse_stats = await self._parse_listing_response(
+                response, await self._selector_plan(domain, selectors), pagination=True
+            )
+            await self._record_parse(domain, parse_stats)
+            frontier.complete(page, len(products))
+            frontier.collector.add(products)
+            
+            if products:
+                frontier.page_size = len(products)
+                frontier.last_page = last_page
+                self._report_progress('products_parsed', len(products))
+                self.identity_system.mark_success(identity['id'], len(products))
+        
+        except Exception as e:
+            # I worker riprovano la prima pagina con altre identità
+            logger.warning(f"Pagination discovery failed: {e}")
+            frontier.release(page)
+        
+        finally:
+            if session is not None:
+                session.close()
+        
+        return products
+    
+    async def _extract_chunk(self, url, identity, profile, frontier, chunk_id):
+        """Worker con identità specifica: legge le pagine assegnate dalla frontiera e le consegna al collector"""
+        products = []
+        session = await self._create_identity_session(identity)
+        selectors = profile.get('selectors', self.site_manager._get_universal_selectors())
+        domain = urlparse(url).netloc
+        
         try:
             request_count = 0
-            page = chunk_id * 10  # Start da pagina diversa per ogni chunk
             
-            while len(products) < chunk_size:
-                # Costruisci URL pagina
-                page_url = f"{url}?page={page}" if '?' not in url else f"{url}&page={page}"
+            while True:
+                page = frontier.claim()
+                if page is None:
+                    break
                 
                 # Delay
                 await asyncio.sleep(random.uniform(*profile['request_delay']))
                 
                 # Request
-                response = session.get(page_url, timeout=30)
+                try:
+                    response = await self._fetch_listing(session, self._page_url(url, page), timeout=30)
+                except Exception:
+                    frontier.release(page)
+                    raise
+                
                 request_count += 1
+                self._report_progress('pages_fetched')
                 
-                if response.status_code == 200:
-                    html = response.text
-                    
-                    # Check blocco
-                    if self._is_blocked(html):
-                        self.stats['blocks'] += 1
-                        self.identity_system.mark_blocked(identity['id'])
-                        break
-                    
-                    # Parse
-                    page_products = self._parse_products_html(html, profile.get('selectors', self.site_manager._get_universal_selectors()))
-                    
-                    if not page_products:
-                        break
-                    
-                    products.extend(page_products)
-                    page += 1
-                    
-                    # Pausa periodica
-                    if request_count % profile['max_requests_before_pause'] == 0:
-                        pause = random.uniform(*profile['pause_duration'])
-                        await asyncio.sleep(pause)
+                if response.status_code in (404, 410):
+                    frontier.complete(page, 0)
+                    break
                 
-                else:
+                if response.status_code != 200:
+                    frontier.release(page)
+                    break
+                
+                # Check blocco
+                if self._is_blocked(self._response_head(response)):
+                    self.stats['blocks'] += 1
+                    self.identity_system.mark_blocked(identity['id'])
+                    frontier.release(page)
+                    break
+                
+                # Parse (pool di processi) con il selector plan appreso per il dominio
+                page_products, _, parse_stats = await self._parse_listing_response(
+                    response, await self._selector_plan(domain, selectors)
+                )
+                await self._record_parse(domain, parse_stats)
+                frontier.complete(page, len(page_products))
+                
+                if not page_products:
                     break
+                
+                products.extend(page_products)
+                frontier.collector.add(page_products)
+                self._report_progress('products_parsed', len(page_products))
+                
+                # Pausa periodica
+                if request_count % profile['max_requests_before_pause'] == 0:
+                    pause = random.uniform(*profile['pause_duration'])
+                    await asyncio.sleep(pause)
             
             # Marca successo
             if products:
@@ -1865,6 +4681,11 @@ class MasterOmniExtractor:
         
         return products
     
+    @staticmethod
+    def _response_head(response, size=20000):
+        """Inizio della pagina decodificato, senza decodificare tutta la risposta"""
+        return _decode_html(response.content[:size], response.encoding)
+    
     def _is_blocked(self, html):
         """Rileva se bloccati"""
         blocked_indicators = [
@@ -1876,140 +4697,24 @@ class MasterOmniExtractor:
         html_lower = html.lower()[:5000]  # Check solo inizio
         return any(indicator in html_lower for indicator in blocked_indicators)
     
-    def _parse_products_html(self, html, selectors):
-        """Parse prodotti da HTML"""
-        products = []
-        soup = BeautifulSoup(html, 'html.parser')
-        
-        for selector in selectors:
-            elements = soup.select(selector)[:100]
-            
-            for element in elements:
-                product = self._extract_product_from_element(element)
-                if product:
-                    products.append(product)
-            
-            if products:
-                break
-        
-        return products
-    
-    def _extract_product_from_element(self, element):
-        """Estrae dati prodotto da elemento HTML"""
-        try:
-            product = {}
-            
-            # Nome
-            name_selectors = [
-                '[itemprop="name"]', 'h1', 'h2', 'h3', 'h4',
-                '.product-name', '.title', 'a[href*="/product"]',
-                '.pip-header-section__title'  # IKEA
-            ]
-            
-            for selector in name_selectors:
-                elem = element.select_one(selector)
-                if elem:
-                    text = elem.get_text(strip=True)
-                    if text and len(text) > 3:
-                        product['name'] = text[:200]
-                        break
-            
-            if not product.get('name'):
-                return None
-            
-            # Prezzo
-            price_selectors = [
-                '[itemprop="price"]', '.price', '[data-price]',
-                'span[class*="price"]', '.cost',
-                '.pip-price__integer'  # IKEA
-            ]
-            
-            for selector in price_selectors:
-                elem = element.select_one(selector)
-                if elem:
-                    price = self._parse_price(elem.get_text())
-                    if price:
-                        product['price'] = price
-                        break
-            
-            # Brand
-            brand_selectors = [
-                '[itemprop="brand"]', '.brand', '.designer',
-                '[data-brand]'
-            ]
-            
-            for selector in brand_selectors:
-                elem = element.select_one(selector)
-                if elem:
-                    product['brand'] = elem.get_text(strip=True).upper()
-                    break
-            
-            # Immagine
-            img = element.select_one('img')
-            if img:
-                src = img.get('src') or img.get('data-src') or img.get('data-lazy')
-                if src:
-                    product['image_url'] = src if src.startswith('http') else f"https:{src}"
-            
-            # URL prodotto
-            link = element.select_one('a[href*="/product"], a[href*="/item"]')
-            if link:
-                product['url'] = link.get('href')
-            
-            # Categoria
-            product['category'] = self._detect_category(product['name'])
-            
-            # SKU
-            product['sku'] = f"LXB{hashlib.md5(product['name'].encode()).hexdigest()[:8].upper()}"
-            
-            return product
-            
-        except Exception as e:
-            return None
-    
     def _parse_price(self, text):
         """Parse prezzo da testo"""
-        if not text:
-            return None
-        
-        # Pulisci testo
-        text = re.sub(r'[^\d.,]', '', text)
-        text = text.replace(',', '.')
-        
-        try:
-            price = float(text)
-            if 10 <= price <= 50000:
-                return price
-        except:
-            pass
-        
-        return None
+        return self.html_parser.parse_price(text)
     
     def _detect_category(self, name):
         """Rileva categoria da nome"""
-        name_lower = name.lower()
-        
-        categories = {
-            'BORSE': ['bag', 'borsa', 'clutch', 'tote', 'backpack'],
-            'SCARPE': ['shoe', 'sneaker', 'boot', 'sandal', 'pump', 'loafer'],
-            'ABBIGLIAMENTO': ['dress', 'shirt', 'jacket', 'coat', 'pants', 'skirt'],
-            'ACCESSORI': ['belt', 'wallet', 'scarf', 'hat', 'sunglasses'],
-            'GIOIELLI': ['ring', 'necklace', 'bracelet', 'earring', 'watch'],
-            'MOBILI': ['chair', 'table', 'sofa', 'desk', 'bed', 'wardrobe'],
-            'ILLUMINAZIONE': ['lamp', 'light', 'chandelier', 'lampada']
-        }
-        
-        for category, keywords in categories.items():
-            if any(kw in name_lower for kw in keywords):
-                return category
-        
-        return 'LUXURY ITEM'
+        return self.html_parser.detect_category(name)
     
     async def _recovery_extraction(self, url, remaining):
         """Recovery con metodi alternativi"""
         # Implementa recovery se necessario
         return []
     
+    @staticmethod
+    def _product_key(product):
+        """Chiave unica del prodotto nel catalogo (nome + brand)"""
+        return f"{product.get('name', '')}_{product.get('brand', '')}"
+    
     def _process_and_deduplicate(self, products):
         """Processa e rimuove duplicati"""
         seen = {}
@@ -2017,229 +4722,1038 @@ class MasterOmniExtractor:
         
         for product in products:
             # Chiave unica
-            key = f"{product.get('name', '')}_{product.get('brand', '')}"
+            key = self._product_key(product)
             
             if key not in seen:
-                # Assicura campi necessari
+                # Assicura campi necessari (derivati dalla chiave: stabili tra un'estrazione e l'altra)
+                digest = hashlib.sha1(key.encode()).hexdigest()
                 if not product.get('price'):
-                    product['price'] = random.randint(200, 2000)
+                    product['price'] = 200 + int(digest[:8], 16) % 1801
                 
                 if not product.get('sku'):
-                    product['sku'] = f"LXB{uuid.uuid4().hex[:8].upper()}"
+                    product['sku'] = f"LXB{digest[8:16].upper()}"
                 
                 seen[key] = product
                 unique.append(product)
             else:
-                # Mergia dati migliori
-                existing = seen[key]
-                for field in ['image_url', 'brand', 'category', 'sizes']:
-                    if not existing.get(field) and product.get(field):
-                        existing[field] = product[field]
-        
-        return unique
+                # Mergia dati migliori
+                existing = seen[key]
+                for field in ['image_url', 'brand', 'category', 'sizes']:
+                    if not existing.get(field) and product.get(field):
+                        existing[field] = product[field]
+        
+        return unique
+
+# ==========================================
+#  PRODUCT IMAGE PIPELINE
+# ==========================================
+
+def _is_public_ip(host):
+    """Indirizzo IP instradabile su Internet (no loopback, rete privata, link-local, metadata)"""
+    try:
+        address = ipaddress.ip_address(host.split('%', 1)[0])
+    except ValueError:
+        return False
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return address.is_global and not address.is_multicast
+
+class PublicOnlyResolver(aiohttp.ThreadedResolver):
+    """Resolver che scarta gli indirizzi non pubblici: vale per ogni connessione, redirect compresi"""
+    
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        hosts = [entry for entry in await super().resolve(host, port, family) if _is_public_ip(entry['host'])]
+        if not hosts:
+            raise OSError(f"{host} resolves to non-public addresses only")
+        return hosts
+
+class ProductImagePipeline:
+    """
+    Miniature delle immagini prodotto per gli export: download concorrente
+    (limite globale e per host), decodifica ridotta nel pool di processi,
+    cache per contenuto (sha256 dell'immagine originale) con tetto in byte
+    e retention LRU. URL già visti non vengono riscaricati per IMAGE_URL_TTL,
+    quelli falliti per IMAGE_FAILED_TTL
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS image_urls (
+            url TEXT PRIMARY KEY,
+            digest TEXT NOT NULL,
+            checked_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            accessed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_thumbnails_accessed ON thumbnails (accessed_at);
+    """
+    
+    HEADERS = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+                      '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8'
+    }
+    
+    EVICT_INTERVAL = 10
+    
+    def __init__(self, path, max_bytes, size, pool):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = size
+        self.pool = pool
+        self.index = SharedSQLiteStore(os.path.join(path, 'index.db'), self.SCHEMA)
+        self.stats = Counter()
+        self.last_evict = 0
+    
+    def thumb_path(self, digest):
+        return os.path.join(self.path, digest[:2], f"{digest}.jpg")
+    
+    async def thumbnails(self, urls, host_failures=None):
+        """
+        url -> percorso della miniatura per gli URL disponibili (cache o
+        download entro IMAGE_BLOCK_TIMEOUT); gli altri restano senza immagine.
+        host_failures: fallimenti per host condivisi tra i blocchi di un export
+        """
+        urls = list(dict.fromkeys(url for url in urls if url and url.startswith(('http://', 'https://'))))
+        if not urls:
+            return {}
+        
+        now = time.time()
+        found = {}
+        to_fetch = []
+        known = self._lookup(urls)
+        
+        for url in urls:
+            digest, checked_at = known.get(url, (None, 0))
+            if digest and now - checked_at < OmniSystemConfig.IMAGE_URL_TTL and os.path.exists(self.thumb_path(digest)):
+                found[url] = digest
+                self.stats['hits'] += 1
+            elif digest == '' and now - checked_at < OmniSystemConfig.IMAGE_FAILED_TTL:
+                self.stats['skipped'] += 1
+            else:
+                to_fetch.append(url)
+        
+        if to_fetch:
+            fetched = await self._fetch_all(to_fetch, Counter() if host_failures is None else host_failures)
+            self.index.executemany(
+                'INSERT OR REPLACE INTO image_urls (url, digest, checked_at) VALUES (?, ?, ?)',
+                [(url, digest or '', now) for url, digest in fetched.items()]
+            )
+            found.update((url, digest) for url, digest in fetched.items() if digest)
+        
+        if found:
+            self.index.executemany(
+                'UPDATE thumbnails SET accessed_at = ? WHERE digest = ?',
+                [(now, digest) for digest in set(found.values())]
+            )
+        self._maybe_evict()
+        
+        return {url: self.thumb_path(digest) for url, digest in found.items()}
+    
+    def _lookup(self, urls):
+        """url -> (digest, checked_at) dall'indice ('' = download fallito)"""
+        known = {}
+        for start in range(0, len(urls), 500):
+            batch = urls[start:start + 500]
+            rows = self.index.execute(
+                f"SELECT url, digest, checked_at FROM image_urls WHERE url IN ({','.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+            known.update((url, (digest, checked_at)) for url, digest, checked_at in rows)
+        return known
+    
+    async def _fetch_all(self, urls, host_failures):
+        """url -> digest (None = fallito, anche se non completato nel budget)"""
+        connector = aiohttp.TCPConnector(
+            limit=OmniSystemConfig.IMAGE_FETCH_CONCURRENCY,
+            limit_per_host=OmniSystemConfig.IMAGE_FETCH_PER_HOST,
+            ttl_dns_cache=OmniSystemConfig.HTTP_DNS_CACHE_TTL,
+            resolver=PublicOnlyResolver()
+        )
+        timeout = aiohttp.ClientTimeout(total=OmniSystemConfig.IMAGE_FETCH_TIMEOUT)
+        semaphore = asyncio.Semaphore(OmniSystemConfig.IMAGE_FETCH_CONCURRENCY)
+        results = {}
+        
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.HEADERS) as session:
+            tasks = {
+                asyncio.ensure_future(self._fetch_one(session, semaphore, host_failures, url, results)): url
+                for url in urls
+            }
+            done, pending = await asyncio.wait(tasks, timeout=OmniSystemConfig.IMAGE_BLOCK_TIMEOUT)
+            
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+                # Fallimento in cache: gli export successivi non li riaspettano per IMAGE_FAILED_TTL
+                for task in pending:
+                    results.setdefault(tasks[task], None)
+                self.stats['timed_out'] += len(pending)
+                logger.warning(f"Image stage budget exceeded: {len(pending)}/{len(urls)} images skipped")
+        
+        return results
+    
+    async def _fetch_one(self, session, semaphore, host_failures, url, results):
+        """Scarica un'immagine e ne crea la miniatura (se non già in cache)"""
+        host = urlparse(url).netloc
+        
+        async with semaphore:
+            # Host che continua a fallire: saltato per il resto dell'export
+            if host_failures[host] >= OmniSystemConfig.IMAGE_HOST_MAX_FAILURES:
+                self.stats['host_skipped'] += 1
+                return
+            
+            data = await self._download(session, url)
+            if data is None:
+                host_failures[host] += 1
+                results[url] = None
+                return
+            host_failures[host] = 0
+            
+            digest = hashlib.sha256(data).hexdigest()
+            path = self.thumb_path(digest)
+            
+            if os.path.exists(path):
+                self.stats['deduplicated'] += 1
+            else:
+                thumbnail = await self.pool.make_thumbnail(data, self.size)
+                if thumbnail is None:
+                    results[url] = None
+                    self.stats['undecodable'] += 1
+                    return
+                self._write_thumbnail(digest, thumbnail)
+            
+            self.stats['fetched'] += 1
+            results[url] = digest
+    
+    @staticmethod
+    def _allowed_url(url):
+        """
+        URL scaricabile: http(s) e, se l'host è un IP, solo pubblico. I nomi
+        sono controllati dal resolver (gli IP letterali non passano di lì)
+        """
+        parsed = urlparse(url)
+        if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+            return False
+        
+        try:
+            ipaddress.ip_address(parsed.hostname.split('%', 1)[0])
+        except ValueError:
+            return True
+        return _is_public_ip(parsed.hostname)
+    
+    async def _download(self, session, url):
+        """
+        Byte dell'immagine o None (errore, non immagine, oltre
+        IMAGE_MAX_SOURCE_BYTES, host non pubblico). I redirect sono seguiti
+        a mano per controllare ogni destinazione
+        """
+        limit = OmniSystemConfig.IMAGE_MAX_SOURCE_BYTES
+        
+        try:
+            for _ in range(OmniSystemConfig.IMAGE_MAX_REDIRECTS + 1):
+                if not self._allowed_url(url):
+                    self.stats['rejected'] += 1
+                    return None
+                
+                async with session.get(url, allow_redirects=False) as response:
+                    if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                        url = urljoin(url, response.headers['Location'])
+                        continue
+                    return await self._read_image(response, limit)
+            
+            return None
+        
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+            logger.debug(f"Image download failed {url}: {e}")
+            return None
+    
+    @staticmethod
+    async def _read_image(response, limit):
+        if response.status != 200 or (response.content_length or 0) > limit:
+            return None
+        if response.content_type and response.content_type.startswith(('text/', 'application/json')):
+            return None
+        
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(64 * 1024):
+            data += chunk
+            if len(data) > limit:
+                return None
+        return bytes(data)
+    
+    def _write_thumbnail(self, digest, thumbnail):
+        """Scrittura atomica del file e registrazione nell'indice"""
+        path = self.thumb_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(thumbnail)
+        os.replace(tmp_path, path)
+        
+        self.index.execute(
+            'INSERT OR REPLACE INTO thumbnails (digest, size, accessed_at) VALUES (?, ?, ?)',
+            (digest, len(thumbnail), time.time())
+        )
+    
+    def _maybe_evict(self):
+        """LRU: oltre max_bytes rimuove le miniature meno usate fino al 90%"""
+        now = time.time()
+        if now - self.last_evict < self.EVICT_INTERVAL:
+            return
+        self.last_evict = now
+        
+        total = self.index.execute('SELECT COALESCE(SUM(size), 0) FROM thumbnails').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        rows = self.index.execute('SELECT digest, size FROM thumbnails ORDER BY accessed_at').fetchall()
+        
+        for digest, size in rows:
+            if freed >= target:
+                break
+            try:
+                os.remove(self.thumb_path(digest))
+            except OSError:
+                pass
+            self.index.execute('DELETE FROM thumbnails WHERE digest = ?', (digest,))
+            freed += size
+            self.stats['evicted'] += 1
+    
+    def info(self):
+        return dict(self.stats)
+
+product_image_pipeline = ProductImagePipeline(
+    os.path.join(OmniSystemConfig.TEMP_PATH, 'thumbs'),
+    OmniSystemConfig.IMAGE_CACHE_MAX_BYTES,
+    OmniSystemConfig.IMAGE_THUMB_SIZE,
+    export_pool
+)
+
+# ==========================================
+#  STREAMING XLSX
+# ==========================================
+
+class ChunkQueueWriter:
+    """
+    File-like non seekable per gli export in streaming: i byte scritti
+    sono raggruppati in chunk su una coda limitata, letta dalla risposta
+    HTTP. Coda piena = il produttore aspetta; client chiuso = la write
+    successiva solleva BrokenPipeError e il produttore si ferma (le
+    scritture dopo, es. la chiusura degli zip, vengono scartate).
+    Errore del produttore o nessun chunk entro idle_timeout = l'iterazione
+    solleva e il server interrompe la risposta (niente file troncato)
+    """
+    
+    def __init__(self, chunk_size, max_chunks, idle_timeout=None):
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue(maxsize=max_chunks)
+        self.buffer = bytearray()
+        self.closed_by_client = threading.Event()
+        self.cancelled = False
+        self.bytes_written = 0
+    
+    def write(self, data):
+        if self.closed_by_client.is_set():
+            self._cancel()
+            return len(data)
+        
+        self.buffer += data
+        self.bytes_written += len(data)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+        return len(data)
+    
+    def flush(self):
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer.clear()
+    
+    def finish(self, error=None):
+        """Fine dello stream (error: interrotto lato produttore)"""
+        try:
+            if error is None:
+                self.flush()
+            self._put(error)
+        except BrokenPipeError:
+            pass
+    
+    def _cancel(self):
+        """BrokenPipeError solo la prima volta"""
+        if not self.cancelled:
+            self.cancelled = True
+            raise BrokenPipeError('export stream closed by client')
+    
+    def _put(self, item):
+        while True:
+            if self.closed_by_client.is_set():
+                self._cancel()
+                return
+            try:
+                self.queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+    
+    def __iter__(self):
+        """Chunk per la risposta HTTP; chiusa dal client = ferma il produttore"""
+        try:
+            while True:
+                try:
+                    item = self.queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    # Non OSError: il server lo tratterebbe come client disconnesso e lascerebbe la connessione appesa
+                    raise RuntimeError(f'export stream idle for {self.idle_timeout}s') from None
+                if item is None:
+                    return
+                if isinstance(item, BaseException):
+                    # Connessione interrotta senza chunk finale: il client vede il download fallito
+                    raise RuntimeError('export stream failed') from item
+                yield item
+        finally:
+            self.close()
+    
+    def close(self):
+        """Chiamata dal server a fine risposta (anche se mai iterata)"""
+        self.closed_by_client.set()
+
+StyledValue = namedtuple('StyledValue', ['value', 'style'])
+
+class XlsxStreamWriter:
+    """
+    Workbook xlsx a un foglio scritto in streaming su un file-like anche
+    non seekable (zip con data descriptor): parti statiche subito, righe
+    del foglio in XML man mano che arrivano (stringhe inline, niente
+    shared strings) e nessun file temporaneo
+    """
+    
+    XML_HEADER = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    SHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+    REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+    PKG_REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+    
+    CONTENT_TYPES = (
+        XML_HEADER +
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    )
+    
+    ROOT_RELS = (
+        XML_HEADER +
+        f'<Relationships xmlns="{PKG_REL_NS}">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    )
+    
+    WORKBOOK_RELS = (
+        XML_HEADER +
+        f'<Relationships xmlns="{PKG_REL_NS}">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/>'
+        '<Relationship Id="rId2" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+        'Target="styles.xml"/>'
+        '</Relationships>'
+    )
+    
+    # Caratteri non ammessi in XML 1.0
+    ILLEGAL_XML_RE = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+    
+    ROWS_PER_WRITE = 200
+    
+    def __init__(self, fileobj, sheet_title, column_widths, styles):
+        """styles: [(nome, spec)] con spec: bold, size, color, fill, border, center, num_format"""
+        self.style_ids = {name: index for index, (name, _) in enumerate(styles, 1)}
+        self.rows = 0
+        self.pending = []
+        
+        self.zip = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+        self.zip.writestr('[Content_Types].xml', self.CONTENT_TYPES)
+        self.zip.writestr('_rels/.rels', self.ROOT_RELS)
+        self.zip.writestr('xl/workbook.xml', self._workbook_xml(sheet_title))
+        self.zip.writestr('xl/_rels/workbook.xml.rels', self.WORKBOOK_RELS)
+        self.zip.writestr('xl/styles.xml', self._styles_xml(styles))
+        
+        self.sheet = self.zip.open('xl/worksheets/sheet1.xml', 'w', force_zip64=True)
+        cols = ''.join(
+            f'<col min="{index}" max="{index}" width="{width}" customWidth="1"/>'
+            for index, width in sorted(
+                (self._column_index(letter), width) for letter, width in column_widths.items()
+            )
+        )
+        self.sheet.write(
+            f'{self.XML_HEADER}<worksheet xmlns="{self.SHEET_NS}" xmlns:r="{self.REL_NS}">'
+            f'<cols>{cols}</cols><sheetData>'.encode()
+        )
+    
+    def cell(self, value, style_name):
+        """Valore con stile (indice dello stile registrato)"""
+        return StyledValue(value, self.style_ids[style_name])
+    
+    def append(self, row):
+        self.rows += 1
+        number = self.rows
+        cells = []
+        
+        for col, value in enumerate(row, 1):
+            style = ''
+            if isinstance(value, StyledValue):
+                style = f' s="{value.style}"'
+                value = value.value
+            
+            if value is None:
+                if style:
+                    cells.append(f'<c r="{get_column_letter(col)}{number}"{style}/>')
+                continue
+            
+            ref = f'{get_column_letter(col)}{number}'
+            if isinstance(value, bool):
+                cells.append(f'<c r="{ref}"{style} t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, int):
+                cells.append(f'<c r="{ref}"{style} t="n"><v>{value}</v></c>')
+            elif isinstance(value, float) and value - value == 0:
+                # Stessa precisione di openpyxl; float non finiti (nan, inf) finiscono come testo
+                cells.append(f'<c r="{ref}"{style} t="n"><v>{value:.16g}</v></c>')
+            else:
+                cells.append(
+                    f'<c r="{ref}"{style} t="inlineStr"><is><t xml:space="preserve">'
+                    f'{self._escape(str(value))}</t></is></c>'
+                )
+        
+        self.pending.append(f'<row r="{number}">{"".join(cells)}</row>')
+        if len(self.pending) >= self.ROWS_PER_WRITE:
+            self.flush()
+    
+    def flush(self):
+        """Scrive le righe in attesa nel foglio"""
+        if self.pending:
+            self.sheet.write(''.join(self.pending).encode())
+            self.pending.clear()
+    
+    def close(self):
+        self.flush()
+        self.sheet.write(b'</sheetData></worksheet>')
+        self.sheet.close()
+        self.zip.close()
+    
+    def abort(self):
+        """Chiusura dopo un errore: lo stream resta comunque troncato"""
+        try:
+            self.sheet.close()
+            self.zip.close()
+        except Exception:
+            pass
+    
+    @classmethod
+    def _escape(cls, text):
+        text = cls.ILLEGAL_XML_RE.sub('', text)
+        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+    
+    @staticmethod
+    def _column_index(letter):
+        index = 0
+        for char in letter:
+            index = index * 26 + ord(char) - 64
+        return index
+    
+    def _workbook_xml(self, sheet_title):
+        return (
+            f'{self.XML_HEADER}<workbook xmlns="{self.SHEET_NS}" xmlns:r="{self.REL_NS}"><sheets>'
+            f'<sheet name="{self._escape(sheet_title[:31])}" sheetId="1" r:id="rId1"/>'
+            '</sheets></workbook>'
+        )
+    
+    def _styles_xml(self, styles):
+        """Stili minimi: font, fill, bordi e formati numerici usati dagli stili registrati"""
+        fonts = ['<font><sz val="11"/><name val="Calibri"/></font>']
+        fills = ['<fill><patternFill patternType="none"/></fill>', '<fill><patternFill patternType="gray125"/></fill>']
+        borders = ['<border><left/><right/><top/><bottom/><diagonal/></border>']
+        num_formats = []
+        xfs = ['<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>']
+        
+        for _, spec in styles:
+            font_id = fill_id = border_id = num_format_id = 0
+            
+            if spec.get('bold') or spec.get('color') or spec.get('size'):
+                font_id = len(fonts)
+                bold = '<b/>' if spec.get('bold') else ''
+                color = f'<color rgb="FF{spec["color"]}"/>' if spec.get('color') else ''
+                fonts.append(f'<font>{bold}<sz val="{spec.get("size", 11)}"/>{color}<name val="Calibri"/></font>')
+            if spec.get('fill'):
+                fill_id = len(fills)
+                fills.append(f'<fill><patternFill patternType="solid"><fgColor rgb="FF{spec["fill"]}"/></patternFill></fill>')
+            if spec.get('border'):
+                border_id = len(borders)
+                borders.append(
+                    '<border><left style="thin"/><right style="thin"/><top style="thin"/>'
+                    '<bottom style="thin"/><diagonal/></border>'
+                )
+            if spec.get('num_format'):
+                num_format_id = 164 + len(num_formats)
+                num_formats.append(f'<numFmt numFmtId="{num_format_id}" formatCode="{self._escape(spec["num_format"])}"/>')
+            
+            flags = [
+                name for name, enabled in (
+                    ('applyNumberFormat', num_format_id), ('applyFont', font_id),
+                    ('applyFill', fill_id), ('applyBorder', border_id), ('applyAlignment', spec.get('center'))
+                ) if enabled
+            ]
+            attrs = ''.join(f' {name}="1"' for name in flags)
+            xf = f'<xf numFmtId="{num_format_id}" fontId="{font_id}" fillId="{fill_id}" borderId="{border_id}" xfId="0"{attrs}'
+            if spec.get('center'):
+                xf += '><alignment horizontal="center" vertical="center"/></xf>'
+            else:
+                xf += '/>'
+            xfs.append(xf)
+        
+        return (
+            f'{self.XML_HEADER}<styleSheet xmlns="{self.SHEET_NS}">'
+            + (f'<numFmts count="{len(num_formats)}">{"".join(num_formats)}</numFmts>' if num_formats else '')
+            + f'<fonts count="{len(fonts)}">{"".join(fonts)}</fonts>'
+            f'<fills count="{len(fills)}">{"".join(fills)}</fills>'
+            f'<borders count="{len(borders)}">{"".join(borders)}</borders>'
+            '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+            f'<cellXfs count="{len(xfs)}">{"".join(xfs)}</cellXfs>'
+            '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+            '</styleSheet>'
+        )
+
+# Thread produttori degli export in streaming (ognuno con il proprio event loop)
+export_stream_executor = ThreadPoolExecutor(
+    max_workers=OmniSystemConfig.EXPORT_STREAM_WORKERS,
+    thread_name_prefix='export-stream'
+)
+
+# Un posto per produttore: oltre, i download vengono rifiutati invece di restare in coda
+export_stream_slots = threading.BoundedSemaphore(OmniSystemConfig.EXPORT_STREAM_WORKERS)
 
 # ==========================================
 #  PROFESSIONAL EXCEL GENERATOR OMNISYSTEM
 # ==========================================
 
+class SizeGridLayout:
+    """
+    Colonne taglie del layout pubblico compilate una volta per processo:
+    per categoria la maschera (indici delle colonne rilevanti) e il
+    vettore base della riga, copiato e completato con le quantità
+    """
+    
+    def __init__(self, unique_sizes, first_col, size_limit):
+        self.unique_sizes = unique_sizes
+        # Colonne oltre size_limit restano vuote (spazio per AI Score, Competitor, Note)
+        self.base = [0 if col < size_limit else None for col in range(first_col, first_col + len(unique_sizes))]
+        self.masks = {}
+    
+    def mask(self, category):
+        """Indici (in ordine di colonna) delle taglie della categoria"""
+        mask = self.masks.get(category)
+        if mask is None:
+            relevant = {str(s) for s in product_classifier.sizes_for_category(category)}
+            mask = self.masks[category] = tuple(
+                i for i, size in enumerate(self.unique_sizes)
+                if size in relevant and self.base[i] is not None
+            )
+        return mask
+    
+    def row(self, category):
+        """Blocco taglie della riga: quantità casuali solo sulle colonne della maschera"""
+        values = self.base.copy()
+        for i in self.mask(category):
+            values[i] = random.randint(0, 10)
+        return values
+
 class OmniSystemExcelGenerator:
     """
     Generatore Excel professionale omnisystem definitivo
     """
     
-    def __init__(self):
+    # 'b2b_portal' / 'public' -> (headers, SizeGridLayout o None), calcolati una volta per processo
+    _layouts = {}
+    
+    # Parte del digest degli export in cache: da cambiare quando cambia il contenuto dei file
+    GENERATOR_VERSION = 'v10.0-2'
+    
+    def __init__(self, progress=None):
         self.ai_engine = EnhancedCompetitorIntelligenceAI()
+        self.part_pool = export_pool
+        self.export_cache = export_file_cache
+        self.images = product_image_pipeline
+        self.progress = progress
     
-    async def generate_omnisystem_excel(self, products, portal_type='public', user=None):
+    async def generate_omnisystem_excel(self, products, portal_type='public', user=None, products_count=None):
         """
-        Genera Excel omnisystem con tutti i dati
+        Genera Excel omnisystem con tutti i dati.
+        products può essere un iterabile (es. result set in streaming):
+        in quel caso products_count va passato esplicitamente.
+        Se products è rileggibile (lista, StoredProducts) un export
+        identico già generato viene riusato dalla cache
         """
         
+        if products_count is None:
+            products_count = len(products)
+        
+        cache_key, cached = self.cached_export(products, portal_type, user)
+        if cached:
+            logger.info(f"Excel export cache hit: {cached['filename']} ({products_count} products)")
+            return cached
+        
         logger.info(f"""
          GENERATING OMNISYSTEM EXCEL
         ╔══════════════════════════════════════════════╗
-         Products: {len(products)}
+         Products: {products_count}
          Type: {portal_type}
          User: {user.email if user else 'Anonymous'}
         ╚══════════════════════════════════════════════╝
         """)
         
         # Split se necessario
-        if len(products) > OmniSystemConfig.EXCEL_SPLIT_AT:
-            return await self._generate_multi_file(products, portal_type, user)
+        if products_count > OmniSystemConfig.EXCEL_SPLIT_AT:
+            result = await self._generate_multi_file(products, portal_type, user)
         else:
-            return await self._generate_single_file(products, portal_type, user)
-    
-    async def _generate_single_file(self, products, portal_type, user):
-        """Genera singolo Excel"""
+            result = await self._generate_single_file(products, portal_type, user)
         
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "LUXLAB OMNISYSTEM CATALOG"
+        if cache_key:
+            # Con AI analysis l'export vale quanto la cache delle analisi
+            ttl = OmniSystemConfig.AI_CACHE_TTL if self._include_ai(user) else None
+            self.export_cache.store(cache_key, result, ttl)
         
-        # Headers professionali
+        return result
+    
+    def cached_export(self, products, portal_type='public', user=None):
+        """
+        (digest, export già generato o None). Digest solo su iterabili
+        rileggibili (lista, StoredProducts): un iteratore verrebbe consumato
+        """
+        if not self.export_cache or iter(products) is products:
+            return None, None
+        
+        cache_key = self.export_cache.digest(
+            products, portal_type, self._plan_features(user), self.GENERATOR_VERSION,
+            datetime.now().strftime('%y%m')  # prefisso STG delle righe
+        )
+        return cache_key, self.export_cache.lookup(cache_key)
+    
+    # Stili header per sezione (colonna massima inclusa, nome stile, colore)
+    HEADER_SECTIONS = [
+        (5, 'lxb_header_base', '2C3E50'),       # Info base
+        (10, 'lxb_header_details', '34495E'),   # Product details
+        (13, 'lxb_header_pricing', '27AE60'),   # Pricing
+        (None, 'lxb_header_extra', '8E44AD')    # Sizes + AI + Notes
+    ]
+    
+    COLUMN_WIDTHS = {
+        'A': 15, 'B': 18, 'C': 8, 'D': 22, 'E': 12,
+        'F': 18, 'G': 10, 'H': 35, 'I': 18, 'J': 15,
+        'K': 15, 'L': 20, 'M': 12, 'N': 12, 'O': 10
+    }
+    
+    def _excel_layout(self, portal_type):
+        """Headers e griglia taglie per tipo portale (in cache per processo)"""
+        key = 'b2b_portal' if portal_type == 'b2b_portal' else 'public'
+        layout = self._layouts.get(key)
+        if layout is None:
+            headers, unique_sizes = self._excel_headers(key)
+            size_grid = SizeGridLayout(unique_sizes, 14, len(headers) - 3) if unique_sizes else None
+            layout = self._layouts[key] = (headers, size_grid)
+        return layout
+    
+    def _excel_headers(self, portal_type):
+        """Headers e colonne taglie per tipo portale"""
         if portal_type == 'b2b_portal':
             headers = [
                 'SKU/Codice', 'Brand', 'Nome Prodotto', 'Categoria',
                 'Prezzo Wholesale', 'Prezzo Retail', 'Margine %',
                 'Taglie', 'Quantità', 'Immagine', 'AI Analysis', 'Note'
             ]
+            return headers, []
+        
+        headers = [
+            'STG', 'MACRO', 'Gender', 'Categoria', 'Foto',
+            'SKU', 'Collezione', 'Modello', 'Colore',
+            'Prezzo Retail', 'Prezzo Proposto', 'Sconto %',
+            'Quantità'
+        ]
+        
+        # Aggiungi colonne taglie
+        all_sizes = []
+        for size_list in OmniSystemConfig.ALL_SIZES.values():
+            all_sizes.extend(str(s) for s in size_list)
+        
+        unique_sizes = list(dict.fromkeys(all_sizes))[:50]  # Limita a 50 colonne
+        headers.extend(unique_sizes)
+        headers.extend(['AI Score', 'Competitor', 'Note'])
+        
+        return headers, unique_sizes
+    
+    def _register_named_styles(self, wb):
+        """Registra una sola volta gli stili condivisi del workbook"""
+        thin = Side(style='thin')
+        border = Border(left=thin, right=thin, top=thin, bottom=thin)
+        
+        for _, style_name, color in self.HEADER_SECTIONS:
+            style = NamedStyle(name=style_name)
+            style.font = Font(bold=True, size=11, color='FFFFFF')
+            style.fill = PatternFill('solid', fgColor=color)
+            style.alignment = Alignment(horizontal='center', vertical='center')
+            style.border = border
+            wb.add_named_style(style)
+        
+        wb.add_named_style(NamedStyle(name='lxb_currency', number_format='€#,##0.00'))
+        
+        total_label = NamedStyle(name='lxb_total_label')
+        total_label.font = Font(bold=True, size=12, color='E74C3C')
+        wb.add_named_style(total_label)
+    
+    def _header_style(self, col):
+        """Nome dello stile header per colonna"""
+        for max_col, style_name, _ in self.HEADER_SECTIONS:
+            if max_col is None or col <= max_col:
+                return style_name
+    
+    def _styled(self, ws, value, style_name):
+        """Cella write-only con stile condiviso"""
+        if isinstance(ws, XlsxStreamWriter):
+            return ws.cell(value, style_name)
+        
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style_name
+        return cell
+    
+    @staticmethod
+    def _row_note(product, note):
+        """Nota di riga; negli export delta riporta lo stato (NEW, CHANGED, REMOVED)"""
+        status = product.get('delta_status')
+        return f"{status.upper()} - {note}" if status else note
+    
+    def _build_b2b_row(self, ws, product, idx, ai_analysis):
+        """Riga B2B completa: (valori, retail, proposto)"""
+        wholesale = product.get('wholesale_price', product.get('price', 0))
+        retail = wholesale * 2.2
+        margin = ((retail - wholesale) / retail * 100) if retail > 0 else 0
+        
+        row = [
+            product.get('sku', f'SKU{idx:06d}'),
+            product.get('brand', 'BRAND'),
+            product.get('name', ''),
+            product.get('category', 'PRODUCT'),
+            self._styled(ws, wholesale, 'lxb_currency'),
+            self._styled(ws, retail, 'lxb_currency'),
+            f"{margin:.1f}%",
+            product.get('sizes', ''),
+            product.get('quantity', ''),
+            '️' if product.get('image_url') else '-',
+            f"{ai_analysis.get('confidence_score', 0)}%" if ai_analysis else 'N/A',
+            self._row_note(product, 'B2B Import')
+        ]
+        
+        return row, retail, 0
+    
+    def _build_public_row(self, ws, product, idx, ai_analysis, size_grid, stg_prefix):
+        """Riga formato pubblico completa: (valori, retail, proposto)"""
+        name = product.get('name', '')
+        
+        # Pricing
+        retail = product.get('price', 500)
+        
+        if ai_analysis and ai_analysis.get('recommended_strategy'):
+            margin = ai_analysis['recommended_strategy'].get('target_margin', 45) / 100
         else:
-            headers = [
-                'STG', 'MACRO', 'Gender', 'Categoria', 'Foto',
-                'SKU', 'Collezione', 'Modello', 'Colore',
-                'Prezzo Retail', 'Prezzo Proposto', 'Sconto %',
-                'Quantità'
-            ]
+            margin = 0.45
+        
+        proposed = retail * (1 - margin)
+        
+        row = [
+            f"{stg_prefix}{idx:05d}",
+            product.get('brand', 'LUXURY'),
+            self._detect_gender(name),
+            product.get('category', 'ITEM'),
+            '️' if product.get('image_url') else '-',
+            product.get('sku'),
+            'FW24',
+            name[:50],
+            self._detect_color(name),
+            self._styled(ws, retail, 'lxb_currency'),
+            self._styled(ws, proposed, 'lxb_currency'),
+            f"{margin*100:.0f}%",
+            random.randint(5, 50)
+        ]
+        
+        # Taglie: vettore precompilato per categoria (lascia spazio per AI Score, Competitor, Note)
+        row.extend(size_grid.row(product.get('category', 'ABBIGLIAMENTO')))
+        
+        # AI Score + Competitor info
+        if ai_analysis:
+            row.append(f"{ai_analysis.get('confidence_score', 0)}%")
+            if ai_analysis.get('competitor_prices'):
+                row.append(f"{len(ai_analysis['competitor_prices'])} sites")
+            else:
+                row.append(None)
+        else:
+            row.extend([None, None])
+        
+        # Note
+        row.append(self._row_note(product, "AI Enhanced" if ai_analysis else "Standard"))
+        
+        return row, retail, proposed
+    
+    async def _iter_with_analysis(self, products, include_ai, include_images=False):
+        """
+        Scorre i prodotti a blocchi di AI_BATCH_SIZE: per ogni blocco l'AI
+        analysis gira in batch (deduplicata), le miniature vengono preparate
+        in parallelo e poi vengono emesse le righe come (idx, prodotto,
+        analisi). Con miniatura il prodotto è una copia con image_thumbnail
+        """
+        products_iter = iter(products)
+        idx = 0
+        host_failures = Counter()  # host che falliscono: saltati per tutto l'export, non solo nel blocco
+        
+        while True:
+            block = list(islice(products_iter, OmniSystemConfig.AI_BATCH_SIZE))
+            if not block:
+                break
+            
+            thumbnails_task = None
+            if include_images:
+                thumbnails_task = asyncio.ensure_future(self.images.thumbnails(
+                    (product.get('image_url') for product in block if isinstance(product.get('image_url'), str)),
+                    host_failures
+                ))
+            
+            # AI Analysis solo per prodotti con brand
+            analyses = {}
+            if include_ai:
+                targets = [i for i, product in enumerate(block) if product.get('brand')]
+                if targets:
+                    results = await self.ai_engine.analyze_market_batch([block[i] for i in targets])
+                    analyses = dict(zip(targets, results))
             
-            # Aggiungi colonne taglie
-            all_sizes = []
-            for size_list in OmniSystemConfig.ALL_SIZES.values():
-                all_sizes.extend(str(s) for s in size_list)
-            
-            unique_sizes = list(dict.fromkeys(all_sizes))[:50]  # Limita a 50 colonne
-            headers.extend(unique_sizes)
-            headers.extend(['AI Score', 'Competitor', 'Note'])
-        
-        # Stile headers
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = Font(bold=True, size=11, color='FFFFFF')
-            
-            # Color coding per sezioni
-            if col <= 5:  # Info base
-                cell.fill = PatternFill('solid', fgColor='2C3E50')
-            elif col <= 10:  # Product details
-                cell.fill = PatternFill('solid', fgColor='34495E')
-            elif col <= 13:  # Pricing
-                cell.fill = PatternFill('solid', fgColor='27AE60')
-            else:  # Sizes + AI + Notes
-                cell.fill = PatternFill('solid', fgColor='8E44AD')
-            
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-            cell.border = Border(
-                left=Side(style='thin'), right=Side(style='thin'),
-                top=Side(style='thin'), bottom=Side(style='thin')
+            thumbnails = await thumbnails_task if thumbnails_task else {}
+            
+            # Classificazione dei nomi del blocco (gender, colore) fuori dal ciclo delle righe
+            product_classifier.classify_many(product.get('name', '') for product in block)
+            
+            for i, product in enumerate(block):
+                idx += 1
+                image_url = product.get('image_url')
+                if isinstance(image_url, str) and image_url in thumbnails:
+                    product = dict(product, image_thumbnail=thumbnails[image_url])
+                yield idx, product, analyses.get(i)
+    
+    @staticmethod
+    def _include_ai(user):
+        """AI analysis inclusa se il piano dell'utente la prevede"""
+        return bool(user and user.get_plan_limits().get('competitor_analysis', False))
+    
+    @staticmethod
+    def _include_images(user):
+        """Miniature nel foglio se il piano dell'utente le prevede"""
+        return bool(user and user.get_plan_limits().get('images', False))
+    
+    @classmethod
+    def _plan_features(cls, user):
+        """Feature del piano che cambiano il contenuto dell'export"""
+        return {'competitor_analysis': cls._include_ai(user), 'images': cls._include_images(user)}
+    
+    def _new_sheet(self, portal_type):
+        """Workbook write_only con stili, larghezze e headers: (wb, ws, griglia taglie)"""
+        wb = Workbook(write_only=True)
+        self._register_named_styles(wb)
+        ws = wb.create_sheet("LUXLAB OMNISYSTEM CATALOG")
+        
+        headers, size_grid = self._excel_layout(portal_type)
+        
+        # Column widths (in write_only vanno impostate prima delle righe)
+        for col_letter, width in self.COLUMN_WIDTHS.items():
+            ws.column_dimensions[col_letter].width = width
+        
+        # Headers professionali
+        ws.append([
+            self._styled(ws, header, self._header_style(col))
+            for col, header in enumerate(headers, 1)
+        ])
+        
+        return wb, ws, size_grid
+    
+    def _append_product(self, ws, portal_type, size_grid, stg_prefix, idx, product, ai_analysis, row_number=None):
+        """Scrive la riga del prodotto (row_number: per ancorare la miniatura): (retail, proposto)"""
+        if portal_type == 'b2b_portal':
+            row, retail, proposed = self._build_b2b_row(ws, product, idx, ai_analysis)
+        else:
+            row, retail, proposed = self._build_public_row(
+                ws, product, idx, ai_analysis, size_grid, stg_prefix
             )
         
-        # Column widths
-        column_widths = {
-            'A': 15, 'B': 18, 'C': 8, 'D': 22, 'E': 12,
-            'F': 18, 'G': 10, 'H': 35, 'I': 18, 'J': 15,
-            'K': 15, 'L': 20, 'M': 12, 'N': 12, 'O': 10
-        }
+        if row_number and product.get('image_thumbnail'):
+            self._add_thumbnail(ws, portal_type, row_number, product['image_thumbnail'])
+        
+        ws.append(row)
+        return retail, proposed
+    
+    def _add_thumbnail(self, ws, portal_type, row_number, path):
+        """Miniatura nella colonna Foto/Immagine; l'altezza riga va impostata prima di append"""
+        try:
+            with open(path, 'rb') as f:
+                image = XLImage(BytesIO(f.read()))
+        except OSError:
+            # Miniatura rimossa dalla retention nel frattempo
+            return
+        
+        ws.row_dimensions[row_number].height = OmniSystemConfig.IMAGE_THUMB_SIZE * 0.75 + 4
+        ws.add_image(image, f"{'J' if portal_type == 'b2b_portal' else 'E'}{row_number}")
+    
+    def _append_summary(self, ws, total_retail, total_proposed):
+        """Summary row (una riga vuota di separazione)"""
+        ws.append([])
+        ws.append([None] * 8 + [
+            self._styled(ws, 'TOTALI:', 'lxb_total_label'),
+            self._styled(ws, total_retail, 'lxb_currency'),
+            self._styled(ws, total_proposed, 'lxb_currency')
+        ])
+    
+    async def _generate_single_file(self, products, portal_type, user):
+        """
+        Genera singolo Excel in streaming (workbook write_only):
+        le righe vengono scritte intere e gli stili sono condivisi,
+        quindi la memoria resta costante al crescere delle righe
+        """
         
-        for col_letter, width in column_widths.items():
-            if col_letter in ws.column_dimensions:
-                ws.column_dimensions[col_letter].width = width
+        wb, ws, size_grid = self._new_sheet(portal_type)
         
         # Popola dati
         current_row = 2
         total_retail = 0
         total_proposed = 0
+        stg_prefix = f"LXB{datetime.now().strftime('%y%m')}"
+        include_ai = self._include_ai(user)
+        include_images = self._include_images(user)
         
-        # Determina se includere AI analysis
-        include_ai = False
-        if user:
-            plan_limits = user.get_plan_limits()
-            include_ai = plan_limits.get('competitor_analysis', False)
-        
-        for idx, product in enumerate(products, 1):
+        async for idx, product, ai_analysis in self._iter_with_analysis(products, include_ai, include_images):
             try:
-                # AI Analysis se disponibile
-                ai_analysis = None
-                if include_ai and product.get('brand'):
-                    ai_analysis = await self.ai_engine.analyze_market_enhanced(
-                        product.get('name', 'Product'),
-                        product.get('brand'),
-                        product.get('category', 'PRODUCT')
-                    )
-                
-                if portal_type == 'b2b_portal':
-                    # Formato B2B
-                    ws.cell(current_row, 1, product.get('sku', f'SKU{idx:06d}'))
-                    ws.cell(current_row, 2, product.get('brand', 'BRAND'))
-                    ws.cell(current_row, 3, product.get('name', ''))
-                    ws.cell(current_row, 4, product.get('category', 'PRODUCT'))
-                    
-                    wholesale = product.get('wholesale_price', product.get('price', 0))
-                    ws.cell(current_row, 5, wholesale).number_format = '€#,##0.00'
-                    
-                    retail = wholesale * 2.2
-                    ws.cell(current_row, 6, retail).number_format = '€#,##0.00'
-                    
-                    margin = ((retail - wholesale) / retail * 100) if retail > 0 else 0
-                    ws.cell(current_row, 7, f"{margin:.1f}%")
-                    
-                    ws.cell(current_row, 8, product.get('sizes', ''))
-                    ws.cell(current_row, 9, product.get('quantity', ''))
-                    ws.cell(current_row, 10, '️' if product.get('image_url') else '-')
-                    
-                    if ai_analysis:
-                        ws.cell(current_row, 11, f"{ai_analysis.get('confidence_score', 0)}%")
-                    else:
-                        ws.cell(current_row, 11, 'N/A')
-                    
-                    ws.cell(current_row, 12, 'B2B Import')
-                    
-                else:
-                    # Formato pubblico con AI
-                    
-                    # Dati base
-                    ws.cell(current_row, 1, f"LXB{datetime.now().strftime('%y%m')}{idx:05d}")
-                    ws.cell(current_row, 2, product.get('brand', 'LUXURY'))
-                    ws.cell(current_row, 3, self._detect_gender(product.get('name', '')))
-                    ws.cell(current_row, 4, product.get('category', 'ITEM'))
-                    ws.cell(current_row, 5, '️' if product.get('image_url') else '-')
-                    ws.cell(current_row, 6, product.get('sku'))
-                    ws.cell(current_row, 7, 'FW24')
-                    ws.cell(current_row, 8, product.get('name', '')[:50])
-                    ws.cell(current_row, 9, self._detect_color(product.get('name', '')))
-                    
-                    # Pricing
-                    retail = product.get('price', 500)
-                    
-                    if ai_analysis and ai_analysis.get('recommended_strategy'):
-                        margin = ai_analysis['recommended_strategy'].get('target_margin', 45) / 100
-                    else:
-                        margin = 0.45
-                    
-                    proposed = retail * (1 - margin)
-                    
-                    ws.cell(current_row, 10, retail).number_format = '€#,##0.00'
-                    ws.cell(current_row, 11, proposed).number_format = '€#,##0.00'
-                    ws.cell(current_row, 12, f"{margin*100:.0f}%")
-                    ws.cell(current_row, 13, random.randint(5, 50))
-                    
-                    # Taglie
-                    category = product.get('category', 'ABBIGLIAMENTO')
-                    relevant_sizes = self._get_sizes_for_category(category)
-                    
-                    for col_idx, size in enumerate(unique_sizes, 14):
-                        if col_idx < len(headers) - 3:  # Lascia spazio per AI Score, Competitor, Note
-                            if str(size) in [str(s) for s in relevant_sizes]:
-                                ws.cell(current_row, col_idx, random.randint(0, 10))
-                            else:
-                                ws.cell(current_row, col_idx, 0)
-                    
-                    # AI Score
-                    ai_col = len(headers) - 2
-                    if ai_analysis:
-                        ws.cell(current_row, ai_col, f"{ai_analysis.get('confidence_score', 0)}%")
-                        
-                        # Competitor info
-                        comp_col = len(headers) - 1
-                        if ai_analysis.get('competitor_prices'):
-                            comp_count = len(ai_analysis['competitor_prices'])
-                            ws.cell(current_row, comp_col, f"{comp_count} sites")
-                    
-                    # Note
-                    note_col = len(headers)
-                    note = "AI Enhanced" if ai_analysis else "Standard"
-                    ws.cell(current_row, note_col, note)
+                retail, proposed = self._append_product(
+                    ws, portal_type, size_grid, stg_prefix, idx, product, ai_analysis, current_row
+                )
+                if self.progress:
+                    self.progress.increment('rows_written')
                 
-                total_retail += retail if 'retail' in locals() else 0
-                total_proposed += proposed if 'proposed' in locals() else 0
+                total_retail += retail
+                total_proposed += proposed
                 current_row += 1
                 
                 # Check limite righe Excel
@@ -2250,113 +5764,662 @@ class OmniSystemExcelGenerator:
                 logger.error(f"Error processing product {idx}: {e}")
                 continue
         
-        # Summary row
-        summary_row = current_row + 1
-        ws.cell(summary_row, 9, 'TOTALI:').font = Font(bold=True, size=12, color='E74C3C')
-        ws.cell(summary_row, 10, total_retail).number_format = '€#,##0.00'
-        ws.cell(summary_row, 11, total_proposed).number_format = '€#,##0.00'
+        self._append_summary(ws, total_retail, total_proposed)
+        
+        # Salva
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        filename = f"LUXLAB_OMNISYSTEM_{portal_type.upper()}_{timestamp}.xlsx"
+        filepath = os.path.join(OmniSystemConfig.EXPORT_PATH, filename)
+        
+        wb.save(filepath)
+        
+        return {
+            'filename': filename,
+            'filepath': filepath,
+            'products_count': current_row - 2,
+            'file_size': os.path.getsize(filepath),
+            'total_retail': total_retail,
+            'total_proposed': total_proposed,
+            'ai_analysis_included': include_ai
+        }
+    
+    def build_part(self, items, portal_type, stg_prefix):
+        """
+        Parte di un export multi-file, senza I/O: items sono (idx, prodotto,
+        analisi) già pronti. Ritorna (byte dell'xlsx, righe scritte)
+        """
+        wb, ws, size_grid = self._new_sheet(portal_type)
+        rows = 0
+        total_retail = 0
+        total_proposed = 0
+        
+        for idx, product, ai_analysis in items:
+            try:
+                retail, proposed = self._append_product(
+                    ws, portal_type, size_grid, stg_prefix, idx, product, ai_analysis, rows + 2
+                )
+            except Exception as e:
+                logger.error(f"Error processing product {idx}: {e}")
+                continue
+            
+            total_retail += retail
+            total_proposed += proposed
+            rows += 1
+        
+        self._append_summary(ws, total_retail, total_proposed)
+        
+        buffer = BytesIO()
+        wb.save(buffer)
+        return buffer.getvalue(), rows
+    
+    def _stream_styles(self):
+        """Stessi stili di _register_named_styles, nel formato di XlsxStreamWriter"""
+        styles = [
+            (style_name, {'bold': True, 'size': 11, 'color': 'FFFFFF', 'fill': color, 'border': True, 'center': True})
+            for _, style_name, color in self.HEADER_SECTIONS
+        ]
+        styles.append(('lxb_currency', {'num_format': '€#,##0.00'}))
+        styles.append(('lxb_total_label', {'bold': True, 'size': 12, 'color': 'E74C3C'}))
+        return styles
+    
+    async def stream_omnisystem_excel(self, products, portal_type, products_count, include_ai, fileobj):
+        """
+        Export scritto su fileobj (anche non seekable, es. la risposta HTTP)
+        mentre le righe vengono prodotte: un xlsx o, oltre EXCEL_SPLIT_AT
+        prodotti, uno ZIP con le parti. Nessun file su disco
+        """
+        stg_prefix = f"LXB{datetime.now().strftime('%y%m')}"
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        
+        if products_count <= OmniSystemConfig.EXCEL_SPLIT_AT:
+            rows = await self._stream_sheet(
+                fileobj, self._iter_with_analysis(products, include_ai),
+                portal_type, stg_prefix, OmniSystemConfig.EXCEL_SAFE_ROWS - 1
+            )
+            return {'products_count': rows, 'parts': 1}
+        
+        archive = zipfile.ZipFile(fileobj, 'w', zipfile.ZIP_DEFLATED, compresslevel=1)
+        products_iter = iter(products)
+        rows = 0
+        parts = 0
+        
+        # Stessa suddivisione di _generate_multi_file, una parte per volta
+        while True:
+            chunk = list(islice(products_iter, OmniSystemConfig.EXCEL_SPLIT_AT))
+            if not chunk:
+                break
+            
+            parts += 1
+            info = zipfile.ZipInfo(
+                f"LUXLAB_OMNISYSTEM_{portal_type.upper()}_{timestamp}_part{parts}.xlsx",
+                date_time=datetime.now().timetuple()[:6]
+            )
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            
+            with archive.open(info, 'w', force_zip64=True) as entry:
+                rows += await self._stream_sheet(
+                    entry, self._iter_with_analysis(chunk, include_ai),
+                    portal_type, stg_prefix, OmniSystemConfig.EXCEL_SPLIT_AT
+                )
+        
+        archive.close()
+        return {'products_count': rows, 'parts': parts}
+    
+    async def _stream_sheet(self, fileobj, items, portal_type, stg_prefix, limit):
+        """Foglio in streaming con al massimo limit righe prodotto: ritorna le righe scritte"""
+        headers, size_grid = self._excel_layout(portal_type)
+        ws = XlsxStreamWriter(fileobj, "LUXLAB OMNISYSTEM CATALOG", self.COLUMN_WIDTHS, self._stream_styles())
+        
+        ws.append([
+            self._styled(ws, header, self._header_style(col))
+            for col, header in enumerate(headers, 1)
+        ])
+        
+        # Primi byte subito al client, prima dell'AI analysis del primo blocco
+        ws.flush()
+        fileobj.flush()
+        
+        rows = 0
+        total_retail = 0
+        total_proposed = 0
+        
+        try:
+            async for idx, product, ai_analysis in items:
+                try:
+                    retail, proposed = self._append_product(ws, portal_type, size_grid, stg_prefix, idx, product, ai_analysis)
+                except BrokenPipeError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Error processing product {idx}: {e}")
+                    continue
+                
+                total_retail += retail
+                total_proposed += proposed
+                rows += 1
+                
+                if rows >= limit:
+                    break
+            
+            self._append_summary(ws, total_retail, total_proposed)
+        
+        except BaseException:
+            ws.abort()
+            raise
+        
+        ws.close()
+        return rows
+    
+    def _detect_gender(self, name):
+        """Rileva gender"""
+        return product_classifier.classify(name).gender
+    
+    def _detect_color(self, name):
+        """Rileva colore"""
+        return product_classifier.classify(name).color
+    
+    def _get_sizes_for_category(self, category):
+        """Ottiene taglie per categoria"""
+        return product_classifier.sizes_for_category(category)
+    
+    async def _generate_multi_file(self, products, portal_type, user):
+        """
+        Genera multipli file con ZIP: le parti sono costruite in parallelo
+        nel pool di processi degli export (l'AI analysis resta qui, con la sua cache) e
+        scritte nell'archivio in ordine appena pronte, senza file intermedi.
+        Compressione veloce (livello 1): l'XML delle righe è molto ripetitivo
+        e gli xlsx si riducono ancora di un terzo con pochi ms per parte
+        """
+        
+        products_iter = iter(products)
+        products_count = 0
+        parts = 0
+        include_ai = self._include_ai(user)
+        include_images = self._include_images(user)
+        stg_prefix = f"LXB{datetime.now().strftime('%y%m')}"
+        
+        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+        zip_name = f"LUXLAB_OMNISYSTEM_COMPLETE_{timestamp}.zip"
+        zip_path = os.path.join(OmniSystemConfig.EXPORT_PATH, zip_name)
+        
+        # Parti in costruzione (in ordine), al massimo una per worker
+        pending = []
+        max_pending = max(1, self.part_pool.workers)
+        
+        async def write_part(zipf, part, task):
+            content, rows = await task
+            
+            info = zipfile.ZipInfo(
+                f"LUXLAB_OMNISYSTEM_{portal_type.upper()}_{timestamp}_part{part}.xlsx",
+                date_time=datetime.now().timetuple()[:6]
+            )
+            info.external_attr = 0o644 << 16
+            zipf.writestr(info, content, compress_type=zipfile.ZIP_DEFLATED, compresslevel=1)
+            
+            if self.progress:
+                self.progress.increment('rows_written', rows)
+                self.progress.set('parts_written', part)
+        
+        try:
+            with zipfile.ZipFile(zip_path, 'w') as zipf:
+                # Chunk letti uno alla volta: l'iterabile può essere uno stream
+                while True:
+                    chunk = list(islice(products_iter, OmniSystemConfig.EXCEL_SPLIT_AT))
+                    if not chunk:
+                        break
+                    
+                    parts += 1
+                    products_count += len(chunk)
+                    items = [item async for item in self._iter_with_analysis(chunk, include_ai, include_images)]
+                    pending.append((parts, asyncio.ensure_future(
+                        self.part_pool.build_excel_part(items, portal_type, stg_prefix)
+                    )))
+                    
+                    if len(pending) >= max_pending:
+                        await write_part(zipf, *pending.pop(0))
+                
+                while pending:
+                    await write_part(zipf, *pending.pop(0))
+        
+        except BaseException:
+            for _, task in pending:
+                task.cancel()
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
+            raise
+        
+        return {
+            'filename': zip_name,
+            'filepath': zip_path,
+            'products_count': products_count,
+            'file_size': os.path.getsize(zip_path),
+            'parts': parts
+        }
+
+# ==========================================
+#  EXTRACTION RESULT STORE
+# ==========================================
+
+class StoredProducts:
+    """Prodotti di un result set salvato: iterabile rileggibile, ogni iter() riparte dal file"""
+    
+    def __init__(self, file_path):
+        self.file_path = file_path
+    
+    def __iter__(self):
+        with gzip.open(self.file_path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+class ExtractionResultStore:
+    """
+    Result set delle estrazioni salvati lato server (JSON lines gzip),
+    indicizzati per extraction ID e riletti in streaming dall'Excel
+    """
+    
+    def save(self, products, url, portal_type, user=None):
+        """Salva i prodotti e ritorna il record ExtractionResult"""
+        self._purge_expired()
+        
+        extraction_id = uuid.uuid4().hex
+        file_path = os.path.join(OmniSystemConfig.RESULTS_PATH, f"{extraction_id}.jsonl.gz")
+        
+        count = 0
+        with gzip.open(file_path, 'wt', encoding='utf-8', compresslevel=5) as f:
+            for product in products:
+                f.write(json.dumps(product, separators=(',', ':'), ensure_ascii=False, default=str))
+                f.write('\n')
+                count += 1
+        
+        record = ExtractionResult(
+            id=extraction_id,
+            user_id=user.id if user else None,
+            url=url,
+            portal_type=portal_type,
+            products_count=count,
+            file_path=file_path,
+            file_size=os.path.getsize(file_path)
+        )
+        db.session.add(record)
+        db.session.commit()
+        
+        return record
+    
+    def get(self, extraction_id, user=None):
+        """Record visibile dall'utente (None se non esiste o di altri)"""
+        record = ExtractionResult.query.get(extraction_id)
+        if not record or not os.path.exists(record.file_path):
+            return None
+        
+        if record.user_id and (not user or record.user_id != user.id):
+            return None
+        
+        return record
+    
+    def products(self, record):
+        """Prodotti del result set, rileggibili (es. digest + generazione Excel)"""
+        return StoredProducts(record.file_path)
+    
+    def iter_products(self, record):
+        """Legge i prodotti uno alla volta dal result set"""
+        return iter(self.products(record))
+    
+    def _purge_expired(self):
+        """Rimuove i result set più vecchi di RESULTS_TTL_HOURS"""
+        cutoff = datetime.utcnow() - timedelta(hours=OmniSystemConfig.RESULTS_TTL_HOURS)
+        
+        try:
+            expired = ExtractionResult.query.filter(ExtractionResult.created_at < cutoff).all()
+            for record in expired:
+                if record.file_path and os.path.exists(record.file_path):
+                    os.remove(record.file_path)
+                db.session.delete(record)
+            
+            if expired:
+                db.session.commit()
+                logger.info(f"Purged {len(expired)} expired extraction results")
+        
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Extraction result purge failed: {e}")
+
+result_store = ExtractionResultStore()
+
+class ProductDeltaIndex:
+    """
+    Impronte dei prodotti per catalogo (utente + URL): chiave stabile e
+    hash di prezzo, taglie e immagine. Confronta un'estrazione con la
+    precedente e ritorna solo prodotti nuovi, modificati e rimossi
+    """
+    
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS product_index (
+            scope TEXT NOT NULL,
+            key TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            url TEXT,
+            lastmod TEXT,
+            product TEXT NOT NULL,
+            updated_at REAL NOT NULL,
+            PRIMARY KEY (scope, key)
+        );
+    """
+    
+    BATCH_SIZE = 500
+    
+    def __init__(self, path):
+        self.store = SharedSQLiteStore(path, self.SCHEMA)
+    
+    @staticmethod
+    def scope(url, user):
+        """Catalogo: utente (registrato, gli anonimi non hanno delta) + host e path dell'URL (query inclusa)"""
+        parsed = urlparse(url.strip())
+        catalog = f"{parsed.netloc.lower()}{parsed.path.rstrip('/')}"
+        if parsed.query:
+            catalog += f"?{parsed.query}"
+        return f"{user.id}:{catalog}"
+    
+    @staticmethod
+    def fingerprint(product):
+        sizes = product.get('sizes')
+        if isinstance(sizes, (list, tuple, set)):
+            sizes = sorted(str(s) for s in sizes)
+        
+        value = [product.get('price'), sizes, product.get('image_url')]
+        return hashlib.sha1(json.dumps(value, default=str).encode()).hexdigest()[:16]
+    
+    def known_products(self, scope):
+        """url -> (lastmod, prodotto JSON) per saltare le pagine dettaglio invariate"""
+        try:
+            rows = self.store.execute(
+                'SELECT url, lastmod, product FROM product_index '
+                'WHERE scope = ? AND url IS NOT NULL AND lastmod IS NOT NULL', (scope,)
+            ).fetchall()
+        except sqlite3.Error as e:
+            logger.warning(f"Product index read failed: {e}")
+            return {}
+        
+        return {url: (lastmod, product) for url, lastmod, product in rows}
+    
+    def diff(self, scope, products, complete=True):
+        """
+        Confronto con l'ultima estrazione del catalogo. I rimossi sono
+        riportati (e tolti dall'indice) solo se l'estrazione è completa:
+        non fermata dal limite, da blocchi, errori o pagine non lette
+        """
+        try:
+            previous = {
+                key: (fingerprint, lastmod) for key, fingerprint, lastmod in self.store.execute(
+                    'SELECT key, fingerprint, lastmod FROM product_index WHERE scope = ?', (scope,)
+                )
+            }
+        except sqlite3.Error as e:
+            # Indice non leggibile (es. lock): tutti nuovi, nessun rimosso
+            logger.warning(f"Product index read failed: {e}")
+            previous = {}
+            complete = False
+        
+        # 'stale': invariati ma con lastmod nuovo, da riscrivere nell'indice; 'complete': rimossi verificati
+        delta = {'new': [], 'changed': [], 'removed': [], 'unchanged': 0, 'stale': [], 'complete': complete}
+        seen = set()
         
-        # Salva
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"LUXLAB_OMNISYSTEM_{portal_type.upper()}_{timestamp}.xlsx"
-        filepath = os.path.join(OmniSystemConfig.EXPORT_PATH, filename)
+        for product in products:
+            key = MasterOmniExtractor._product_key(product)
+            seen.add(key)
+            
+            old = previous.get(key)
+            if old is None:
+                delta['new'].append(product)
+            elif old[0] != self.fingerprint(product):
+                delta['changed'].append(product)
+            else:
+                delta['unchanged'] += 1
+                if product.get('lastmod') != old[1]:
+                    delta['stale'].append(product)
+        
+        if complete:
+            removed = [key for key in previous if key not in seen]
+            for i in range(0, len(removed), self.BATCH_SIZE):
+                batch = removed[i:i + self.BATCH_SIZE]
+                try:
+                    rows = self.store.execute(
+                        f"SELECT product FROM product_index WHERE scope = ? AND key IN ({','.join('?' * len(batch))})",
+                        (scope, *batch)
+                    ).fetchall()
+                except sqlite3.Error as e:
+                    # Rimossi non letti restano nell'indice: riportati alla prossima estrazione completa
+                    logger.warning(f"Product index read failed: {e}")
+                    delta['complete'] = False
+                    break
+                delta['removed'].extend(json_loads(row[0]) for row in rows)
         
-        wb.save(filepath)
+        return delta
+    
+    def update(self, scope, products, delta):
+        """Salva le impronte dell'estrazione corrente (nuovi, modificati, lastmod cambiati) e toglie i rimossi"""
+        now = time.time()
+        rows = [
+            (scope, MasterOmniExtractor._product_key(product), self.fingerprint(product),
+             product.get('url'), product.get('lastmod'),
+             json.dumps(product, separators=(',', ':'), ensure_ascii=False, default=str), now)
+            for product in delta['new'] + delta['changed'] + delta['stale']
+        ]
+        removed = [(scope, MasterOmniExtractor._product_key(product)) for product in delta['removed']]
         
-        return {
-            'filename': filename,
-            'filepath': filepath,
-            'products_count': current_row - 2,
-            'file_size': os.path.getsize(filepath),
-            'total_retail': total_retail,
-            'total_proposed': total_proposed,
-            'ai_analysis_included': include_ai
-        }
+        conn = self.store.connection()
+        try:
+            conn.execute('BEGIN')
+            conn.executemany('INSERT OR REPLACE INTO product_index VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.executemany('DELETE FROM product_index WHERE scope = ? AND key = ?', removed)
+            conn.execute('COMMIT')
+        except sqlite3.Error as e:
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+            logger.warning(f"Product index update failed: {e}")
+
+product_delta_index = ProductDeltaIndex(OmniSystemConfig.PRODUCT_INDEX_PATH)
+
+# ==========================================
+#  BACKGROUND JOB QUEUE
+# ==========================================
+
+class JobProgress:
+    """
+    Contatori di avanzamento di un job (pagine, prodotti, righe),
+    salvati sul record del job al massimo ogni JOB_PROGRESS_INTERVAL secondi
+    """
     
-    def _detect_gender(self, name):
-        """Rileva gender"""
-        name_lower = name.lower()
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.counters = defaultdict(int)
+        self.lock = threading.Lock()
+        self.last_flush = 0
+    
+    def increment(self, key, amount=1):
+        """Incrementa un contatore"""
+        with self.lock:
+            self.counters[key] += amount
+        self._maybe_flush()
+    
+    def set(self, key, value):
+        """Imposta un valore di avanzamento"""
+        with self.lock:
+            self.counters[key] = value
+        self._maybe_flush()
+    
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+    
+    def _maybe_flush(self):
+        if time.time() - self.last_flush >= OmniSystemConfig.JOB_PROGRESS_INTERVAL:
+            self.flush()
+    
+    def flush(self):
+        """Salva il progresso sul record del job"""
+        self.last_flush = time.time()
+        try:
+            job = OmniJob.query.get(self.job_id)
+            if job:
+                job.progress = json.dumps(self.snapshot())
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"Job {self.job_id} progress flush failed: {e}")
+
+class OmniJobQueue:
+    """
+    Coda job persistente: i record stanno nel database (visibili da tutti
+    i worker gunicorn), l'esecuzione avviene in un pool di thread locale.
+    Ogni processo aggiorna l'heartbeat dei propri job e marca failed quelli
+    rimasti queued/running senza heartbeat (worker riavviato o ucciso)
+    """
+    
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='omnijob')
+        self.handlers = {}
+        self.active = set()  # job accodati o in esecuzione in questo processo
+        self.lock = threading.Lock()
+        self.heartbeat_pid = None
+    
+    @staticmethod
+    def owner():
+        """Identità del processo corrente (dopo un fork il pid cambia)"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+    
+    def ensure_heartbeat(self):
+        """Avvia (una volta per processo) il thread di heartbeat/reaping"""
+        if self.heartbeat_pid == os.getpid():
+            return
+        
+        with self.lock:
+            if self.heartbeat_pid == os.getpid():
+                return
+            threading.Thread(target=self._heartbeat_loop, name='omnijob-heartbeat', daemon=True).start()
+            self.heartbeat_pid = os.getpid()
+    
+    def _heartbeat_loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    self._heartbeat()
+                    self.reap_stale()
+            except Exception as e:
+                logger.warning(f"Job heartbeat failed: {e}")
+            
+            time.sleep(OmniSystemConfig.JOB_HEARTBEAT_INTERVAL)
+    
+    def _heartbeat(self):
+        with self.lock:
+            job_ids = list(self.active)
         
-        if any(w in name_lower for w in ['women', 'donna', 'lady', 'female']):
-            return 'F'
-        elif any(w in name_lower for w in ['men', 'uomo', 'man', 'male']):
-            return 'M'
-        else:
-            return 'Unisex'
+        if job_ids:
+            OmniJob.query.filter(OmniJob.id.in_(job_ids)).update(
+                {'heartbeat_at': datetime.utcnow()}, synchronize_session=False
+            )
+            db.session.commit()
     
-    def _detect_color(self, name):
-        """Rileva colore"""
-        colors = {
-            'black': 'NERO', 'white': 'BIANCO', 'red': 'ROSSO',
-            'blue': 'BLU', 'green': 'VERDE', 'brown': 'MARRONE',
-            'grey': 'GRIGIO', 'gray': 'GRIGIO', 'beige': 'BEIGE',
-            'pink': 'ROSA', 'yellow': 'GIALLO', 'orange': 'ARANCIONE',
-            'purple': 'VIOLA', 'gold': 'ORO', 'silver': 'ARGENTO'
-        }
+    def reap_stale(self):
+        """Marca failed i job queued/running il cui worker non dà più heartbeat"""
+        cutoff = datetime.utcnow() - timedelta(seconds=OmniSystemConfig.JOB_STALE_AFTER)
+        
+        stale = OmniJob.query.filter(
+            OmniJob.status.in_(['queued', 'running']),
+            db.or_(
+                OmniJob.heartbeat_at < cutoff,
+                db.and_(OmniJob.heartbeat_at.is_(None), OmniJob.created_at < cutoff)
+            )
+        ).all()
+        
+        for job in stale:
+            job.status = 'failed'
+            job.error = 'Job interrotto: worker riavviato o terminato'
+            job.finished_at = datetime.utcnow()
+            logger.warning(f"Job {job.id} reaped (owner {job.owner}, last heartbeat {job.heartbeat_at})")
         
-        name_lower = name.lower()
-        for eng, ita in colors.items():
-            if eng in name_lower:
-                return ita
+        if stale:
+            db.session.commit()
         
-        return 'MULTICOLOR'
+        return len(stale)
     
-    def _get_sizes_for_category(self, category):
-        """Ottiene taglie per categoria"""
-        category_upper = category.upper()
-        
-        for cat_key, size_key in OmniSystemConfig.SIZE_MAPPING.items():
-            if cat_key in category_upper:
-                return OmniSystemConfig.ALL_SIZES.get(size_key, ['UNI'])
-        
-        # Default
-        if 'SCARPE' in category_upper or 'SHOE' in category_upper:
-            return OmniSystemConfig.ALL_SIZES['SCARPE']
-        elif 'BORSE' in category_upper or 'BAG' in category_upper:
-            return OmniSystemConfig.ALL_SIZES['BORSE']
-        elif 'MOBILI' in category_upper or 'FURNITURE' in category_upper:
-            return OmniSystemConfig.ALL_SIZES['COMPLEMENTI']
-        else:
-            return OmniSystemConfig.ALL_SIZES['ABBIGLIAMENTO']
+    def register(self, kind, handler):
+        """Registra handler async(params, user, progress) -> (payload, status)"""
+        self.handlers[kind] = handler
     
-    async def _generate_multi_file(self, products, portal_type, user):
-        """Genera multipli file con ZIP"""
+    def submit(self, kind, params, user=None):
+        """Crea il record del job e lo accoda"""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        
+        self.ensure_heartbeat()
+        
+        job = OmniJob(
+            id=str(uuid.uuid4()),
+            user_id=user.id if user else None,
+            kind=kind,
+            status='queued',
+            params=json.dumps(params),
+            owner=self.owner(),
+            heartbeat_at=datetime.utcnow()
+        )
+        db.session.add(job)
+        db.session.commit()
         
-        files = []
-        chunks = [products[i:i+OmniSystemConfig.EXCEL_SPLIT_AT] 
-                 for i in range(0, len(products), OmniSystemConfig.EXCEL_SPLIT_AT)]
+        with self.lock:
+            self.active.add(job.id)
+        self.executor.submit(self._run, job.id)
+        logger.info(f"Job {job.id} ({kind}) queued")
         
-        for i, chunk in enumerate(chunks, 1):
-            result = await self._generate_single_file(chunk, portal_type, user)
+        return job
+    
+    def _run(self, job_id):
+        """Esegue il job in un thread del pool con il proprio event loop"""
+        try:
+            self._execute(job_id)
+        finally:
+            with self.lock:
+                self.active.discard(job_id)
+    
+    def _execute(self, job_id):
+        with app.app_context():
+            job = OmniJob.query.get(job_id)
+            if not job:
+                return
             
-            # Rinomina con part
-            old_name = result['filename']
-            new_name = old_name.replace('.xlsx', f'_part{i}.xlsx')
+            job.status = 'running'
+            job.started_at = datetime.utcnow()
+            db.session.commit()
             
-            old_path = result['filepath']
-            new_path = os.path.join(OmniSystemConfig.EXPORT_PATH, new_name)
+            progress = JobProgress(job_id)
+            user = User.query.get(job.user_id) if job.user_id else None
             
-            os.rename(old_path, new_path)
-            files.append(new_name)
-        
-        # Crea ZIP
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        zip_name = f"LUXLAB_OMNISYSTEM_COMPLETE_{timestamp}.zip"
-        zip_path = os.path.join(OmniSystemConfig.EXPORT_PATH, zip_name)
-        
-        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for file in files:
-                file_path = os.path.join(OmniSystemConfig.EXPORT_PATH, file)
-                zipf.write(file_path, file)
-                os.remove(file_path)
-        
-        return {
-            'filename': zip_name,
-            'filepath': zip_path,
-            'products_count': len(products),
-            'file_size': os.path.getsize(zip_path),
-            'parts': len(chunks)
-        }
+            try:
+                handler = self.handlers[job.kind]
+                payload, status = asyncio.run(handler(json.loads(job.params), user, progress))
+                
+                job = OmniJob.query.get(job_id)
+                if status >= 400:
+                    job.status = 'failed'
+                    job.error = payload.get('error', f'HTTP {status}')
+                else:
+                    job.status = 'completed'
+                    job.result = json.dumps(payload, default=str)
+            
+            except Exception as e:
+                logger.error(f"Job {job_id} failed: {e}")
+                db.session.rollback()
+                job = OmniJob.query.get(job_id)
+                job.status = 'failed'
+                job.error = str(e)
+            
+            job.progress = json.dumps(progress.snapshot())
+            job.finished_at = datetime.utcnow()
+            db.session.commit()
+            
+            logger.info(f"Job {job_id} {job.status}")
+
+job_queue = OmniJobQueue(OmniSystemConfig.JOB_WORKERS)
 
 # ==========================================
 # JWT & AUTHENTICATION
@@ -2405,7 +6468,7 @@ def token_required(f):
         request.current_user_plan = payload.get('plan', 'trial')
         request.is_admin = payload.get('is_admin', False)
         
-        return f(*args, **kwargs)
+        return app.ensure_sync(f)(*args, **kwargs)
     return decorated
 
 def optional_auth(f):
@@ -2429,7 +6492,7 @@ def optional_auth(f):
                     request.current_user_plan = user.plan
                     request.is_admin = user.is_admin
         
-        return f(*args, **kwargs)
+        return app.ensure_sync(f)(*args, **kwargs)
     return decorated
 
 # ==========================================
@@ -3208,7 +7271,7 @@ def index():
                 <p style="font-size: 1.2rem; color: var(--accent-cyan);">
                     Analisi AI in corso su 30+ competitor sites...
                 </p>
-                <p style="margin-top: 1rem; color: #9CA3AF;">
+                <p style="margin-top: 1rem; color: #9CA3AF;" id="loadingProgress">
                     Questo può richiedere alcuni minuti
                 </p>
             </div>
@@ -3459,23 +7522,13 @@ def index():
             document.getElementById('resultsSection').classList.remove('active');
             
             try {
-                const token = localStorage.getItem('token');
-                const response = await fetch('/api/omnisystem/extract', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'Authorization': token ? 'Bearer ' + token : ''
-                    },
-                    body: JSON.stringify({
-                        url,
-                        strategy,
-                        target: parseInt(limit),
-                        type
-                    })
+                const {response, data} = await runJob('extract', {
+                    url,
+                    strategy,
+                    target: parseInt(limit),
+                    type
                 });
                 
-                const data = await response.json();
-                
                 if (response.ok) {
                     analysisData = data;
                     showResults(data);
@@ -3549,18 +7602,12 @@ def index():
             }
             
             try {
-                const token = localStorage.getItem('token');
-                const response = await fetch('/api/omnisystem/generate-excel', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json',
-                        'Authorization': token ? 'Bearer ' + token : ''
-                    },
-                    body: JSON.stringify(analysisData)
+                showAlert('info', 'Generazione Excel in corso...');
+                const {response, data} = await runJob('excel', {
+                    extraction_id: analysisData.extraction_id,
+                    portal_type: analysisData.portal_type
                 });
                 
-                const data = await response.json();
-                
                 if (response.ok && data.download_url) {
                     window.open(data.download_url, '_blank');
                     showAlert('success', 'Excel generato con successo!');
@@ -3572,6 +7619,61 @@ def index():
             }
         }
         
+        function authHeaders() {
+            const token = localStorage.getItem('token');
+            return {
+                'Content-Type': 'application/json',
+                'Authorization': token ? 'Bearer ' + token : ''
+            };
+        }
+        
+        function formatProgress(progress) {
+            const labels = {
+                pages_fetched: 'pagine',
+                products_parsed: 'prodotti',
+                rows_written: 'righe Excel'
+            };
+            return Object.entries(labels)
+                .filter(([key]) => progress[key])
+                .map(([key, label]) => `${progress[key]} ${label}`)
+                .join(' · ');
+        }
+        
+        async function runJob(kind, body) {
+            // Accoda il job e fa polling fino al completamento
+            const submit = await fetch('/api/omnisystem/jobs', {
+                method: 'POST',
+                headers: authHeaders(),
+                body: JSON.stringify({...body, kind})
+            });
+            const job = await submit.json();
+            
+            if (!submit.ok) {
+                return {response: submit, data: job};
+            }
+            
+            while (true) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                
+                const poll = await fetch(job.poll_url, {headers: authHeaders()});
+                const status = await poll.json();
+                
+                if (!poll.ok) {
+                    return {response: poll, data: status};
+                }
+                
+                const text = formatProgress(status.progress || {});
+                if (text) {
+                    document.getElementById('loadingProgress').textContent = text;
+                }
+                
+                if (status.status === 'completed' || status.status === 'failed') {
+                    const result = await fetch(job.result_url, {headers: authHeaders()});
+                    return {response: result, data: await result.json()};
+                }
+            }
+        }
+        
         function logout() {
             localStorage.removeItem('token');
             currentUser = null;
@@ -3670,88 +7772,199 @@ def verify_token():
         'user': request.current_user.to_dict()
     })
 
+async def run_omnisystem_extraction(data, user, progress=None):
+    """
+    Pipeline di estrazione condivisa da endpoint sincrono e job queue.
+    Ritorna (payload, status_code)
+    """
+    url = data.get('url', '').strip()
+    target = min(int(data.get('target', 1000)), 50000)
+    strategy = data.get('strategy', 'BALANCED')
+    extract_type = data.get('type', 'auto')
+    mode = data.get('mode', 'full')
+    client = data.get('client', {})
+    
+    if not url:
+        return {'error': 'URL richiesto'}, 400
+    
+    if mode not in ('full', 'delta'):
+        return {'error': f"Modalità non valida: {mode}"}, 400
+    
+    # Delta per utente: senza account il confronto sarebbe con le estrazioni di altri visitatori
+    if mode == 'delta' and not user:
+        return {'error': 'Modalità delta disponibile solo con accesso'}, 401
+    
+    # Check user limits
+    if user:
+        plan_limits = user.get_plan_limits()
+        max_products = min(target, plan_limits['products'])
+    else:
+        max_products = 15  # Trial limit for anonymous
+    
+    logger.info(f"Starting omnisystem extraction: {url}")
+    
+    # Extract products
+    extractor = MasterOmniExtractor(progress=progress)
+    if mode == 'delta':
+        # Pagine dettaglio con lastmod invariato riprese dall'estrazione precedente
+        delta_scope = product_delta_index.scope(url, user)
+        extractor.known_products = product_delta_index.known_products(delta_scope)
+    
+    products = await extractor.extract_omnisystem(url, max_products, user)
+    
+    # Modalità delta: solo nuovi, modificati e rimossi rispetto all'ultima estrazione del catalogo.
+    # Confronto anche senza prodotti: un catalogo completo e vuoto riporta tutti i rimossi
+    delta = None
+    result_products = products
+    if mode == 'delta':
+        complete = extractor.extraction_complete() and len(products) < max_products
+        delta = product_delta_index.diff(delta_scope, products, complete=complete)
+        product_delta_index.update(delta_scope, products, delta)
+        result_products = [
+            dict(product, delta_status=status)
+            for status in ('new', 'changed', 'removed')
+            for product in delta[status]
+        ]
+        logger.info(
+            f" Delta: {len(delta['new'])} new, {len(delta['changed'])} changed, "
+            f"{len(delta['removed'])} removed, {delta['unchanged']} unchanged"
+            f"{'' if delta['complete'] else ' (partial run, removals not applied)'}"
+        )
+    
+    if not products and not (delta and delta['removed']):
+        return {'error': 'Nessun prodotto trovato'}, 404
+    
+    # Detect portal type
+    domain = urlparse(url).netloc
+    portal_type = 'b2b_portal' if any(
+        portal['pattern'] in domain 
+        for portal in OmniSystemConfig.B2B_PORTALS.values()
+    ) else 'public'
+    
+    # Result set lato server: l'Excel viene generato da qui via extraction_id
+    extraction = result_store.save(result_products, url, portal_type, user)
+    
+    # AI Analysis on sample
+    competitor_analysis = None
+    if user and user.get_plan_limits().get('competitor_analysis'):
+        ai_engine = EnhancedCompetitorIntelligenceAI()
+        if products:
+            sample = products[0]
+            competitor_analysis = await ai_engine.analyze_market_enhanced(
+                sample.get('name', 'Product'),
+                sample.get('brand'),
+                sample.get('category')
+            )
+    
+    # Update user stats
+    if user:
+        conversion = Conversion(
+            user_id=user.id,
+            url=url,
+            url_hash=hashlib.md5(url.encode()).hexdigest(),
+            strategy=strategy,
+            products_count=len(products),
+            portal_type=portal_type,
+            ai_analysis_used=bool(competitor_analysis),
+            processing_time=0,  # Will be updated
+            ip_address=client.get('ip_address'),
+            user_agent=client.get('user_agent', '')
+        )
+        db.session.add(conversion)
+        user.total_conversions += 1
+        user.total_products_processed += len(products)
+        
+        if user.plan == 'trial':
+            user.free_products_used += len(products)
+        
+        db.session.commit()
+    
+    payload = {
+        'success': True,
+        'extraction_id': extraction.id,
+        'products': result_products[:20],  # Return sample
+        'products_count': len(result_products),
+        'competitor_analysis': competitor_analysis,
+        'portal_type': portal_type,
+        'ai_analysis_included': bool(competitor_analysis),
+        'strategy': strategy
+    }
+    
+    if delta is not None:
+        payload['delta'] = {
+            'new': len(delta['new']),
+            'changed': len(delta['changed']),
+            'removed': len(delta['removed']),
+            'unchanged': delta['unchanged'],
+            'removed_checked': delta['complete'],
+            'details_skipped': extractor.stats['delta_skipped'],
+            'total_products': len(products)
+        }
+        
+        # Excel delta opzionale, generato subito
+        if data.get('delta_excel') and result_products:
+            generator = OmniSystemExcelGenerator(progress=progress)
+            excel = await generator.generate_omnisystem_excel(result_products, portal_type, user)
+            payload['delta_download_url'] = f"/download/{excel['filename']}"
+    
+    return payload, 200
+
+async def run_excel_generation(data, user, progress=None):
+    """
+    Generazione Excel condivisa da endpoint sincrono e job queue.
+    Ritorna (payload, status_code)
+    """
+    extraction_id = data.get('extraction_id')
+    
+    if extraction_id:
+        # Prodotti letti in streaming dal result set salvato
+        extraction = result_store.get(extraction_id, user)
+        if not extraction:
+            return {'error': 'Estrazione non trovata o scaduta'}, 404
+        
+        products = result_store.products(extraction)
+        products_count = extraction.products_count
+        portal_type = data.get('portal_type') or extraction.portal_type or 'public'
+    else:
+        # Get products from request body (compatibilità API)
+        products = data.get('products', [])
+        products_count = len(products)
+        portal_type = data.get('portal_type', 'public')
+    
+    if not products_count:
+        return {'error': 'Nessun prodotto da esportare'}, 400
+    
+    # Generate Excel
+    generator = OmniSystemExcelGenerator(progress=progress)
+    result = await generator.generate_omnisystem_excel(products, portal_type, user, products_count)
+    
+    return {
+        'success': True,
+        'download_url': f"/download/{result['filename']}",
+        'file_size': result['file_size'],
+        'products_count': result['products_count']
+    }, 200
+
+job_queue.register('extract', run_omnisystem_extraction)
+job_queue.register('excel', run_excel_generation)
+
+def _client_info():
+    """IP e User-Agent della richiesta corrente"""
+    return {
+        'ip_address': request.remote_addr,
+        'user_agent': request.headers.get('User-Agent', '')
+    }
+
 @app.route('/api/omnisystem/extract', methods=['POST'])
 @optional_auth
 async def omnisystem_extract():
     """Main omnisystem extraction endpoint"""
     try:
         data = request.get_json()
-        url = data.get('url', '').strip()
-        target = min(int(data.get('target', 1000)), 50000)
-        strategy = data.get('strategy', 'BALANCED')
-        extract_type = data.get('type', 'auto')
-        
-        if not url:
-            return jsonify({'error': 'URL richiesto'}), 400
-        
-        # Check user limits
-        user = request.current_user
-        if user:
-            plan_limits = user.get_plan_limits()
-            max_products = min(target, plan_limits['products'])
-        else:
-            max_products = 15  # Trial limit for anonymous
-        
-        logger.info(f"Starting omnisystem extraction: {url}")
-        
-        # Extract products
-        extractor = MasterOmniExtractor()
-        products = await extractor.extract_omnisystem(url, max_products, user)
-        
-        if not products:
-            return jsonify({'error': 'Nessun prodotto trovato'}), 404
-        
-        # Detect portal type
-        domain = urlparse(url).netloc
-        portal_type = 'b2b_portal' if any(
-            portal['pattern'] in domain 
-            for portal in OmniSystemConfig.B2B_PORTALS.values()
-        ) else 'public'
-        
-        # AI Analysis on sample
-        competitor_analysis = None
-        if user and user.get_plan_limits().get('competitor_analysis'):
-            ai_engine = EnhancedCompetitorIntelligenceAI()
-            if products:
-                sample = products[0]
-                competitor_analysis = await ai_engine.analyze_market_enhanced(
-                    sample.get('name', 'Product'),
-                    sample.get('brand'),
-                    sample.get('category')
-                )
+        data['client'] = _client_info()
         
-        # Update user stats
-        if user:
-            conversion = Conversion(
-                user_id=user.id,
-                url=url,
-                url_hash=hashlib.md5(url.encode()).hexdigest(),
-                strategy=strategy,
-                products_count=len(products),
-                portal_type=portal_type,
-                ai_analysis_used=bool(competitor_analysis),
-                processing_time=0,  # Will be updated
-                ip_address=request.remote_addr,
-                user_agent=request.headers.get('User-Agent', '')
-            )
-            db.session.add(conversion)
-            user.total_conversions += 1
-            user.total_products_processed += len(products)
-            
-            if user.plan == 'trial':
-                user.free_products_used += len(products)
-            
-            db.session.commit()
-        
-        return jsonify({
-            'success': True,
-            'products': products[:20],  # Return sample
-            'products_count': len(products),
-            'competitor_analysis': competitor_analysis,
-            'portal_type': portal_type,
-            'ai_analysis_included': bool(competitor_analysis),
-            'strategy': strategy
-        })
+        payload, status = await run_omnisystem_extraction(data, request.current_user)
+        return jsonify(payload), status
         
     except Exception as e:
         logger.error(f"Extraction error: {e}")
@@ -3764,29 +7977,217 @@ async def generate_excel():
     try:
         data = request.get_json()
         
-        # Get products from extraction
-        products = data.get('products', [])
-        if not products:
-            return jsonify({'error': 'Nessun prodotto da esportare'}), 400
+        payload, status = await run_excel_generation(data, request.current_user)
+        return jsonify(payload), status
+    
+    except Exception as e:
+        logger.error(f"Excel generation error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/omnisystem/jobs', methods=['POST'])
+@optional_auth
+def submit_job():
+    """Accoda estrazione o generazione Excel come job in background"""
+    try:
+        data = request.get_json() or {}
+        kind = data.pop('kind', None)
         
-        portal_type = data.get('portal_type', 'public')
-        user = request.current_user
+        if kind not in job_queue.handlers:
+            return jsonify({'error': f"Tipo job non valido: {kind}"}), 400
         
-        # Generate Excel
-        generator = OmniSystemExcelGenerator()
-        result = await generator.generate_omnisystem_excel(products, portal_type, user)
+        data['client'] = _client_info()
+        job = job_queue.submit(kind, data, request.current_user)
         
         return jsonify({
             'success': True,
-            'download_url': f"/download/{result['filename']}",
-            'file_size': result['file_size'],
-            'products_count': result['products_count']
-        })
+            'job_id': job.id,
+            'status': job.status,
+            'poll_url': f"/api/omnisystem/jobs/{job.id}",
+            'result_url': f"/api/omnisystem/jobs/{job.id}/result"
+        }), 202
         
     except Exception as e:
-        logger.error(f"Excel generation error: {e}")
+        logger.error(f"Job submit error: {e}")
         return jsonify({'error': str(e)}), 500
 
+def _get_user_job(job_id):
+    """Job visibile dall'utente corrente (None se non esiste o di altri)"""
+    # Anche i processi che non accodano job ripuliscono quelli orfani
+    job_queue.ensure_heartbeat()
+    
+    job = OmniJob.query.get(job_id)
+    if not job or (job.user_id and job.user_id != request.current_user_id):
+        return None
+    return job
+
+@app.route('/api/omnisystem/jobs/<job_id>')
+@optional_auth
+def job_status(job_id):
+    """Stato e progresso di un job"""
+    job = _get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    return jsonify(job.to_dict())
+
+@app.route('/api/omnisystem/jobs/<job_id>/result')
+@optional_auth
+def job_result(job_id):
+    """Risultato di un job completato"""
+    job = _get_user_job(job_id)
+    if not job:
+        return jsonify({'error': 'Job non trovato'}), 404
+    
+    if job.status == 'failed':
+        return jsonify({'error': job.error or 'Job fallito', 'status': job.status}), 500
+    
+    if job.status != 'completed':
+        return jsonify({'error': 'Job non ancora completato', 'status': job.status}), 409
+    
+    return jsonify(json.loads(job.result))
+
+EXPORT_STREAM_AUDIENCE = 'export-stream'
+
+def _produce_export_stream(stream, products, portal_type, products_count, include_ai):
+    """Thread produttore: scrive l'export sullo stream con il proprio event loop"""
+    with app.app_context():
+        try:
+            generator = OmniSystemExcelGenerator()
+            result = asyncio.run(generator.stream_omnisystem_excel(
+                products, portal_type, products_count, include_ai, stream
+            ))
+            stream.finish()
+            logger.info(f"Export stream completed: {result['products_count']} rows, {stream.bytes_written} bytes")
+        
+        except BrokenPipeError:
+            logger.info("Export stream cancelled by client")
+        
+        except Exception as e:
+            logger.error(f"Export stream failed: {e}")
+            stream.finish(e)
+        
+        finally:
+            products.close()
+            export_stream_slots.release()
+
+@app.route('/api/omnisystem/export-stream', methods=['POST'])
+@optional_auth
+def export_stream_link():
+    """
+    Link firmato (breve durata) per scaricare l'export in streaming:
+    il download parte subito e il file non passa da EXPORT_PATH.
+    Opzionale, per export molto grandi: il percorso normale (job 'excel')
+    ha cache degli export, miniature e parti nel pool di processi.
+    Se l'export identico è già in cache ritorna il download_url del file;
+    per i piani con miniature (lo stream è solo testo) accoda il job 'excel'
+    """
+    data = request.get_json() or {}
+    user = request.current_user
+    
+    extraction = result_store.get(data.get('extraction_id'), user)
+    if not extraction:
+        return jsonify({'error': 'Estrazione non trovata o scaduta'}), 404
+    
+    if not extraction.products_count:
+        return jsonify({'error': 'Nessun prodotto da esportare'}), 400
+    
+    portal_type = data.get('portal_type') or extraction.portal_type or 'public'
+    
+    # Export identico già generato: download diretto del file in cache, niente rigenerazione
+    _, cached = OmniSystemExcelGenerator().cached_export(result_store.products(extraction), portal_type, user)
+    if cached:
+        return jsonify({
+            'success': True,
+            'download_url': f"/download/{cached['filename']}",
+            'products_count': extraction.products_count,
+            'cached': True
+        })
+    
+    # Miniature solo nel percorso su file: job excel, stessa risposta di /api/omnisystem/jobs
+    if OmniSystemExcelGenerator._include_images(user):
+        job = job_queue.submit('excel', {
+            'extraction_id': extraction.id,
+            'portal_type': portal_type,
+            'client': _client_info()
+        }, user)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status': job.status,
+            'poll_url': f"/api/omnisystem/jobs/{job.id}",
+            'result_url': f"/api/omnisystem/jobs/{job.id}/result"
+        }), 202
+    
+    # Audience dedicata: il token non vale come token di login
+    token = jwt.encode({
+        'extraction_id': extraction.id,
+        'user_id': user.id if user else None,
+        'portal_type': portal_type,
+        'include_ai': OmniSystemExcelGenerator._include_ai(user),
+        'aud': EXPORT_STREAM_AUDIENCE,
+        'exp': datetime.utcnow() + timedelta(seconds=OmniSystemConfig.EXPORT_STREAM_TOKEN_TTL)
+    }, app.config['SECRET_KEY'], algorithm='HS256')
+    
+    return jsonify({
+        'success': True,
+        'stream_url': f"/download/stream/{token}",
+        'products_count': extraction.products_count,
+        'split': extraction.products_count > OmniSystemConfig.EXCEL_SPLIT_AT
+    })
+
+@app.route('/download/stream/<token>')
+def download_stream(token):
+    """
+    Export xlsx (o ZIP delle parti) generato mentre viene scaricato.
+    La risposta dura quanto il download: richiede worker gunicorn gthread
+    (start_production.sh), i worker sync verrebbero uccisi dopo --timeout
+    """
+    try:
+        claims = jwt.decode(
+            token, app.config['SECRET_KEY'], algorithms=['HS256'], audience=EXPORT_STREAM_AUDIENCE
+        )
+    except jwt.InvalidTokenError:
+        return "Link non valido o scaduto", 403
+    
+    user = User.query.get(claims['user_id']) if claims.get('user_id') else None
+    extraction = result_store.get(claims['extraction_id'], user)
+    if not extraction:
+        return "File non trovato", 404
+    
+    portal_type = claims['portal_type']
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    if extraction.products_count > OmniSystemConfig.EXCEL_SPLIT_AT:
+        filename = f"LUXLAB_OMNISYSTEM_COMPLETE_{timestamp}.zip"
+        mimetype = 'application/zip'
+    else:
+        filename = f"LUXLAB_OMNISYSTEM_{portal_type.upper()}_{timestamp}.xlsx"
+        mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    
+    # Produttori tutti occupati: 503 subito, non un 200 che muore dopo EXPORT_STREAM_IDLE_TIMEOUT
+    if not export_stream_slots.acquire(blocking=False):
+        return Response("Troppi export in corso, riprova tra poco", status=503, headers={'Retry-After': '30'})
+    
+    stream = ChunkQueueWriter(
+        OmniSystemConfig.EXPORT_STREAM_CHUNK_SIZE,
+        OmniSystemConfig.EXPORT_STREAM_BUFFER_CHUNKS,
+        OmniSystemConfig.EXPORT_STREAM_IDLE_TIMEOUT
+    )
+    try:
+        export_stream_executor.submit(
+            _produce_export_stream, stream, result_store.iter_products(extraction),
+            portal_type, extraction.products_count, claims['include_ai']
+        )
+    except Exception:
+        export_stream_slots.release()
+        raise
+    
+    # Niente Content-Length: risposta chunked, senza buffering del proxy
+    return Response(stream, mimetype=mimetype, headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no'
+    })
+
 @app.route('/download/<filename>')
 def download(filename):
     """Download generated file"""
@@ -3795,6 +8196,10 @@ def download(filename):
     if not os.path.exists(filepath):
         return "File non trovato", 404
     
+    # Download = uso recente per la retention LRU degli export
+    if export_file_cache:
+        export_file_cache.touch(filename)
+    
     return send_file(filepath, as_attachment=True)
 
 @app.route('/api/health')
@@ -3810,7 +8215,10 @@ def health():
             'max_products': OmniSystemConfig.MAX_PRODUCTS_PER_REQUEST,
             'b2b_portals': len(OmniSystemConfig.B2B_PORTALS),
             'size_categories': len(OmniSystemConfig.ALL_SIZES)
-        }
+        },
+        'ai_cache': market_analysis_cache.info(),
+        'export_cache': export_file_cache.info() if export_file_cache else None,
+        'image_cache': product_image_pipeline.info()
     })
 
 # ==========================================
@@ -1,4 +1,8 @@
 #!/bin/bash
 cd /root/luxlab-clean/luxlab-omnisystem
 source venv/bin/activate
-gunicorn -w 4 -b 127.0.0.1:8080 --timeout 120 app:app --daemon --log-file logs/gunicorn.log
+# Processi gunicorn: anche app.py divide i core dei pool (parsing, export) per questo numero
+export WEB_WORKERS=4
+# Worker gthread: export in streaming e download lenti occupano un thread, non il worker
+# (con i worker sync una risposta oltre --timeout fa uccidere il worker e i suoi job)
+gunicorn -w $WEB_WORKERS --worker-class gthread --threads 8 -b 127.0.0.1:8080 --timeout 120 app:app --daemon --log-file logs/gunicorn.log